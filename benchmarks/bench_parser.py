@@ -0,0 +1,87 @@
+"""
+bench_parser.py
+
+Compares the markdown parser in indexer.py with the line by line parser it replaced,
+in lines per second.
+
+Usage: $ python3 benchmarks/bench_parser.py [index.md] [--repeats n]
+Without a file a synthetic index of 200,000 lines is used (see corpus.py).
+"""
+
+import sys
+import os
+import re
+import time
+import argparse
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import indexer
+import corpus
+
+
+def legacy_parse_line(index, line):
+    """ The old parse_line: search for the location, then split the line on it """
+
+    location_re = re.search(r'\d+\.\d+', line)
+    location = line[location_re.start():location_re.end()]
+    line_text = re.split(r'\d+\.\d+', line)
+    line_text_clean = []
+    for item in line_text:
+        if item != '':
+            line_text_clean.append(item.strip())
+    if len(line_text_clean) == 1:
+        index.add_entry(line_text_clean[0], location)
+    else:
+        index.add_entry(line_text_clean[0], location, line_text_clean[1])
+
+def legacy_parse_file(file_name):
+    """ The old parse_file: one parse_line call per line """
+
+    index = indexer.Index()
+    index.columns = 2
+    with open(file_name, "r") as fo:
+        for line in fo:
+            if len(line) > 1 and not line.startswith('#'):
+                legacy_parse_line(index, line.rstrip())
+                if index.comments[-1] != '':
+                    index.columns = 3
+    return index
+
+def best_time(function, file_name, repeats):
+    """ Fastest of repeats runs, in seconds """
+
+    best = None
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeats):
+            start = time.perf_counter()
+            function(file_name)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def run(file_name, repeats=3):
+    """ Prints lines/second for both parsers """
+
+    with open(file_name) as fo:
+        lines = sum(1 for _ in fo)
+    for name, function in (("legacy", legacy_parse_file), ("indexer", indexer.parse_file)):
+        elapsed = best_time(function, file_name, repeats)
+        print(f"{name:8} {lines / elapsed:>12,.0f} lines/s ({elapsed:.3f}s for {lines} lines)")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compare the markdown parser with the one it replaced, in lines per second")
+    parser.add_argument("input", nargs="?", help="markdown index to parse (default: a synthetic index of 200,000 lines)")
+    parser.add_argument("--repeats", type=int, default=3, help="runs per parser, the best is kept")
+    args = parser.parse_args()
+
+    if args.input:
+        run(args.input, args.repeats)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "index.md")
+            corpus.write_corpus(file_name, entries=200000)
+            run(file_name, args.repeats)
@@ -0,0 +1,148 @@
+"""
+bench_pipeline.py
+
+Times each stage of the indexer pipeline (and its peak memory) on a synthetic index,
+and saves the results as JSON so two versions can be compared.
+
+Usage: $ python3 benchmarks/bench_pipeline.py [--entries n ...] [--repeats n] [--json results.json] [--compare old.json]
+See corpus.py for the corpus options.
+"""
+
+import sys
+import os
+import io
+import gc
+import time
+import json
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import indexer
+import corpus
+
+
+def copy_index(index):
+    """ A separate copy of index (for stages that change it) """
+
+    return index.subset(range(index.count))
+
+def format_all(index):
+    """ Formats every keyword and comment, starting with an empty cache """
+
+    indexer.format_to_html.cache_clear()
+    for text in index.keywords:
+        indexer.format_to_html(text)
+    for text in index.comments:
+        indexer.format_to_html(text)
+
+def render_html(index):
+    """ Renders the whole HTML file to a string, starting with an empty formatting cache """
+
+    indexer.format_to_html.cache_clear()
+    return indexer.create_html(index, True, index.columns, False, "Benchmark")
+
+# (name, function taking the prepared data, function preparing the data from the loaded files)
+# Preparing isn't timed
+STAGES = [
+    ("parse_markdown", indexer.parse_file, lambda files: files["md"]),
+    ("load_tsv", indexer.load_file_tsv, lambda files: files["tsv"]),
+    ("normalize", lambda index: index.normalize(), lambda files: copy_index(files["parsed"])),
+    ("sort", lambda index: index.sort(), lambda files: copy_index(files["normalized"])),
+    ("format_to_html", format_all, lambda files: files["sorted"]),
+    ("create_html", render_html, lambda files: files["sorted"]),
+    ("find_duplicates", indexer.find_duplicates, lambda files: files["sorted"]),
+    ("report", lambda index: indexer.report_stats(index, False), lambda files: files["sorted"]),
+    ("search_index", lambda index: indexer.SearchIndex(index).build(), lambda files: files["sorted"]),
+]
+
+def quiet():
+    """ Hides what the indexer prints """
+
+    return contextlib.redirect_stdout(io.StringIO())
+
+def time_stage(function, prepare, files, repeats):
+    """ Best time of repeats runs (seconds), then the peak memory of one more run (bytes) """
+
+    best = None
+    for _ in range(repeats):
+        data = prepare(files)
+        gc.collect()
+        with quiet():
+            start = time.perf_counter()
+            function(data)
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    # tracemalloc slows everything down, so memory gets its own run
+    data = prepare(files)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        with quiet():
+            function(data)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+def run(options, repeats=3, stages=None):
+    """ Generates the corpus, runs the stages, returns the results as a dict """
+
+    results = {"python": platform.python_version(), "platform": platform.platform(),
+               "corpus": options, "repeats": repeats, "stages": {}}
+    with tempfile.TemporaryDirectory() as directory:
+        files = {"md": os.path.join(directory, "index.md"), "tsv": os.path.join(directory, "index.tsv")}
+        corpus.write_corpus(files["md"], **options)
+        corpus.write_corpus(files["tsv"], **options)
+        with quiet():
+            files["parsed"] = indexer.parse_file(files["md"])
+        files["normalized"] = copy_index(files["parsed"])
+        files["normalized"].normalize()
+        files["sorted"] = copy_index(files["normalized"])
+        files["sorted"].sort()
+
+        for name, function, prepare in STAGES:
+            if stages and name not in stages:
+                continue
+            seconds, peak = time_stage(function, prepare, files, repeats)
+            results["stages"][name] = {"seconds": round(seconds, 6), "peak_bytes": peak,
+                                       "entries_per_second": round(options["entries"] / seconds) if seconds else None}
+    return results
+
+def print_results(results, baseline=None):
+    """ Prints a table of the results, with the change from baseline if given """
+
+    print(f"{results['corpus']['entries']} entries, best of {results['repeats']} (Python {results['python']})")
+    print(f"{'stage':<16} {'seconds':>9} {'entries/s':>12} {'peak MB':>9}" + ("   vs baseline" if baseline else ""))
+    for name, stage in results["stages"].items():
+        line = f"{name:<16} {stage['seconds']:>9.3f} {stage['entries_per_second'] or 0:>12,} {stage['peak_bytes'] / 2**20:>9.1f}"
+        if baseline and name in baseline["stages"]:
+            before = baseline["stages"][name]["seconds"]
+            line += f"   {stage['seconds'] / before:>6.2f}x time" if before else ""
+        print(line)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Time each stage of the indexer on a synthetic index")
+    corpus.add_arguments(parser)
+    parser.add_argument("--repeats", type=int, default=3, help="runs per stage, the best is kept")
+    parser.add_argument("--stage", action="append", choices=[name for name, _, _ in STAGES], help="only run this stage (repeatable)")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results file from an earlier run to compare with")
+    args = parser.parse_args()
+
+    results = run(corpus.corpus_options(args), args.repeats, args.stage)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fo:
+            baseline = json.load(fo)
+    print_results(results, baseline)
+    if args.json:
+        with open(args.json, "w") as fo:
+            json.dump(results, fo, indent=1)
+        print(f"Results written to {args.json}")
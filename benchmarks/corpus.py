@@ -0,0 +1,110 @@
+"""
+corpus.py
+
+Deterministic synthetic indexes for the benchmarks: the same options (and seed) always give the same file.
+
+Usage: $ python3 benchmarks/corpus.py <output.md|output.tsv> [--entries n] [--books n] [--pages n]
+       [--markup 0-1] [--comment-words n] [--duplicates 0-1] [--columns 2|3] [--seed n]
+"""
+
+import random
+import argparse
+
+# Words are made up from these syllables, so the vocabulary is large but still looks like words
+SYLLABLES = ["ker", "nel", "pac", "ket", "lin", "ux", "win", "dows", "reg", "is", "try", "hash", "mem", "or",
+             "port", "scan", "dns", "vol", "til", "pre", "fetch", "log", "auth", "net", "flow", "ssl", "cap", "dump"]
+COLOURS = ["red", "blue", "green", "purple"]
+
+DEFAULTS = {"entries": 100000, "books": 6, "pages": 300, "markup": 0.1, "comment_words": 5,
+            "duplicates": 0.05, "columns": 3, "seed": 1}
+
+def make_word(r):
+    """ A made up word of 1 to 4 syllables, sometimes upper case or with a number """
+
+    word = ''.join(r.choices(SYLLABLES, k=r.randint(1, 4)))
+    roll = r.random()
+    if roll < 0.1:
+        word = word.upper()
+    elif roll < 0.15:
+        word += str(r.randint(2, 64))
+    return word
+
+def add_markup(r, text):
+    """ Wraps text in bold, italic or a colour """
+
+    style = r.randint(0, 2)
+    if style == 0:
+        return f"**{text}**"
+    if style == 1:
+        return f"*{text}*"
+    return f";;{r.choice(COLOURS)} {text};;"
+
+def generate(entries=DEFAULTS["entries"], books=DEFAULTS["books"], pages=DEFAULTS["pages"], markup=DEFAULTS["markup"],
+             comment_words=DEFAULTS["comment_words"], duplicates=DEFAULTS["duplicates"], columns=DEFAULTS["columns"],
+             seed=DEFAULTS["seed"]):
+    """ Generates (keyword, location, comment) tuples
+
+        markup: share of keywords/comments with formatting, duplicates: share of entries reusing an earlier keyword,
+        comment_words: average words per comment (3 columns only) """
+
+    r = random.Random(seed)
+    vocabulary = [make_word(r) for _ in range(max(100, entries // 4))]
+    keywords = []
+    for _ in range(entries):
+        if keywords and r.random() < duplicates:
+            keyword = r.choice(keywords)
+        else:
+            keyword = ' '.join(r.choices(vocabulary, k=r.randint(1, 3)))
+            if r.random() < markup:
+                keyword = add_markup(r, keyword)
+            keywords.append(keyword)
+
+        location = f"{r.randint(1, books)}.{r.randint(1, pages)}"
+        comment = ''
+        if columns == 3:
+            words = r.randint(0, comment_words * 2)
+            comment = ' '.join(r.choices(vocabulary, k=words))
+            if comment and r.random() < markup:
+                comment = add_markup(r, comment)
+        yield keyword, location, comment
+
+def write_corpus(file_name, **options):
+    """ Writes a generated index as markdown, or TSV if file_name ends with .tsv """
+
+    tsv = file_name.endswith('.tsv')
+    columns = options.get("columns", DEFAULTS["columns"])
+    with open(file_name, "w") as fo:
+        if tsv:
+            fo.write("Keyword\tLocation\tComment\n" if columns == 3 else "Keyword\tLocation\n")
+        for keyword, location, comment in generate(**options):
+            if tsv:
+                fo.write(f"{keyword}\t{location}\t{comment}\n" if columns == 3 else f"{keyword}\t{location}\n")
+            else:
+                fo.write(f"{keyword} {location} {comment}".rstrip() + "\n")
+
+def add_arguments(parser):
+    """ Generator options, shared with the benchmark runner """
+
+    parser.add_argument("--entries", type=int, default=DEFAULTS["entries"])
+    parser.add_argument("--books", type=int, default=DEFAULTS["books"])
+    parser.add_argument("--pages", type=int, default=DEFAULTS["pages"], help="pages per book")
+    parser.add_argument("--markup", type=float, default=DEFAULTS["markup"], help="share of entries with formatting")
+    parser.add_argument("--comment-words", type=int, default=DEFAULTS["comment_words"], help="average words per comment")
+    parser.add_argument("--duplicates", type=float, default=DEFAULTS["duplicates"], help="share of repeated keywords")
+    parser.add_argument("--columns", type=int, choices=(2, 3), default=DEFAULTS["columns"])
+    parser.add_argument("--seed", type=int, default=DEFAULTS["seed"])
+
+def corpus_options(args):
+    """ generate() keyword arguments from parsed arguments """
+
+    return {name: getattr(args, name) for name in DEFAULTS}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Write a synthetic index for benchmarking")
+    parser.add_argument("output", help="file to write (.md or .tsv)")
+    add_arguments(parser)
+    args = parser.parse_args()
+    write_corpus(args.output, **corpus_options(args))
+    print(f"{args.entries} entries written to {args.output}")
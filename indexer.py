@@ -19,126 +19,703 @@ Can use \n for a linebreak, Must escape with \\n
 import sys
 import re
 import string
-import csv
+import itertools
+import bisect
+import operator
+import functools
+import os
+import glob
+import struct
+import contextlib
+import io
+import weakref
+import collections
+import time
+from array import array
+
+# Output is written in chunks as it is generated, this is the size of the file buffer
+WRITE_BUFFER_SIZE = 1 << 16
+
+
+### Profiling Hooks
+
+# Functions called as hook(stage, metrics) when a pipeline stage ends, see profile_stage()
+PROFILE_HOOKS = []
+# Peak traced memory of each open stage (its children's peaks included)
+_profile_stack = []
+# Start of each open stage, a stage's order is its parents' starts then its own (so the table lists it under them)
+_profile_starts = []
+_profile_start = None
+
+def add_profile_hook(hook):
+    """ Registers hook(stage, metrics) to be called at the end of every pipeline stage
+
+        metrics has wall and cpu (seconds), start (seconds since the first stage),
+        depth (nesting, e.g. parse is inside load), order (sorts the stages under the stage they are in),
+        entries (if known), file (the file written, for write stages),
+        peak_memory (bytes, only while tracemalloc is tracing) and max_rss (bytes, where available) """
+
+    PROFILE_HOOKS.append(hook)
+
+def remove_profile_hook(hook):
+    """ Unregisters a hook added with add_profile_hook """
+
+    PROFILE_HOOKS.remove(hook)
+
+def max_rss():
+    """ Peak resident memory of this process in bytes, None where the resource module isn't available """
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def record_stage(stage, metrics):
+    """ Passes the metrics of a finished stage to every hook """
+
+    metrics.setdefault('depth', len(_profile_stack))
+    metrics.setdefault('order', (*_profile_starts, metrics.get('start', 0)))
+    metrics.setdefault('max_rss', max_rss())
+    for hook in list(PROFILE_HOOKS):
+        hook(stage, metrics)
+
+@contextlib.contextmanager
+def profile_stage(stage):
+    """ Measures the code inside the with block as one pipeline stage (does nothing without hooks)
+
+        Yields the metrics dict, add 'entries' (or anything else) to it inside the block """
+
+    global _profile_start
+    metrics = {}
+    if not PROFILE_HOOKS:
+        yield metrics
+        return
+
+    import tracemalloc
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        # The parent's peak so far, then start measuring this stage on its own
+        if _profile_stack:
+            _profile_stack[-1] = max(_profile_stack[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    metrics['depth'] = len(_profile_stack)
+    _profile_stack.append(0)
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    if _profile_start is None:
+        _profile_start = wall
+    metrics['start'] = wall - _profile_start
+    _profile_starts.append(metrics['start'])
+    try:
+        yield metrics
+    finally:
+        metrics['wall'] = time.perf_counter() - wall
+        metrics['cpu'] = time.process_time() - cpu
+        _profile_starts.pop()
+        peak = _profile_stack.pop()
+        if tracing and tracemalloc.is_tracing():
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            if _profile_stack:
+                _profile_stack[-1] = max(_profile_stack[-1], peak)
+            tracemalloc.reset_peak()
+            metrics['peak_memory'] = peak
+        record_stage(stage, metrics)
+
+class StageTotal():
+    """ A stage done a little at a time (e.g. one output of write_outputs, called section by section): the time inside
+        every timing() block is added up and recorded as one stage by finish() (does nothing without hooks) """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.metrics = {'wall': 0.0, 'cpu': 0.0}
+
+    @contextlib.contextmanager
+    def timing(self):
+        """ Adds the time of the code inside the with block to the stage, yields the metrics dict """
+
+        global _profile_start
+        if not PROFILE_HOOKS:
+            yield self.metrics
+            return
+        import tracemalloc
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            # As in profile_stage, the peak of each block on its own
+            if _profile_stack:
+                _profile_stack[-1] = max(_profile_stack[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        if _profile_start is None:
+            _profile_start = wall
+        self.metrics.setdefault('start', wall - _profile_start)
+        # Stages recorded inside the block (e.g. writes) are nested in this one
+        _profile_stack.append(0)
+        _profile_starts.append(self.metrics['start'])
+        try:
+            yield self.metrics
+        finally:
+            _profile_starts.pop()
+            peak = _profile_stack.pop()
+            self.metrics['wall'] += time.perf_counter() - wall
+            self.metrics['cpu'] += time.process_time() - cpu
+            if tracing and tracemalloc.is_tracing():
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                if _profile_stack:
+                    _profile_stack[-1] = max(_profile_stack[-1], peak)
+                tracemalloc.reset_peak()
+                self.metrics['peak_memory'] = max(self.metrics.get('peak_memory', 0), peak)
+
+    def finish(self, **metrics):
+        """ Records the stage (if any of it was timed) with metrics added, e.g. entries """
+
+        if PROFILE_HOOKS and 'start' in self.metrics:
+            self.metrics.update(metrics)
+            record_stage(self.stage, self.metrics)
+
+class ProfileReport():
+    """ Profile hook that collects the stages and prints them as a table (used by --profile) """
+
+    def __init__(self):
+        self.stages = []
+
+    def __call__(self, stage, metrics):
+        self.stages.append((stage, metrics))
+
+    def print_report(self, file=None):
+        """ Prints the stages in the order they started, nested stages indented under the stage they are in """
+
+        file = file or sys.stderr
+        print(f"{'Stage':<30}{'Wall (s)':>10}{'CPU (s)':>10}{'Entries':>10}{'Peak MB':>10}{'Max RSS MB':>12}", file=file)
+        for stage, metrics in sorted(self.stages, key=lambda item: item[1]['order']):
+            name = '  ' * metrics['depth'] + stage
+            if 'file' in metrics:
+                name += f" {os.path.basename(metrics['file'])}"
+            entries = metrics.get('entries', '')
+            peak = metrics.get('peak_memory')
+            peak = f"{peak / 2**20:.1f}" if peak is not None else '-'
+            rss = metrics.get('max_rss')
+            rss = f"{rss / 2**20:.1f}" if rss is not None else '-'
+            print(f"{name:<30}{metrics['wall']:>10.3f}{metrics['cpu']:>10.3f}{entries:>10}{peak:>10}{rss:>12}", file=file)
 
 
 ### Define the Index class
 
+# Locations (n.nnn) are packed into a single integer, the book number in the high bits and the page in the low bits
+PAGE_BITS = 20
+PAGE_MASK = (1 << PAGE_BITS) - 1
+
+# Maps the field names used by callers (e.g. entry['Keyword']) to the Index column holding them
+COLUMN_NAMES = {"Keyword": "keywords", "Location": "locations", "Comment": "comments"}
+
+def pack_location(location):
+    """ Packs a location string e.g. '1.103' into a single int, unreadable locations are packed as 0 """
+
+    book, _, page = location.partition('.')
+    try:
+        return (int(book) << PAGE_BITS) | int(page)
+    except ValueError:
+        return 0
+
+class Entry():
+    """ Lightweight view of one row of an Index, nothing is copied out of the index columns """
+
+    __slots__ = ('index', 'position')
+
+    def __init__(self, index, position):
+        self.index = index
+        self.position = position
+
+    def __getitem__(self, field):
+        """ Allows entry['Keyword'], entry['Location'] and entry['Comment'] """
+
+        return getattr(self.index, COLUMN_NAMES[field])[self.position]
+
+    @property
+    def keyword(self):
+        return self.index.keywords[self.position]
+
+    @property
+    def location(self):
+        return self.index.locations[self.position]
+
+    @property
+    def comment(self):
+        return self.index.comments[self.position]
+
+    @property
+    def sort_key(self):
+        return self.index.sort_keys[self.position]
+
+    @property
+    def letter(self):
+        return self.index.letters[self.position]
+
+    @property
+    def plain_keyword(self):
+        return self.index.plain_keywords[self.position]
+
+    @property
+    def book(self):
+        return self.index.packed_locations[self.position] >> PAGE_BITS
+
+    @property
+    def page(self):
+        return self.index.packed_locations[self.position] & PAGE_MASK
+
+class Entries():
+    """ Sequence of Entry views over an Index (what index.entries returns) """
+
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.count
+
+    def __getitem__(self, position):
+        # range() takes care of negative positions, slices and raising IndexError/TypeError
+        positions = range(self.index.count)[position]
+        if isinstance(positions, range):
+            return [Entry(self.index, position) for position in positions]
+        return Entry(self.index, positions)
+
+    def __iter__(self):
+        index = self.index
+        for position in range(index.count):
+            yield Entry(index, position)
+
 class Index():
+    """ Stores the entries column by column (parallel lists) rather than as a dict per entry """
     
     def __init__(self):
         """ Instantiates the Index""" 
         
         self.columns = 0
-        self.entries = []
-        self.count = 0
+        self.keywords = []
+        self.locations = [] # Interned, the same few hundred page strings are shared by every entry
+        self.comments = []
+        self.packed_locations = array('Q')
+
+        # Filled in once by normalize() and then reused by sorting, sections, reports and duplicates
+        self.sort_keys = [] # bytes, see Collation
+        self.letters = [] # Upper case first letter used for the letter sections ('' if there isn't one)
+        self.plain_keywords = [] # Keyword with the markdown/colour formatting removed
+
+        # Goes up whenever the entries are rearranged or normalized again, together with count it tells
+        # the search and location indexes built from this index (see search()) whether they are out of date
+        self.version = 0
+
+    @property
+    def count(self):
+        return len(self.keywords)
+
+    @property
+    def entries(self):
+        return Entries(self)
+
+    @property
+    def normalized(self):
+        return len(self.sort_keys) == len(self.keywords)
+
+    def column_names(self):
+        """ Names of the columns holding data (the normalized columns are only there after normalize()) """
+
+        names = ['keywords', 'locations', 'comments', 'packed_locations']
+        if self.normalized:
+            names += ['sort_keys', 'letters', 'plain_keywords']
+        return names
     
     def add_entry(self, keyword, location, comment=''):
         """ Add an entry to the index """
         
-        self.entries.append({"Keyword":keyword, "Location":location, "Comment":comment})
-        self.count += 1
+        self.keywords.append(keyword)
+        self.locations.append(sys.intern(location))
+        self.comments.append(comment if comment else '')
+        self.packed_locations.append(pack_location(location))
+
+    def extend(self, keywords, locations, comments):
+        """ Add many entries at once (parallel lists, comments are '' when there is none) """
+
+        # Pack each distinct location once
+        packed = {location: pack_location(location) for location in set(locations)}
+        self.keywords.extend(keywords)
+        self.locations.extend(map(sys.intern, locations))
+        self.comments.extend(comments)
+        self.packed_locations.extend(map(packed.__getitem__, locations))
+
+    def add_from(self, index, position):
+        """ Copy an entry from another index (strings are shared, not copied) """
+
+        for name in index.column_names():
+            getattr(self, name).append(getattr(index, name)[position])
+
+    def html_slice(self, start, stop):
+        """ Returns a new Index with only what rendering needs (keywords, locations, comments) of entries start to stop - 1 """
+
+        index = Index()
+        index.columns = self.columns
+        index.keywords = self.keywords[start:stop]
+        index.locations = self.locations[start:stop]
+        index.comments = self.comments[start:stop]
+        return index
+
+    def subset(self, positions):
+        """ Returns a new Index holding only the entries at positions (in that order) """
+
+        index = Index()
+        index.columns = self.columns
+        index.reorder(positions, source=self)
+        return index
+
+    def normalize(self, collation=None):
+        """ Works out the sort key, section letter and plain keyword of every entry (do this once after loading)
+
+            collation orders the keywords (see Collation), the default is DEFAULT_COLLATION """
+
+        self.plain_keywords = [strip_formatting(keyword) for keyword in self.keywords]
+        self.sort_keys, self.letters = (collation or DEFAULT_COLLATION).keys(self.plain_keywords, self.packed_locations)
+        self.version += 1
+
+    def reorder(self, order, source=None):
+        """ Rearranges every column so that entry order[i] becomes entry i (taking the entries from source if given) """
+
+        if source is None:
+            source = self
+        for name in source.column_names():
+            column = getattr(source, name)
+            if isinstance(column, array):
+                setattr(self, name, array(column.typecode, map(column.__getitem__, order)))
+            else:
+                setattr(self, name, [column[i] for i in order])
+        self.version += 1
+
+    def sort(self, key=None):
+        """ Sorts the index in place by the normalized sort key (or key, called with each Entry) """
+
+        if key is None:
+            order = sorted(range(self.count), key=self.sort_keys.__getitem__)
+        else:
+            order = sorted(range(self.count), key=lambda position: key(Entry(self, position)))
+        self.reorder(order)
+
+
+### Collation
+
+# Sort keys are bytes, worked out once per entry by normalize() so sorting stays a single sort on them.
+# The plain keyword is split into tokens, each starting with a marker that orders the kinds of token
+# (separator < punctuation < number < word), numbers start with their length so they sort by value.
+# Entries with the same keyword are then ordered by location: \x00 (before any marker) and the packed location
+COLLATION_SEPARATOR = '\x01'
+COLLATION_PUNCTUATION = '\x02'
+COLLATION_NUMBER = '\x03'
+COLLATION_WORD = '\x04'
+COLLATION_OPTIONS = ('natural', 'accents', 'punctuation', 'location')
+COLLATION_LOCATION = struct.Struct('>xQ')
+# Lower case ASCII words and single spaces (most keywords) don't need to be split into tokens
+SIMPLE_KEYWORD_RE = re.compile(r'[A-Za-z]+(?: [A-Za-z]+)*')
+
+class Collation():
+    """ How keywords are ordered, shared by the markdown and TSV loaders
+
+        natural: numbers sort by value ('80' < '443' < '802.11'), fold_accents: 'é' sorts as 'e',
+        ignore_punctuation: punctuation only separates words ('#hash' sorts as 'hash'),
+        by_location: equal keywords are ordered by book/page, locale_name: sort words with that locale's rules """
+
+    def __init__(self, natural=True, fold_accents=True, ignore_punctuation=True, by_location=True, locale_name=None):
+        self.natural = natural
+        self.fold_accents = fold_accents
+        self.ignore_punctuation = ignore_punctuation
+        self.by_location = by_location
+        self.locale_name = locale_name
+        # Without natural numbers digits are part of words (and compared character by character)
+        word = r'[^\W\d_]+' if natural else r'[^\W_]+'
+        self.token_re = re.compile(rf'({word})|([0-9]+)|(\s+)|(.)', re.DOTALL)
+
+    def __repr__(self):
+        options = [option for option, on in zip(COLLATION_OPTIONS, (self.natural, self.fold_accents, self.ignore_punctuation, self.by_location)) if on]
+        return f"Collation({','.join(options) or 'none'}, locale={self.locale_name!r})"
+
+    def set_locale(self):
+        """ Switches LC_COLLATE to locale_name (raises locale.Error if it isn't installed) """
+
+        import locale
+
+        locale.setlocale(locale.LC_COLLATE, self.locale_name)
+
+    def key(self, keyword):
+        """ Returns (sort key without the location, upper case section letter) for a plain keyword """
+
+        text = keyword
+        if self.fold_accents and not text.isascii():
+            import unicodedata
+            text = ''.join(char for char in unicodedata.normalize('NFKD', text) if not unicodedata.combining(char))
+        text = text.casefold()
+        if self.locale_name is not None:
+            import locale
+
+        tokens = []
+        letter = ''
+        for word, number, space, other in self.token_re.findall(text):
+            if space or (other and self.ignore_punctuation):
+                # One separator between tokens, none at either end
+                if tokens and tokens[-1] != COLLATION_SEPARATOR:
+                    tokens.append(COLLATION_SEPARATOR)
+                continue
+            if not letter:
+                letter = (word or number or other)[0].upper()
+            if word:
+                if self.locale_name is not None:
+                    # Shifted so the transformed word never contains a marker
+                    word = ''.join([chr(ord(char) + 5) for char in locale.strxfrm(word)])
+                tokens.append(COLLATION_WORD + word)
+            elif number:
+                digits = number.lstrip('0') or '0'
+                tokens.append(COLLATION_NUMBER + chr(len(digits) + 0x20) + digits)
+            else:
+                tokens.append(COLLATION_PUNCTUATION + other)
+        if tokens and tokens[-1] == COLLATION_SEPARATOR:
+            tokens.pop()
+        return ''.join(tokens).encode('utf-8', 'surrogatepass'), letter
+
+    def keys(self, keywords, packed_locations):
+        """ Sort keys and section letters (two lists) for plain keywords """
+
+        if self.locale_name is None:
+            # Work out the keys of the simple keywords all at once (the same as key() would give),
+            # then go back over the others one at a time
+            word = COLLATION_WORD.encode()
+            replace_spaces = operator.methodcaller('replace', ' ', COLLATION_SEPARATOR + COLLATION_WORD)
+            keys = list(map(word.__add__, map(str.encode, map(replace_spaces, map(str.lower, keywords)))))
+            letters = list(map(str.upper, map(operator.itemgetter(slice(0, 1)), keywords)))
+            complex_positions = itertools.compress(range(len(keywords)), map(operator.not_, map(SIMPLE_KEYWORD_RE.fullmatch, keywords)))
+        else:
+            self.set_locale()
+            keys = [b''] * len(keywords)
+            letters = [''] * len(keywords)
+            complex_positions = range(len(keywords))
+        for position in complex_positions:
+            keys[position], letters[position] = self.key(keywords[position])
+
+        if self.by_location:
+            keys = list(map(bytes.__add__, keys, map(COLLATION_LOCATION.pack, packed_locations)))
+        # Interned, the few distinct letters are shared by every entry (and compared by identity)
+        return keys, list(map(sys.intern, letters))
+
+DEFAULT_COLLATION = Collation()
+
+def parse_collation(option_input, locale_name=None):
+    """ Collation from a comma separated list of the options to use (e.g. 'natural,location', 'none' for none of them)
+
+        Returns None if an option isn't recognised """
+
+    options = set(option_input.lower().split(',')) - {'none', ''}
+    if not options <= set(COLLATION_OPTIONS):
+        return None
+    return Collation(*(option in options for option in COLLATION_OPTIONS), locale_name=locale_name)
 
 
 ### TSV Specific Functions
 
+# Rows are read and added to the index this many at a time
+TSV_CHUNK_ROWS = 1 << 14
+TABLE_EXTENSIONS = ('.tsv', '.csv')
+
+def open_input(file_name, newline=None):
+    """ Opens an input file as text, gzip compressed files (by their first bytes, not the name) are decompressed """
+
+    with open(file_name, 'rb') as fo:
+        compressed = fo.read(2) == b'\x1f\x8b'
+    if compressed:
+        import gzip
+        return gzip.open(file_name, 'rt', newline=newline)
+    return open(file_name, 'r', newline=newline)
+
+def is_table_file(file_name):
+    """ True for .csv files (and .csv.gz), which can't be read as markdown """
+
+    file_name = file_name.lower()
+    if file_name.endswith('.gz'):
+        file_name = file_name[:-3]
+    return file_name.endswith('.csv')
+
 def load_file_tsv(file_name):
-    """ Open TSV file and create the index object """
+    """ Open TSV (or CSV) file and create the index object
+
+        The heading row is read first to pick the delimiter and the columns,
+        then the rows are added in chunks in a single pass """
 
     index = Index()
+    for columns, keywords, locations, comments in iter_tsv_chunks(file_name):
+        index.columns = columns
+        index.extend(keywords, locations, comments)
+    return index
 
-    with open(file_name, "r") as index_file:
-        tsv_reader = csv.DictReader(index_file, delimiter="\t")
-        
-        # Determine if 3 or 2 column index
-        try:
-            for entry in tsv_reader:
-                index.add_entry(entry['Keyword'], entry['Location'], entry['Comment'])
-        except KeyError:
-            print("Comment Column Not Detected")
-        else:
-            print("Loaded TSV File: Three Column Index Detected")
-            index.columns = 3
-            return index
-        
-    # Load 2 column index
-    with open(file_name, "r") as index_file:
-        tsv_reader = csv.DictReader(index_file, delimiter="\t")
+def iter_tsv_chunks(file_name, chunk_rows=TSV_CHUNK_ROWS):
+    """ Reads a TSV (or CSV) file chunk_rows rows at a time, generates (columns, keywords, locations, comments) per chunk
 
-        # Catch error if no headings
-        try:
-            for entry in tsv_reader:
-                index.add_entry(entry['Keyword'], entry['Location'])
-        except KeyError:
+        Nothing is generated if the heading row is missing """
+
+    import csv
+
+    with open_input(file_name, newline='') as index_file:
+        heading = index_file.readline()
+        delimiter = '\t' if '\t' in heading or ',' not in heading else ','
+        names = [name.strip().lstrip('\ufeff') for name in next(csv.reader([heading], delimiter=delimiter), [])]
+
+        # Determine if 3 or 2 column index
+        if 'Keyword' not in names or 'Location' not in names:
             print("Error: No Headings detected, does the TSV file have Keyword/Location/Comment titles in the first row?")
-            return index
+            return
+        wanted = [names.index('Keyword'), names.index('Location')]
+        if 'Comment' in names:
+            wanted.append(names.index('Comment'))
+            index_columns = 3
         else:
-            index.columns = 2
-            print("Loaded TSV File: Two Column Index Detected")
-            return index
+            print("Comment Column Not Detected")
+            index_columns = 2
+        get_columns = operator.itemgetter(*wanted)
+        width = max(wanted) + 1
+
+        tsv_reader = csv.reader(index_file, delimiter=delimiter)
+        for chunk in iter(lambda: list(itertools.islice(tsv_reader, chunk_rows)), []):
+            try:
+                rows = list(map(get_columns, chunk))
+            except IndexError:
+                # Blank rows are skipped, short rows are missing the comment (or more) so pad them
+                rows = [get_columns(row + [''] * (width - len(row))) for row in chunk if row]
+            if not rows:
+                continue
+            columns = list(zip(*rows))
+            comments = columns[2] if index_columns == 3 else [''] * len(rows)
+            yield index_columns, columns[0], columns[1], comments
+
+    if index_columns == 3:
+        print("Loaded TSV File: Three Column Index Detected")
+    else:
+        print("Loaded TSV File: Two Column Index Detected")
 
 ### Markdown Specific Functions
 
-def parse_line(index, line):
-    """ Searches the line for the keyword, location, comment and populates index entry"""
-    # TODO throw an error message for each line parse failure!!! (print the line in question)
+# Every line matches exactly one branch: a # comment, an entry, a blank line, or a bad line.
+# The location is the first book.page number, the keyword is before it (made of runs of text and
+# numbers that aren't a location, each run can only match one way so bad lines can't backtrack badly)
+# and the comment is after it. Keywords and comments still need trailing whitespace removed
+MARKDOWN_LINE_RE = re.compile(r"""
+    ^(?:
+        \#[^\n]*
+      | [ \t]*(?P<keyword>(?:[^\d\n]+(?![^\d\n])|\d+(?!\d|\.\d))*)(?P<location>\d+\.\d+)[ \t]*(?P<comment>[^\n]*)
+      | [ \t\r]*
+      | (?P<bad>[^\n]+)
+    )$""", re.MULTILINE | re.VERBOSE)
 
-    # Get location first
-    location_re = re.search('\d+\.\d+', line)
-    location = line[location_re.start():location_re.end()]
-    
-    # Get remaining text
-    line_text = re.split('\d+\.\d+', line)
+# Bad lines printed before just giving the count
+MAX_REPORTED_LINES = 10
 
-    # Strip whitespace and eliminate empty strings
-    line_text_clean = []
-    for item in line_text:
-        if item != '':
-            line_text_clean.append(item.strip())
+def parse_text(text):
+    """ Parses markdown index text with one regex pass over the whole string, returns (index, bad lines)
 
-    # if len 'line_text_clean' is 1 then it's a two column index
-    if len(line_text_clean) == 1:
-        index.add_entry(line_text_clean[0], location)
-    else: # 3 columns
-        index.add_entry(line_text_clean[0], location, line_text_clean[1])
+        Bad lines (no location or no keyword) are skipped and returned as (line number, line) """
 
+    # One row per line (keyword, location, comment, bad), in the same order as the lines
+    rows = MARKDOWN_LINE_RE.findall(text)
+    entries = [row for row in rows if row[1]]
+    keywords = list(map(str.rstrip, map(operator.itemgetter(0), entries)))
+    locations = list(map(operator.itemgetter(1), entries))
+    comments = list(map(str.rstrip, map(operator.itemgetter(2), entries)))
 
-def parse_file(file_name):
-    """ Parses the file, determine # of columns, returns populated index """
-    # TODO Try catch filenotfound error
+    bad_lines = [(line_number, row[3].rstrip()) for line_number, row in enumerate(rows, 1) if row[3]]
+
+    # Location first, the text after it is the keyword (nothing at all after it is a bad line)
+    if '' in keywords:
+        line_numbers = [line_number for line_number, row in enumerate(rows, 1) if row[1]]
+        for position in reversed(range(len(keywords))):
+            if keywords[position]:
+                continue
+            if comments[position]:
+                keywords[position] = comments[position]
+                comments[position] = ''
+            else:
+                bad_lines.append((line_numbers[position], locations[position]))
+                del keywords[position], locations[position], comments[position]
+        bad_lines.sort()
 
-    # Catch if file might be TSV?
-    tsv_file = False
-    
-    # Index will be a list of dicts (keys of keyword,location,comment)
     index = Index()
-    # Default 2 column
-    index.columns = 2
-    
-    # Identify where is the keyword, location, comment (skip lines with #)
-    with open(file_name, "r") as fo:
-        for line in fo:
+    index.extend(keywords, locations, comments)
+    # Any comment at all makes it a 3 column index
+    index.columns = 3 if any(comments) else 2
+    return index, bad_lines
 
-            # TSV Check
-            if "\t" in line:
-                tsv_file = True
-            
-            if len(line) > 1 and not line.startswith('#'):
-                parse_line(index, line.rstrip())
-
-                # Check if any entries use 3 columns
-                if index.entries[-1]['Comment'] != '':
-                    index.columns = 3
-                    
-    if tsv_file:
+def parse_file(file_name):
+    """ Parses the file, determine # of columns, returns populated index
+
+        Raises ValueError if it looks like a TSV file (the first bad line has tabs, e.g. a heading row) """
+
+    with open_input(file_name) as fo:
+        text = fo.read()
+    index, bad_lines = parse_text(text)
+
+    # TSV files have a heading row without a location (Keyword, Location...)
+    if bad_lines and "\t" in bad_lines[0][1]:
+        raise ValueError(f"{file_name} looks like a TSV file")
+
+    print_parse_warnings(file_name, bad_lines, len(bad_lines), index.columns, "\t" in text)
+    return index
+
+def print_bad_lines(file_name, bad_lines, bad_count):
+    """ Prints the first few skipped lines (of bad_count) """
+
+    for line_number, line in bad_lines[:MAX_REPORTED_LINES]:
+        print(f"Warning: {file_name} line {line_number}: no keyword or location (book.page) found, skipped: {line}")
+    if bad_count > MAX_REPORTED_LINES:
+        print(f"Warning: {bad_count - MAX_REPORTED_LINES} more lines in {file_name} skipped")
+
+def print_parse_warnings(file_name, bad_lines, bad_count, columns, tabs):
+    """ Prints the first few skipped lines (of bad_count) and what kind of file it was (tabs: the file has tabs in it) """
+
+    print_bad_lines(file_name, bad_lines, bad_count)
+
+    # Catch if file might be TSV?
+    if tabs:
         print("Warning: This might be a TSV file without Headings, did you use the right flag?\nOutput not guaranteed")
     else:
-        print(f"Input was a markdown file with {index.columns} columns.")   
-    return index
+        print(f"Input was a markdown file with {columns} columns.")
+
+def iter_markdown_chunks(file_name, chunk_bytes):
+    """ Parses the file about chunk_bytes of text at a time (whole lines), generates an Index per chunk
+
+        Raises ValueError like parse_file if the first chunk looks like a TSV file """
+
+    bad_lines = []
+    bad_count = 0
+    columns = 2
+    tabs = False
+    line_count = 0
+    with open_input(file_name) as fo:
+        for lines in iter(lambda: fo.readlines(chunk_bytes), []):
+            text = ''.join(lines)
+            index, chunk_bad_lines = parse_text(text)
+            if not line_count and chunk_bad_lines and "\t" in chunk_bad_lines[0][1]:
+                raise ValueError(f"{file_name} looks like a TSV file")
+            bad_lines += [(line_count + line_number, line) for line_number, line in chunk_bad_lines[:MAX_REPORTED_LINES - len(bad_lines)]]
+            bad_count += len(chunk_bad_lines)
+            line_count += len(lines)
+            columns = max(columns, index.columns)
+            tabs = tabs or "\t" in text
+            yield index
+    print_parse_warnings(file_name, bad_lines, bad_count, columns, tabs)
 
 def strip_formatting(keyword):
     """ Strips markdown formatting and colour formatting from entries to make sort key """
 
+    # Nothing to strip (most keywords)
+    if ';;' not in keyword and '*' not in keyword:
+        return keyword
+
     # First we have to strip colour formatting e.g. ;;blue before stripping punctuation e.g. ;;
             
     while ';;' in keyword:
@@ -151,7 +728,9 @@ def strip_formatting(keyword):
             keyword = keyword[:-2]
         # find something like ";;xxx"
         start = keyword.index(';;')
-        stop = keyword.index(' ', start) + 1 # First 'space' after the ';;____' (+1 removes that space)
+        stop = keyword.find(' ', start) + 1 # First 'space' after the ';;____' (+1 removes that space)
+        if stop == 0: # No space, the colour runs to the end
+            stop = len(keyword)
         # Add that color to the stripped colors list
         keyword = keyword[:start] + keyword[stop:]
 
@@ -161,238 +740,1400 @@ def strip_formatting(keyword):
     return keyword
 
 
-### Generic Code
+### Loading Input Files
 
-def find_duplicates(index):
-    """ Find entries with a duplicate keyword (great to find terms in need of more context) """
+# File types picked up when a directory is given as input
+INPUT_EXTENSIONS = ('.md', '.txt', '.tsv', '.csv', '.md.gz', '.txt.gz', '.tsv.gz', '.csv.gz')
 
-    duplicates = Index()
-    duplicates.columns = index.columns
-    
-    # Iterate through index, compare entries i and i+1
-    for i in range(0, index.count - 1): #Skip entry 1 (meta data, stop at len-1 for out of bounds)
-        j = i + 1
-        if index.entries[i]['Keyword'].lower() == index.entries[j]['Keyword'].lower():
-            duplicates.entries.append(index.entries[i])
-            if index.entries[j]['Keyword'].lower() not in duplicates.entries:
-                duplicates.entries.append(index.entries[j])
+def expand_input_files(file_names):
+    """ Expands directories and glob patterns (e.g. 'book*.md') into a list of input files """
 
-    return duplicates
+    input_files = []
+    for file_name in file_names:
+        if os.path.isdir(file_name):
+            for child in sorted(os.listdir(file_name)):
+                if child.lower().endswith(INPUT_EXTENSIONS):
+                    input_files.append(os.path.join(file_name, child))
+        elif glob.has_magic(file_name):
+            input_files += sorted(glob.glob(file_name))
+        else:
+            input_files.append(file_name)
+    return input_files
 
-def search_index(index):
-    """ Searches the index and returns results containing the query """
+class RecordedOutput(io.TextIOBase):
+    """ Text stream writing through to stream and keeping a copy of what was written (in text) """
 
-    columns = index.columns
-    query = input("Search term: ").lower()
+    def __init__(self, stream):
+        self.stream = stream
+        self.parts = []
 
-    # Determine if 3 or 2 column index
-    if columns == 3:
-        option_input = input("Search **K**eyword, **C**omment, or **B**oth: ").lower()
-
-        # Just test first 3 chars, should work even with some minor typos
-        if option_input == "k" or option_input[:3] == "key":
-            for entry in index.entries:
-                if query in entry['Keyword'].lower():
-                    print(f"{entry['Keyword']} - [{entry['Location']}] - {entry['Comment']}")
-        elif option_input == "c" or option_input[:3] == "com":
-            for entry in index.entries:
-                if query in entry['Comment'].lower():
-                    print(f"{entry['Keyword']} - [{entry['Location']}] - {entry['Comment']}")
-        elif option_input == "b" or option_input[:3] == "bot":
-            for entry in index.entries:
-                if query in entry['Keyword'].lower() or query in entry['Comment'].lower():
-                    print(f"{entry['Keyword']} - [{entry['Location']}] - {entry['Comment']}")
-        else:
-            print("Invalid option")
-            
-    # Two Column Index
-    elif columns == 2:
-        for entry in index.entries:
-            if query in entry['Keyword'].lower():
-                print(f"{entry['Location']} \t- {entry['Keyword']}")
+    def write(self, text):
+        self.parts.append(text)
+        return self.stream.write(text)
 
-### Functions related to Creating a report
+    def flush(self):
+        self.stream.flush()
 
-def report_count(index):
-    """ Iterates through index and determines entries per book/per letter """
+    @property
+    def text(self):
+        return ''.join(self.parts)
 
-    book_entries = {}
-    alphabet_entries = {}
+def load_index(file_name, tsv=False, collation=None):
+    """ Loads, normalizes (with collation) and sorts a single input file
 
-    for entry in index.entries:
+        Returns (index, True if it was read as a TSV file, what reading it printed e.g. warnings about bad lines) """
 
-        # Book count
-        current_book = entry['Location'][:entry['Location'].index('.')] # Get str before the decimal
-        if current_book not in book_entries:
-            book_entries[current_book] = 1
-        else:
-            book_entries[current_book] += 1
-
-        # Letter count
-        current_letter = get_first_letter(entry['Keyword']).upper()
-        # handle non alphabet chars
-        if not current_letter.isalpha():
-            current_letter = "#"   
-        if current_letter not in alphabet_entries:
-            alphabet_entries[current_letter] = 1
+    # CSV files are always tables
+    tsv = tsv or is_table_file(file_name)
+    with profile_stage('parse') as metrics, contextlib.redirect_stdout(RecordedOutput(sys.stdout)) as output:
+        if not tsv:
+            # Failsafe to check if user forgot TSV flag
+            try:
+                index = parse_file(file_name)
+            except ValueError:
+                tsv = True
+                print(f"Warning: -t TSV flag not used but {file_name} appears to be TSV file")
+
+        if tsv:
+            index = load_file_tsv(file_name)
+        metrics['entries'] = index.count
+
+    # Sort key is 'Keyword' without the formatting, the same for markdown and TSV
+    with profile_stage('normalize') as metrics:
+        index.normalize(collation)
+        metrics['entries'] = index.count
+    with profile_stage('sort') as metrics:
+        index.sort()
+        metrics['entries'] = index.count
+    return index, tsv, output.text
+
+def merge_indexes(indexes):
+    """ Merges already sorted indexes into one sorted index """
+
+    if len(indexes) == 1:
+        return indexes[0]
+
+    merged = concat_indexes(indexes)
+    # Each index is already a sorted run, so the (stable) sort only has to merge the runs
+    # and entries with the same sort key (and location) keep the order of the input files
+    merged.sort()
+    return merged
+
+def concat_indexes(indexes):
+    """ One index with the entries of each index in turn (all normalized, or none of them) """
+
+    merged = Index()
+    merged.columns = max(index.columns for index in indexes)
+    for name in indexes[0].column_names():
+        columns = [getattr(index, name) for index in indexes]
+        if isinstance(columns[0], array):
+            merged_column = array(columns[0].typecode)
+            for column in columns:
+                merged_column += column
         else:
-            alphabet_entries[current_letter] += 1
+            merged_column = list(itertools.chain.from_iterable(columns))
+        setattr(merged, name, merged_column)
+    return merged
 
-    return book_entries, alphabet_entries
+def load_files(file_names, tsv=False, jobs=None, cache=True, collation=None):
+    """ Loads every input file (in parallel across jobs processes, default one per CPU) and merges them into one sorted index
+        ordered by collation (default DEFAULT_COLLATION)
 
-def create_report(index, tsv):
-    """ Ouputs a report with information about the number of entries """
+        Unchanged inputs are loaded from the compiled index cache (unless cache is False)
+        Returns (index, True if any file was read as a TSV file) """
 
-    # Get data
-    book_entries, alphabet_entries = report_count(index)
-    
-    output = "<html><body><h1>Index Summary</h1>"
-    # Type of Input
-    if tsv:
-        output += f"<b>The input was a TSV file with {index.columns} columns.</b>"
+    if cache:
+        with profile_stage('cache_load') as metrics:
+            key = cache_key(file_names, tsv, collation)
+            cached = load_cache(key)
+            metrics['entries'] = cached[0].count if cached else 0
+        if cached:
+            # The same warnings as when the files were read
+            print(cached[2], end='')
+            print(f"Loaded {cached[0].count} entries from cache")
+            return cached[:2]
+
+    jobs = jobs or os.cpu_count() or 1
+    if len(file_names) == 1 or jobs == 1:
+        results = [load_index(file_name, tsv, collation) for file_name in file_names]
     else:
-        output += f"<b>The input was a MD file with {index.columns} columns.</b>"
-    # Total Length
-    output += f"<p>Total Length: {index.count} entries</p>"
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(load_index, file_names, itertools.repeat(tsv), itertools.repeat(collation)))
 
-    # Per Book Entries
-    output += "<h3>Entries per Book Number</h3>"
-    ## Must print sorted book entries
-    for book in sorted(book_entries.keys()):
-        output += f"<b>Book {book}</b> --- {book_entries[book]}<br>"
+    # An empty index means the file couldn't be loaded (error already printed)
+    indexes = [index for index, _, _ in results if index.count > 0]
+    tsv = any(file_tsv for _, file_tsv, _ in results)
+    if not indexes:
+        return Index(), tsv
+    if len(file_names) > 1:
+        print(f"Merging {len(indexes)} input files")
+    with profile_stage('merge') as metrics:
+        index = merge_indexes(indexes)
+        metrics['entries'] = index.count
 
-    # Per Letter Entries
-    output += "<h3>Entries per Letter</h3>"
-    for letter, value in alphabet_entries.items():
-        output += f"<b>{letter}</b> --- {value}<br>"
+    if cache:
+        with profile_stage('cache_save') as metrics:
+            try:
+                save_cache(index, tsv, key, ''.join(messages for _, _, messages in results))
+            except OSError as error:
+                print(f"Warning: Could not write to the cache ({error})")
+            metrics['entries'] = index.count
+    return index, tsv
 
-    output += "</body></html>"
 
+### Compiled Index Cache
 
-    # Write the file
-    write_file(output, "report.html")
+# Bump whenever parsing/normalizing changes, older cache files are then ignored
+CACHE_VERSION = 4
+CACHE_MAGIC = b'GIACIDX'
+CACHE_HEADER = struct.Struct('<7sBIIQ') # magic, version, columns, tsv, count
+CACHE_DIR = os.environ.get('GIAC_INDEXER_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'giac-indexer'))
+# Least recently used cache files are removed once the directory grows past this
+CACHE_MAX_BYTES = 256 * 1024 * 1024
 
-### Functions for HTML Output
+def cache_key(file_names, tsv, collation=None):
+    """ Hash of the contents of the input files (in order) plus anything else that changes the parsed index """
 
-def format_to_html(text):
-    """ Replaces markdown formatting and special chars with html equivalents """
+    import hashlib
 
-    # First escape angle brackets
-    text = text.replace('<', '&lt;')
-    text = text.replace('>', '&gt;')
-    # Add in line breaks -- catching escaped ones
-    text = text.replace('\\\\n', '!NEWLINE!')
-    text = text.replace('\\n', '<br>')
-    text = text.replace('!NEWLINE!', '\\n')
-
-    #Color characters
-    while ';;' in text:
-        tag_index = text.index(";;") + 2
-        tag_stop_index = text.index(" ", tag_index)
-        color = text[tag_index:tag_stop_index]
-        
-        text = text.replace(";;"+color, f"<span style=\"color:{color}\">", 1)
-        text = text.replace(";;", "</span>", 1)
+    digest = hashlib.sha256(f"{CACHE_VERSION} {tsv} {sys.byteorder} {collation or DEFAULT_COLLATION!r}".encode())
+    for file_name in file_names:
+        # The same contents are read differently as a .csv file
+        digest.update(b'table\0' if is_table_file(file_name) else b'text\0')
+        with open(file_name, 'rb') as fo:
+            for chunk in iter(lambda: fo.read(1 << 20), b''):
+                digest.update(chunk)
+        digest.update(b'\0') # File boundary
+    return digest.hexdigest()
 
-    # Bold
-    while '**' in text:
-        text = text.replace("**", "<span class=\"bold\">", 1)
-        text = text.replace("**", "</span>", 1)
-        
-    # Italic while saving '*' characters
-    if not text.count('*') == 1: # Single asterisk? Might be in tsv file or not escaped
-        if '\*' in text:
-            text = text.replace('\*', "!AST!")
-        while '*' in text:
-            text = text.replace("*", "<span class=\"italic\">", 1)
-            text = text.replace("*", "</span>", 1)
-        if '!AST!' in text:
-            text = text.replace('!AST!', '*')
-            
-    return text
+def save_cache(index, tsv, key, messages='', cache_dir=CACHE_DIR):
+    """ Writes the (normalized, sorted) index to the cache as a header followed by one block per column,
+        then the messages printed while reading the input files """
 
-def create_html_head():
-    """ Creates start of html file """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, key + '.idx')
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as fo:
+        fo.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, index.columns, tsv, index.count))
+        for name in index.column_names():
+            column = getattr(index, name)
+            if isinstance(column, array):
+                block = column.tobytes()
+            elif name == 'sort_keys':
+                # Binary keys can contain \0, so the lengths come first
+                block = array('Q', map(len, column)).tobytes() + b''.join(column)
+            else:
+                block = '\0'.join(column).encode('utf-8', 'surrogatepass')
+            fo.write(struct.pack('<Q', len(block)))
+            fo.write(block)
+        block = messages.encode('utf-8', 'surrogatepass')
+        fo.write(struct.pack('<Q', len(block)))
+        fo.write(block)
+    # Readers never see a half written file
+    os.replace(temp_path, path)
+    prune_cache(cache_dir)
 
-    html = """<html><body><table>
-                <head>
-                <style>
+def load_cache(key, cache_dir=CACHE_DIR):
+    """ Returns (index, tsv, messages) from the cache, or None if it isn't cached (or the cache file is unusable) """
 
-                :root {
-                    --border-radius: 5px;
-                    --box-shadow: 2px 2px 10px;
-                    --font-family: Calibri, -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, Oxygen-Sans, Ubuntu, Cantarell, "Helvetica Neue", sans-serif;
-                    --justify-normal: left;
-                    --line-height: 1.5;
-                }
+    import mmap
 
-                body {
-                    background: var(--color-bg);
-                    color: var(--color-text);
-                    font-family: var(--font-family);
-                    line-height: var(--line-height);
-                    margin: 0;
-                    padding: 0;
-                }
+    path = os.path.join(cache_dir, key + '.idx')
+    try:
+        with open(path, 'rb') as fo, mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            magic, version, columns, tsv, count = CACHE_HEADER.unpack_from(buffer)
+            if magic != CACHE_MAGIC or version != CACHE_VERSION:
+                raise ValueError("Old or unknown cache file")
 
-                .bold {
-                    font-weight: bold;
-                }
-                .italic {
-                    font-style: italic;
-                }
-                """
-    return html
+            index = Index()
+            index.columns = columns
+            offset = CACHE_HEADER.size
+            # Same columns (in the same order) as save_cache wrote, always normalized
+            for name in ['keywords', 'locations', 'comments', 'packed_locations', 'sort_keys', 'letters', 'plain_keywords']:
+                (length,) = struct.unpack_from('<Q', buffer, offset)
+                offset += 8
+                block = buffer[offset:offset + length]
+                offset += length
+                if name == 'packed_locations':
+                    column = array('Q')
+                    column.frombytes(block)
+                elif name == 'sort_keys':
+                    lengths = array('Q')
+                    lengths.frombytes(block[:8 * count])
+                    ends = list(itertools.accumulate(lengths, initial=8 * count))
+                    column = list(map(block.__getitem__, map(slice, ends, ends[1:])))
+                elif count:
+                    column = block.decode('utf-8', 'surrogatepass').split('\0')
+                else:
+                    column = []
+                if len(column) != count:
+                    raise ValueError("Cache file doesn't match its header")
+                setattr(index, name, column)
+            (length,) = struct.unpack_from('<Q', buffer, offset)
+            offset += 8
+            messages = buffer[offset:offset + length].decode('utf-8', 'surrogatepass')
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, struct.error) as error:
+        print(f"Warning: Ignoring unreadable cache file {path} ({error})")
+        # Read only or already removed by another run, either way the files are read again
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
 
-def add_print_css(columns):
-    """ Adds the proper stylesheet depending on the number of columns """
+    index.locations = [sys.intern(location) for location in index.locations]
+    index.letters = [sys.intern(letter) for letter in index.letters]
+    # Mark as recently used for prune_cache()
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return index, bool(tsv), messages
 
-    print_css = ""
+def prune_cache(cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+    """ Removes the least recently used cache files until the cache fits in max_bytes """
 
-    if columns == 3:
-        print_css += """             
-                @media print {
-                    @page {
-                      margin: 1.5cm;   
-                    }
-                    section.table > div:nth-of-type(odd) {
-                        background: #e0e0e0;
-                    }
-                    .table {
-                        page-break-after: always;
-                        width:20cm;
-                    }
-                    div.row > div {
-                      display: inline-block;  
-                      overflow-x: auto;
-                      padding: 0;
-                      vertical-align: top;
-                    }
-                    div.row {
-                      display: block;
-                    }
-                    h1 {
-                        margin-left: 10em;
-                    }
-                    .thead {
-                        text-align: center;
-                        font-weight: bold;
-                        }
-                    .keyword {
-                        width: 30%;
-                        margin-left: 0.1cm;
-                        /*margin: 0.1cm; /* Can be removed, good for readability when using colour output */
-                    }
-                    .location {
-                        width: 10%;
-                        text-align: center;
-                    }
-                    .comment {
-                        width:50%;
-                        margin-left: 0.5cm;
-                    }
-                }
-                """
+    cache_files = []
+    for file_name in os.listdir(cache_dir):
+        if file_name.endswith('.idx'):
+            path = os.path.join(cache_dir, file_name)
+            stat = os.stat(path)
+            cache_files.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in cache_files)
+    for _, size, path in sorted(cache_files):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+
+
+### Out of Core Sorting
+# With --max-memory the whole index is never in memory: the input is parsed a chunk at a time, each run of chunks
+# is normalized, sorted and written to a temporary file, then the runs are merged block by block straight into the output
+
+MEMORY_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+# Rough memory used by an entry (plus its text times RUN_TEXT_FACTOR) while its run is sorted and written out
+RUN_ENTRY_BYTES = 1024
+RUN_TEXT_FACTOR = 4
+# Memory kept aside for Python itself and for merging the runs
+RUN_RESERVED_BYTES = 24 << 20
+# Entries per block of merged entries, and per block of a run file (one of these per run is in memory while merging)
+RUN_BLOCK_ENTRIES = 1 << 12
+RUN_FILE_BLOCK_ENTRIES = 1 << 8
+# Markdown text parsed at a time
+MARKDOWN_CHUNK_BYTES = 1 << 20
+
+def parse_size(text):
+    """ Bytes in a size like 200M, 1.5G, 512K or 1000000, None if it isn't one """
+
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([KMG]?)B?', text.strip().upper())
+    if match is None:
+        return None
+    return int(float(match[1]) * MEMORY_UNITS[match[2]])
+
+def iter_input_chunks(file_names, tsv=False, chunk_bytes=MARKDOWN_CHUNK_BYTES):
+    """ Generates (Index, True if it was read as a TSV file) for a chunk of the input files at a time, in order """
+
+    for file_name in file_names:
+        file_tsv = tsv or is_table_file(file_name)
+        if not file_tsv:
+            chunks = iter_markdown_chunks(file_name, chunk_bytes)
+            try:
+                # A TSV file is spotted in the first chunk
+                first = next(chunks, None)
+            except ValueError:
+                file_tsv = True
+                print(f"Warning: -t TSV flag not used but {file_name} appears to be TSV file")
+            else:
+                for chunk in itertools.chain([first] if first else [], chunks):
+                    yield chunk, False
+        if file_tsv:
+            for columns, keywords, locations, comments in iter_tsv_chunks(file_name):
+                chunk = Index()
+                chunk.columns = columns
+                chunk.extend(keywords, locations, comments)
+                yield chunk, True
+
+def run_memory(index):
+    """ Estimated memory needed to sort index as a run """
+
+    text = sum(map(len, index.keywords)) + sum(map(len, index.comments))
+    return RUN_ENTRY_BYTES * index.count + RUN_TEXT_FACTOR * text
+
+def iter_run(fo):
+    """ Generates the entries of a run file as (sort key, keyword, location, comment, letter, packed location) """
+
+    import pickle
+
+    fo.seek(0)
+    while True:
+        try:
+            block = pickle.load(fo)
+        except EOFError:
+            return
+        yield from zip(*block)
+
+class SortedRuns():
+    """ An index too big for memory, as sorted runs in temporary files (see sort_runs) """
+
+    def __init__(self):
+        self.files = []
+        self.columns = 0
+        self.tsv = False
+        self.count = 0
+
+    def add(self, run):
+        """ Sorts a normalized index and writes it as a new run, a block of entries at a time """
+
+        import pickle
+        import tempfile
+
+        run.sort()
+        fo = tempfile.TemporaryFile()
+        for start in range(0, run.count, RUN_FILE_BLOCK_ENTRIES):
+            stop = start + RUN_FILE_BLOCK_ENTRIES
+            block = (run.sort_keys[start:stop], run.keywords[start:stop], run.locations[start:stop],
+                     run.comments[start:stop], run.letters[start:stop], run.packed_locations[start:stop].tolist())
+            pickle.dump(block, fo, pickle.HIGHEST_PROTOCOL)
+        self.files.append(fo)
+        self.columns = max(self.columns, run.columns)
+        self.count += run.count
+
+    def blocks(self):
+        """ Merges the runs, generates Index blocks of RUN_BLOCK_ENTRIES entries in sorted order
+
+            Runs are in input order and merge() is stable, so the order is the same as sorting everything in memory """
+
+        import heapq
+
+        merged = heapq.merge(*map(iter_run, self.files), key=operator.itemgetter(0))
+        for entries in iter(lambda: list(itertools.islice(merged, RUN_BLOCK_ENTRIES)), []):
+            block = Index()
+            block.columns = self.columns
+            block.sort_keys, block.keywords, block.locations, block.comments, block.letters, packed = map(list, zip(*entries))
+            block.packed_locations = array('Q', packed)
+            yield block
+
+    def close(self):
+        for fo in self.files:
+            fo.close()
+        self.files = []
+
+def sort_runs(file_names, tsv=False, max_memory=200 << 20, collation=None):
+    """ Parses and sorts the input files into a SortedRuns, using about max_memory bytes """
+
+    runs = SortedRuns()
+    budget = max(max_memory - RUN_RESERVED_BYTES, max_memory // 4)
+    chunks = []
+    used = 0
+    for chunk, chunk_tsv in iter_input_chunks(file_names, tsv, min(MARKDOWN_CHUNK_BYTES, budget // (4 * RUN_TEXT_FACTOR))):
+        runs.tsv = runs.tsv or chunk_tsv
+        chunk.normalize(collation)
+        chunks.append(chunk)
+        used += run_memory(chunk)
+        if used >= budget:
+            runs.add(concat_indexes(chunks))
+            chunks = []
+            used = 0
+    if chunks:
+        runs.add(concat_indexes(chunks))
+    print(f"Sorted {runs.count} entries in {len(runs.files)} runs")
+    return runs
+
+def write_merged_outputs(runs, outputs, book_colours, page_breaks=False):
+    """ write_outputs() for sorted runs: the sections (which can span blocks) go to the outputs as the runs are merged """
+
+    columns = runs.columns
+    headings = SectionHeadings(columns, page_breaks)
+    previous = None
+    stages, rendering = output_stages(outputs)
+    for output, stage in stages:
+        with stage.timing():
+            output.start()
+    for block in runs.blocks():
+        letters = block.letters
+        with rendering.timing():
+            rows = list(map(create_html_row, block.keywords, block.locations, block.comments,
+                            itertools.repeat(columns), itertools.repeat(book_colours)))
+        # The block starts with the rest of the previous block's section (unless a section starts right there)
+        starts = [0]
+        block_headings = ['']
+        for position in letter_changes(letters, previous):
+            heading = headings.heading(letters[position])
+            if heading is None:
+                continue
+            if position == 0:
+                block_headings[0] = heading
+            else:
+                starts.append(position)
+                block_headings.append(heading)
+        previous = letters[-1]
+        for heading, start, stop in zip(block_headings, starts, starts[1:] + [block.count]):
+            for output, stage in stages:
+                with stage.timing():
+                    output.section(block, heading, start, stop, rows[start:stop])
+    finish_outputs(stages, rendering, runs.count)
+
+
+### Generic Code
+
+def duplicate_key(keyword):
+    """ Keyword as compared for duplicates: no markup, lower case, single spaces """
+
+    return ' '.join(keyword.lower().split())
+
+def duplicate_groups(index):
+    """ Groups the entries sharing a keyword (ignoring markup, case and spacing)
+
+        Returns a list of position lists (2 or more each), in index order """
+
+    groups = {}
+    for position, keyword in enumerate(index.plain_keywords):
+        groups.setdefault(duplicate_key(keyword), []).append(position)
+    return [positions for key, positions in groups.items() if len(positions) > 1 and key]
+
+def find_duplicates(index, groups=None):
+    """ Find entries with a duplicate keyword (great to find terms in need of more context) """
+
+    if groups is None:
+        groups = duplicate_groups(index)
+    return index.subset(list(itertools.chain.from_iterable(groups)))
+
+def print_duplicate_summary(index, groups, top=10):
+    """ Prints how many keywords are duplicated, and the locations of the most duplicated ones """
+
+    entries = sum(len(positions) for positions in groups)
+    print(f"Found {len(groups)} duplicate keywords ({entries} entries)")
+    for positions in sorted(groups, key=len, reverse=True)[:top]:
+        locations = ', '.join(index.locations[position] for position in positions)
+        print(f"{len(positions):>5} x {index.plain_keywords[positions[0]]}: {locations}")
+
+# Distinct keywords are compared with the next NEAR_WINDOW keywords in sorted order, and again
+# sorted by their last letters (so a typo at either end still lands nearby)
+NEAR_WINDOW = 8
+NEAR_SIMILARITY = 0.8
+
+def edit_distance(a, b, limit):
+    """ Levenshtein distance between a and b, or limit + 1 once it's known to be over limit """
+
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    # Each edit adds or removes at most two letters from the set of letters used
+    if len(set(a).symmetric_difference(b)) > 2 * limit:
+        return limit + 1
+
+    # A shared start or end doesn't change the distance
+    start = len(os.path.commonprefix((a, b)))
+    a = a[start:]
+    b = b[start:]
+    end = len(os.path.commonprefix((a[::-1], b[::-1])))
+    if end:
+        a = a[:-end]
+        b = b[:-end]
+    if not a or not b:
+        return len(a) + len(b)
+
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+def keyword_similarity(a, b, threshold=0.0):
+    """ Similarity (0 to 1) of two duplicate keys, the best of shared words and edit distance
+
+        The edit distance is only worked out as far as needed to reach threshold """
+
+    words_a = set(a.split())
+    words_b = set(b.split())
+    similarity = len(words_a & words_b) / len(words_a | words_b)
+    if threshold and similarity >= threshold:
+        return similarity
+    longest = max(len(a), len(b))
+    limit = int(longest * (1 - threshold) + 1e-9)
+    return max(similarity, 1 - edit_distance(a, b, limit) / longest)
+
+def near_duplicate_groups(index, threshold=NEAR_SIMILARITY):
+    """ Groups entries whose keywords are similar but not identical (typos, reordered words)
+
+        Only likely pairs are compared (blocking): keywords with the same set of words,
+        and neighbours in two sort orders, so this stays close to linear on big indexes.
+        Returns a list of position lists, each with at least two different keywords """
+
+    # One candidate per distinct keyword, in index order
+    keys = {}
+    for position, keyword in enumerate(index.plain_keywords):
+        key = duplicate_key(keyword)
+        if key:
+            keys.setdefault(key, []).append(position)
+    key_list = list(keys)
+
+    # Union-find over the distinct keywords
+    parent = list(range(len(key_list)))
+    def find(key_id):
+        while parent[key_id] != key_id:
+            parent[key_id] = parent[parent[key_id]]
+            key_id = parent[key_id]
+        return key_id
+    def union(key_a, key_b):
+        root_a = find(key_a)
+        root_b = find(key_b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    # Same words in another order
+    word_sets = {}
+    for key_id, key in enumerate(key_list):
+        word_sets.setdefault(' '.join(sorted(set(key.split()))), []).append(key_id)
+    for members in word_sets.values():
+        for key_id in members[1:]:
+            union(members[0], key_id)
+
+    # Typos and small changes
+    orders = (sorted(range(len(key_list)), key=key_list.__getitem__),
+              sorted(range(len(key_list)), key=lambda key_id: key_list[key_id][::-1]))
+    for order in orders:
+        for i, key_a in enumerate(order):
+            for key_b in order[i + 1:i + 1 + NEAR_WINDOW]:
+                if find(key_a) != find(key_b) and keyword_similarity(key_list[key_a], key_list[key_b], threshold) >= threshold:
+                    union(key_a, key_b)
+
+    groups = {}
+    for key_id in range(len(key_list)):
+        groups.setdefault(find(key_id), []).append(key_id)
+    return [list(itertools.chain.from_iterable(keys[key_list[key_id]] for key_id in members))
+            for members in groups.values() if len(members) > 1]
+
+### Search
+
+# Words of the keywords and comments for prefix terms (nm*), the same as the embedded search's (see EMBED_WORD_RE)
+SEARCH_WORD_RE = re.compile(r'\w+')
+
+def build_trigrams(texts):
+    """ Maps every 3 character substring to the (ascending) positions of the texts containing it """
+
+    trigrams = {}
+    for position, text in enumerate(texts):
+        for trigram in {text[i:i + 3] for i in range(len(text) - 2)}:
+            postings = trigrams.get(trigram)
+            if postings is None:
+                postings = trigrams[trigram] = array('I')
+            postings.append(position)
+    return trigrams
+
+def build_words(texts):
+    """ The distinct words of the texts in sorted order, and for each the (ascending) positions of the texts with it """
+
+    word_positions = {}
+    for position, text in enumerate(texts):
+        for word in set(SEARCH_WORD_RE.findall(text)):
+            positions = word_positions.get(word)
+            if positions is None:
+                positions = word_positions[word] = array('I')
+            positions.append(position)
+    words = sorted(word_positions)
+    return words, [word_positions[word] for word in words]
+
+class SearchIndex():
+    """ Inverted (trigram) index over the keywords and comments of an Index, built once and then queried many times
+
+        Text is matched lower case with the markdown/colour formatting removed """
+
+    FIELDS = ('keyword', 'comment')
+
+    def __init__(self, index):
+        """ Prepares the text of each field, the postings of a field are built the first time it is searched """
+
+        self.index = index
+        self.texts = {
+            'keyword': [keyword.lower() for keyword in index.plain_keywords],
+            'comment': [strip_formatting(comment).lower() for comment in index.comments],
+        }
+        self.trigrams = {}
+        # Built on the first query shorter than a trigram: (trigram postings by their first 1 and 2 characters,
+        # positions by the last 2 characters of their text), then the postings of each short term queried
+        self.short_parts = {}
+        self.short_postings = {}
+        # The distinct words in sorted order and the positions of the texts with each, built with the trigrams
+        self.sorted_words = {}
+        # Built on the first ranked keyword search: the texts in sorted order and their positions
+        self.sorted_texts = {}
+
+    def build(self, fields=FIELDS):
+        """ Builds the trigrams and words for fields now rather than on their first search """
+
+        for field in fields:
+            if field not in self.trigrams:
+                self.trigrams[field] = build_trigrams(self.texts[field])
+                self.sorted_words[field] = build_words(self.texts[field])
+
+    def find_short(self, term, field):
+        """ Returns the ascending positions whose field contains term (1 or 2 characters)
+
+            A text contains term if one of its trigrams starts with it, or its last 2 characters contain it,
+            so the postings are the union of those (worked out once per term) """
+
+        postings = self.short_postings.get((field, term))
+        if postings is not None:
+            return postings
+
+        if field not in self.short_parts:
+            self.build((field,))
+            by_start = {}
+            for trigram, trigram_postings in self.trigrams[field].items():
+                by_start.setdefault(trigram[0], []).append(trigram_postings)
+                by_start.setdefault(trigram[:2], []).append(trigram_postings)
+            by_end = {}
+            for position, text in enumerate(self.texts[field]):
+                end_postings = by_end.get(text[-2:])
+                if end_postings is None:
+                    end_postings = by_end[text[-2:]] = array('I')
+                end_postings.append(position)
+            self.short_parts[field] = (by_start, by_end)
+        by_start, by_end = self.short_parts[field]
+
+        parts = by_start.get(term, []) + [end_postings for end, end_postings in by_end.items() if term in end]
+        postings = self.short_postings[(field, term)] = array('I', sorted(set().union(*parts)))
+        return postings
+
+    def find(self, term, field):
+        """ Returns the set of positions whose field contains term """
+
+        # Too short for a trigram
+        if len(term) < 3:
+            return set(self.find_short(term, field))
+
+        self.build((field,))
+        texts = self.texts[field]
+        trigrams = self.trigrams[field]
+        if len(term) == 3:
+            return set(trigrams.get(term, ()))
+        postings = []
+        for i in range(len(term) - 2):
+            trigram_postings = trigrams.get(term[i:i + 3])
+            if trigram_postings is None:
+                return set()
+            postings.append(trigram_postings)
+        postings.sort(key=len)
+
+        # Only entries with the rarest trigram can match, check their text (map/compress keep the loop in C)
+        candidates = postings[0]
+        found = map(operator.contains, map(texts.__getitem__, candidates), itertools.repeat(term))
+        return set(itertools.compress(candidates, found))
+
+    def find_prefix(self, term, field):
+        """ Returns the set of positions whose field has a word starting with term """
+
+        # A term with punctuation in it isn't part of one word, look for it after a word break instead
+        if not SEARCH_WORD_RE.fullmatch(term):
+            at_word_start = re.compile(r'(?<!\w)' + re.escape(term)).search
+            texts = self.texts[field]
+            return {position for position in self.find(term, field) if at_word_start(texts[position])}
+
+        self.build((field,))
+        words, positions = self.sorted_words[field]
+
+        # Every word starting with term sorts between term and term followed by the highest character
+        start = bisect.bisect_left(words, term)
+        stop = bisect.bisect_left(words, term + chr(sys.maxunicode), start)
+        return set().union(*positions[start:stop])
+
+    def find_start(self, term, field):
+        """ Returns the set of positions whose field starts with term """
+
+        if field not in self.sorted_texts:
+            texts = self.texts[field]
+            order = sorted(range(len(texts)), key=texts.__getitem__)
+            self.sorted_texts[field] = ([texts[i] for i in order], order)
+        sorted_texts, order = self.sorted_texts[field]
+
+        # Every text starting with term sorts between term and term followed by the highest character
+        start = bisect.bisect_left(sorted_texts, term)
+        stop = bisect.bisect_left(sorted_texts, term + chr(sys.maxunicode), start)
+        return set(order[start:stop])
+
+    def search(self, query, fields=FIELDS, limit=None):
+        """ Returns the positions of the entries matching every term of the query, best matches first
+
+            A term ending in * only matches words starting with it (e.g. nm*)
+            Entries matching in the keyword rank before those only matching in the comment """
+
+        terms = query.lower().split()
+        if not terms:
+            return []
+
+        # matches[field][i] = positions where field matches term i
+        matches = {}
+        for field in fields:
+            matches[field] = []
+            for term in terms:
+                if term.endswith('*') and len(term) > 1:
+                    matches[field].append(self.find_prefix(term[:-1], field))
+                else:
+                    matches[field].append(self.find(term, field))
+
+        # Every term has to match (in any of the fields)
+        results = None
+        for i in range(len(terms)):
+            term_matches = set().union(*[matches[field][i] for field in fields])
+            results = term_matches if results is None else results & term_matches
+
+        # Rank: keyword starts with the first term, keyword contains every term, then the rest
+        # (each in index order)
+        if 'keyword' in fields:
+            in_keyword = set.intersection(*matches['keyword'])
+            first_term = terms[0].rstrip('*')
+            starts_with = self.find_start(first_term, 'keyword') & in_keyword
+            ranks = [starts_with, in_keyword - starts_with, results - in_keyword]
+        else:
+            ranks = [results]
+
+        ranked = []
+        for positions in ranks:
+            ranked += sorted(positions)
+            if limit is not None and len(ranked) >= limit:
+                return ranked[:limit]
+        return ranked
+
+    def search_entries(self, query, fields=FIELDS, limit=None):
+        """ Same as search() but returns Entry views (entry.keyword, entry.location etc.) """
+
+        return [Entry(self.index, position) for position in self.search(query, fields, limit)]
+
+def parse_fields(option_input):
+    """ Turns k(eyword), c(omment) or b(oth) into the fields to search, None if it's none of those """
+
+    # Just test first 3 chars, should work even with some minor typos
+    option_input = option_input.strip().lower()
+    if option_input == "k" or option_input[:3] == "key":
+        return ('keyword',)
+    elif option_input == "c" or option_input[:3] == "com":
+        return ('comment',)
+    elif option_input == "b" or option_input[:3] == "bot":
+        return ('keyword', 'comment')
+    return None
+
+def print_search_results(index, entries):
+    """ Prints search results to the terminal """
+
+    for entry in entries:
+        if index.columns == 3:
+            print(f"{entry.keyword} - [{entry.location}] - {entry.comment}")
+        else:
+            print(f"{entry.location} \t- {entry.keyword}")
+
+def search_index(index, fields=None, limit=None):
+    """ Interactive search shell, keeps the index (and its search index) loaded between queries
+
+        Lines starting with : are commands, see :help """
+
+    try:
+        import readline # Up/down arrow history and line editing for input(), where available
+    except ImportError:
+        pass
+
+    search = SearchIndex(index)
+    if fields is None:
+        fields = ('keyword', 'comment') if index.columns == 3 else ('keyword',)
+    history = []
+    print("Type a search (several words must all match, end a word with * to match the start), :help for commands, :quit to exit")
+
+    while True:
+        try:
+            query = input("Search term: ").strip()
+        except EOFError:
+            print()
+            break
+        if not query:
+            continue
+        history.append(query)
+
+        if query.startswith(':'):
+            command, _, value = query[1:].partition(' ')
+            if command in ('q', 'quit', 'exit'):
+                break
+            elif command == 'field':
+                new_fields = parse_fields(value)
+                if new_fields is None:
+                    print("Search **K**eyword, **C**omment, or **B**oth e.g. :field k")
+                else:
+                    fields = new_fields
+                    print(f"Searching {' and '.join(fields)}")
+            elif command == 'limit':
+                if value.strip().isdigit():
+                    limit = int(value) or None
+                elif value.strip() in ('', 'none'):
+                    limit = None
+                else:
+                    print("Limit must be a number (0 or none for no limit)")
+                    continue
+                print(f"Showing {limit or 'all'} results")
+            elif command == 'history':
+                for number, previous in enumerate(history[:-1], 1):
+                    print(f"{number}\t{previous}")
+            else:
+                print(":field k|c|b\tSearch the keyword, comment or both")
+                print(":limit n\tOnly show the first n results (0 for all)")
+                print(":history\tShow previous searches")
+                print(":quit\t\tExit")
+            continue
+
+        entries = search.search_entries(query, fields, limit)
+        print_search_results(index, entries)
+        print(f"-- {len(entries)} result{'' if len(entries) == 1 else 's'}")
+
+def results_to_json(index, positions):
+    """ Search results as a list of {"Keyword": ..., "Location": ..., "Comment": ...} """
+
+    return [{"Keyword": index.keywords[position], "Location": index.locations[position], "Comment": index.comments[position]}
+            for position in positions]
+
+def search_batch(index, queries, output_format='tsv', fields=None, limit=None, output=None):
+    """ Runs every query (one per line) against the index and writes the results as TSV or JSON lines
+
+        TSV: query, keyword, location, comment per result
+        JSON: {"query": ..., "results": [{"Keyword": ..., "Location": ..., "Comment": ...}]} per query """
+
+    import json
+
+    search = SearchIndex(index)
+    if fields is None:
+        fields = ('keyword', 'comment') if index.columns == 3 else ('keyword',)
+    if output is None:
+        output = sys.stdout
+    # TSV output has to stay one line per result
+    clean = str.maketrans('\t\n', '  ')
+
+    for query in queries:
+        query = query.strip()
+        if not query:
+            continue
+        positions = search.search(query, fields, limit)
+        if output_format == 'json':
+            output.write(json.dumps({"query": query, "results": results_to_json(index, positions)}) + "\n")
+        else:
+            for position in positions:
+                output.write(f"{query.translate(clean)}\t{index.keywords[position].translate(clean)}\t"
+                             f"{index.locations[position]}\t{index.comments[position].translate(clean)}\n")
+
+### Location Queries
+
+# Locations as written in queries: a page (2.40), a range of pages (2.40-75 or 2.40-3.10), a book (3) or books (2-3)
+LOCATION_RANGE_RE = re.compile(r'(\d+)(?:\.(\d+))?(?:-(?:(\d+)\.)?(\d+))?')
+
+def parse_location_range(text):
+    """ ((book, page), (book, page)) for the first and last locations of a location query, None if it isn't one
+
+        page is None for a whole book (the query was just a book number) """
+
+    match = LOCATION_RANGE_RE.fullmatch(text.strip())
+    if match is None:
+        return None
+    book, page, end_book, end = match.groups()
+    book = int(book)
+    if page is None:
+        # Books, there can't be a page in the end
+        if end_book is not None:
+            return None
+        first, last = (book, None), (int(end) if end else book, None)
+    else:
+        first = (book, int(page))
+        last = (int(end_book) if end_book else book, int(end)) if end else first
+    if (last[0], last[1] if last[1] is not None else PAGE_MASK) < (first[0], first[1] or 0):
+        return None
+    return first, last
+
+class LocationIndex():
+    """ Reverse index from locations to entries, built once from the packed locations of an Index
+
+        The distinct locations are kept sorted (book then page) so pages, ranges and gaps are found with bisect """
+
+    def __init__(self, index):
+        self.index = index
+        packed = index.packed_locations
+        # Stable, so the entries of a location stay in index order
+        order = sorted(range(index.count), key=packed.__getitem__)
+        sorted_packed = list(map(packed.__getitem__, order))
+        starts = [0, *itertools.compress(range(1, len(order)), map(operator.ne, sorted_packed, itertools.islice(sorted_packed, 1, None)))]
+        if not order:
+            starts = []
+        self.order = array('I', order)
+        # The entries at locations[i] are order[starts[i]:starts[i + 1]]
+        self.locations = array('Q', map(sorted_packed.__getitem__, starts))
+        starts.append(len(order))
+        self.starts = array('I', starts)
+
+    def span(self, first, last):
+        """ (i, j) such that locations[i:j] are the locations from first to last (packed, both included) """
+
+        i = bisect.bisect_left(self.locations, first)
+        return i, bisect.bisect_right(self.locations, last, i)
+
+    def positions(self, first, last):
+        """ Positions of the entries from location first to last (packed, both included), in location order """
+
+        i, j = self.span(first, last)
+        return self.order[self.starts[i]:self.starts[j]].tolist()
+
+    def count(self, first, last):
+        """ Number of entries from location first to last (packed, both included) """
+
+        i, j = self.span(first, last)
+        return self.starts[j] - self.starts[i]
+
+    def page(self, book, page):
+        """ Positions of the entries on one page """
+
+        location = (book << PAGE_BITS) | page
+        return self.positions(location, location)
+
+    def books(self):
+        """ The books with entries, in order (book 0 holds the locations that aren't book.page) """
+
+        books = []
+        i = 0
+        while i < len(self.locations):
+            book = self.locations[i] >> PAGE_BITS
+            books.append(book)
+            i = bisect.bisect_left(self.locations, (book + 1) << PAGE_BITS, i)
+        return books
+
+    def pages(self, book, first_page=0, last_page=PAGE_MASK):
+        """ The pages of book (from first_page to last_page) with entries, in order """
+
+        i, j = self.span((book << PAGE_BITS) | first_page, (book << PAGE_BITS) | last_page)
+        return [location & PAGE_MASK for location in self.locations[i:j]]
+
+    def gaps(self, book, first_page=None, last_page=None):
+        """ [first, last] page ranges of book without entries, from first_page to last_page
+
+            Without first_page/last_page the gaps are between the first and last pages of the book with entries """
+
+        pages = self.pages(book, first_page or 0, PAGE_MASK if last_page is None else last_page)
+        if not pages and (first_page is None or last_page is None):
+            return []
+        previous = pages[0] - 1 if first_page is None else first_page - 1
+        gaps = []
+        for page in pages + [pages[-1] + 1 if last_page is None else last_page + 1]:
+            if page > previous + 1:
+                gaps.append([previous + 1, page - 1])
+            previous = page
+        return gaps
+
+    def query(self, text):
+        """ Positions of the entries at a location query (see parse_location_range), None if it isn't one """
+
+        bounds = parse_location_range(text)
+        if bounds is None:
+            return None
+        (book, page), (last_book, last_page) = bounds
+        return self.positions((book << PAGE_BITS) | (page or 0),
+                              (last_book << PAGE_BITS) | (PAGE_MASK if last_page is None else last_page))
+
+    def query_gaps(self, text=None):
+        """ {book: gaps} for a location query (every book with entries if text is None), None if it isn't one
+
+            The first and last books of a range are cut at its first and last pages """
+
+        if text is None:
+            return {book: self.gaps(book) for book in self.books() if book}
+        bounds = parse_location_range(text)
+        if bounds is None:
+            return None
+        (book, page), (last_book, last_page) = bounds
+        books = [present for present in self.books() if book <= present <= last_book]
+        # Books asked for by page are checked even without any entries
+        if page is not None and book not in books:
+            books.insert(0, book)
+        if last_page is not None and last_book not in books:
+            books.append(last_book)
+        return {present: self.gaps(present, page if present == book else None, last_page if present == last_book else None)
+                for present in books}
+
+def print_location_results(index, query, positions, output_format='tsv', output=None):
+    """ Writes the entries found by a location query as TSV (location, keyword, comment) or a JSON line """
+
+    import json
+
+    if output is None:
+        output = sys.stdout
+    if output_format == 'json':
+        output.write(json.dumps({"query": query, "results": results_to_json(index, positions)}) + "\n")
+        return
+    clean = str.maketrans('\t\n', '  ')
+    for position in positions:
+        output.write(f"{index.locations[position]}\t{index.keywords[position].translate(clean)}\t"
+                     f"{index.comments[position].translate(clean)}\n")
+
+def print_location_gaps(query, gaps, output_format='tsv', output=None):
+    """ Writes the pages without entries found by query_gaps(), one range (e.g. 3.12-15) per line or a JSON line """
+
+    import json
+
+    if output is None:
+        output = sys.stdout
+    if output_format == 'json':
+        output.write(json.dumps({"query": query, "gaps": gaps}) + "\n")
+        return
+    for book, book_gaps in gaps.items():
+        for first, last in book_gaps:
+            output.write(format_pages(book, first, last) + "\n")
+
+### Functions related to Creating a report
+
+# Pages per range in the entry density part of the report
+REPORT_PAGE_RANGE = 10
+REPORT_FORMATS = ('html', 'json', 'csv')
+
+def count_books(page_counts):
+    """ Entries per book from entries per (packed) location """
+
+    book_entries = {}
+    for packed_location, count in sorted(page_counts.items()):
+        book = packed_location >> PAGE_BITS
+        book_entries[book] = book_entries.get(book, 0) + count
+    return book_entries
+
+def count_letters(letters, alphabet_entries=None):
+    """ Adds the entries per letter of (sorted) letters to alphabet_entries (a new dict if None) and returns it
+
+        Letters are in order of first appearance, non alphabet chars all count as # """
+
+    if alphabet_entries is None:
+        alphabet_entries = {}
+    if not letters:
+        return alphabet_entries
+    # The index is sorted so letters come in runs, only look at where a new run starts
+    starts = letter_changes(letters)
+    starts.append(len(letters))
+    for start, stop in zip(starts, starts[1:]):
+        letter = letters[start]
+        if not letter.isalpha():
+            letter = "#"
+        alphabet_entries[letter] = alphabet_entries.get(letter, 0) + stop - start
+    return alphabet_entries
+
+def report_stats(index, tsv, page_range=REPORT_PAGE_RANGE):
+    """ Works out everything in the report, returns it as a dict (ready for JSON)
+
+        books/letters: entries per book/letter, pages: entries per page of each book,
+        gaps: page ranges without entries (between the first and last indexed page of a book),
+        density: entries per range of page_range pages, comments: comment length stats.
+        Book 0 holds the entries whose location isn't book.page """
+
+    return report_from_counts(index.count, index.columns, tsv, collections.Counter(index.packed_locations),
+                              count_letters(index.letters), collections.Counter(map(len, index.comments)), page_range)
+
+def report_from_counts(entries, columns, tsv, page_counts, alphabet_entries, comment_lengths, page_range=REPORT_PAGE_RANGE):
+    """ report_stats from the counts it is based on: entries per packed location, entries per letter
+        (see count_letters) and comments per length """
+
+    book_entries = count_books(page_counts)
+    pages = {}
+    for packed_location, count in sorted(page_counts.items()):
+        pages.setdefault(packed_location >> PAGE_BITS, {})[packed_location & PAGE_MASK] = count
+
+    gaps = {}
+    density = {}
+    for book, book_pages in pages.items():
+        if not book:
+            continue
+        book_gaps = []
+        previous = None
+        for page in book_pages:
+            if previous is not None and page > previous + 1:
+                book_gaps.append([previous + 1, page - 1])
+            previous = page
+        gaps[book] = book_gaps
+
+        ranges = {}
+        for page, count in book_pages.items():
+            first = (page - 1) // page_range * page_range + 1 if page else 0
+            ranges[first] = ranges.get(first, 0) + count
+        density[book] = [[first, first + page_range - 1, count] for first, count in ranges.items()]
+
+    # Comment lengths as a histogram, the stats are worked out from that
+    lengths = collections.Counter(comment_lengths)
+    with_comment = entries - lengths.pop(0, 0)
+    comments = {"with_comment": with_comment, "without_comment": entries - with_comment}
+    if with_comment:
+        lengths = sorted(lengths.items())
+        total = sum(length * count for length, count in lengths)
+        # Middle value(s) of the sorted lengths
+        low = None
+        seen = 0
+        for length, count in lengths:
+            seen += count
+            if low is None and seen > (with_comment - 1) // 2:
+                low = length
+            if seen > with_comment // 2:
+                high = length
+                break
+        comments.update({"min_length": lengths[0][0], "max_length": lengths[-1][0],
+                         "mean_length": round(total / with_comment, 1),
+                         "median_length": low if with_comment % 2 else (low + high) / 2})
+
+    return {"input": "TSV" if tsv else "MD", "columns": columns, "entries": entries,
+            "books": book_entries, "letters": alphabet_entries, "pages": pages,
+            "gaps": gaps, "density": density, "comments": comments}
+
+def format_pages(book, first, last):
+    """ book.first-last (or book.first for a single page) """
+
+    return f"{book}.{first}" if first == last else f"{book}.{first}-{last}"
+
+def iter_report_html(stats):
+    """ Generates the HTML report piece by piece """
+
+    yield "<html><body><h1>Index Summary</h1>"
+    # Type of Input
+    yield f"<b>The input was a {stats['input']} file with {stats['columns']} columns.</b>"
+    # Total Length
+    yield f"<p>Total Length: {stats['entries']} entries</p>"
+
+    # Per Book Entries
+    yield "<h3>Entries per Book Number</h3>"
+    for book, count in stats['books'].items():
+        yield f"<b>Book {book}</b> --- {count}<br>"
+
+    # Per Letter Entries
+    yield "<h3>Entries per Letter</h3>"
+    for letter, value in stats['letters'].items():
+        yield f"<b>{letter}</b> --- {value}<br>"
+
+    # Pages with no entries, and how the entries are spread out
+    yield "<h3>Pages without Entries</h3>"
+    for book, book_gaps in stats['gaps'].items():
+        listed = ', '.join(format_pages(book, first, last) for first, last in book_gaps) or "None"
+        yield f"<b>Book {book}</b> --- {listed}<br>"
+    yield "<h3>Entries per Page Range</h3>"
+    for book, ranges in stats['density'].items():
+        listed = ', '.join(f"{format_pages(book, first, last)}: {count}" for first, last, count in ranges)
+        yield f"<b>Book {book}</b> --- {listed}<br>"
+
+    # Comments
+    if stats['columns'] == 3:
+        yield "<h3>Comments</h3>"
+        for name, value in stats['comments'].items():
+            yield f"<b>{name.replace('_', ' ').capitalize()}</b> --- {value}<br>"
+
+    yield "</body></html>"
+
+def iter_report_csv(stats):
+    """ Generates the report as CSV rows: section, book/letter/statistic, page range, value """
+
+    yield ["section", "key", "pages", "value"]
+    for name in ("input", "columns", "entries"):
+        yield ["summary", name, "", stats[name]]
+    for book, count in stats['books'].items():
+        yield ["book", book, "", count]
+    for letter, count in stats['letters'].items():
+        yield ["letter", letter, "", count]
+    for book, book_pages in stats['pages'].items():
+        for page, count in book_pages.items():
+            yield ["page", book, page, count]
+    for book, book_gaps in stats['gaps'].items():
+        for first, last in book_gaps:
+            yield ["gap", book, f"{first}-{last}", last - first + 1]
+    for book, ranges in stats['density'].items():
+        for first, last, count in ranges:
+            yield ["density", book, f"{first}-{last}", count]
+    for name, value in stats['comments'].items():
+        yield ["comments", name, "", value]
+
+def create_report(index, tsv, formats=('html',), file_name="report"):
+    """ Ouputs a report with information about the entries, as report.html/.json/.csv (file_name without the extension) """
+
+    write_report(report_stats(index, tsv), formats, file_name)
+
+def write_report(stats, formats=('html',), file_name="report"):
+    """ Writes report statistics (see report_stats) as file_name.html/.json/.csv """
+
+    import csv
+    import json
+
+    if 'html' in formats:
+        write_file(iter_report_html(stats), f"{file_name}.html")
+    if 'json' in formats:
+        write_file(json.dumps(stats, indent=1), f"{file_name}.json")
+    if 'csv' in formats:
+        with open(f"{file_name}.csv", "w", newline='') as fo_write:
+            csv.writer(fo_write).writerows(iter_report_csv(stats))
+        print(f"Report written as {file_name}.csv")
+
+### Functions for HTML Output
+
+# Every piece of markup understood by format_to_html starts with one of these characters
+# (a quick way to skip text with no markup at all)
+MARKUP_START_RE = re.compile(r"[\\;*<>]")
+
+# The markup itself, found in a single left to right scan
+# (order matters: at any position the first alternative that matches wins)
+MARKUP_RE = re.compile(r"""
+      \\(?: (?P<escaped_newline>\\n)     # \\n is kept as a literal \n
+          | (?P<newline>n)             # \n is a line break
+          | (?P<escaped_asterisk>\*)(?!\*) # \* is a literal *, unless the * is part of a **
+          )
+    | ;;(?: (?P<colour>[^ ]*)(?=\ )    # ;;colour opens a colour span (the colour ends at the first space)
+          | (?P<colour_end>)
+          )
+    | \*(?: (?P<bold>\*) | (?P<italic>) )
+    | (?P<less_than><)
+    | (?P<greater_than>>)
+    """, re.VERBOSE)
+
+# Memo for format_to_html, the same keywords (and comments) show up over and over again
+FORMAT_CACHE_SIZE = 1 << 16
+
+@functools.lru_cache(maxsize=FORMAT_CACHE_SIZE)
+def format_to_html(text):
+    """ Replaces markdown formatting and special chars with html equivalents """
+
+    candidate = MARKUP_START_RE.search(text)
+    if candidate is None:
+        return text
+
+    html = []
+    position = 0
+    colour_open = False
+    bold_open = False
+    italic_open = False
+    # Single asterisk? Might be in tsv file or not escaped, leave it (and any \*) alone
+    italics = text.count('*') - 2 * text.count('**') != 1
+
+    match = MARKUP_RE.search(text, candidate.start())
+    while match:
+        html.append(text[position:match.start()])
+        position = match.end()
+        markup = match.lastgroup
+
+        if markup == 'colour' or markup == 'colour_end':
+            if colour_open:
+                # Any ;; closes the open colour (don't swallow a colour name that follows it)
+                html.append("</span>")
+                position = match.start() + 2
+                colour_open = False
+            elif markup == 'colour':
+                colour = match['colour'].replace('<', '&lt;').replace('>', '&gt;')
+                html.append(f"<span style=\"color:{colour}\">")
+                colour_open = True
+            else:
+                html.append(";;")
+        elif markup == 'bold':
+            html.append("</span>" if bold_open else "<span class=\"bold\">")
+            bold_open = not bold_open
+        elif markup == 'italic':
+            if italics:
+                html.append("</span>" if italic_open else "<span class=\"italic\">")
+                italic_open = not italic_open
+            else:
+                html.append("*")
+        elif markup == 'escaped_asterisk':
+            html.append("*" if italics else "\\*")
+        elif markup == 'newline':
+            html.append("<br>")
+        elif markup == 'escaped_newline':
+            html.append("\\n")
+        elif markup == 'less_than':
+            html.append("&lt;")
+        else:
+            html.append("&gt;")
+
+        match = MARKUP_RE.search(text, position)
+
+    html.append(text[position:])
+    return ''.join(html)
+
+def create_html_head():
+    """ Creates start of html file """
+
+    html = """<html><body><table>
+                <head>
+                <style>
+
+                :root {
+                    --border-radius: 5px;
+                    --box-shadow: 2px 2px 10px;
+                    --font-family: Calibri, -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, Oxygen-Sans, Ubuntu, Cantarell, "Helvetica Neue", sans-serif;
+                    --justify-normal: left;
+                    --line-height: 1.5;
+                }
+
+                body {
+                    background: var(--color-bg);
+                    color: var(--color-text);
+                    font-family: var(--font-family);
+                    line-height: var(--line-height);
+                    margin: 0;
+                    padding: 0;
+                }
+
+                .bold {
+                    font-weight: bold;
+                }
+                .italic {
+                    font-style: italic;
+                }
+                """
+    return html
+
+def add_print_css(columns):
+    """ Adds the proper stylesheet depending on the number of columns """
+
+    print_css = ""
+
+    if columns == 3:
+        print_css += """             
+                @media print {
+                    @page {
+                      margin: 1.5cm;   
+                    }
+                    section.table > div:nth-of-type(odd) {
+                        background: #e0e0e0;
+                    }
+                    .table {
+                        page-break-after: always;
+                        width:20cm;
+                    }
+                    div.row > div {
+                      display: inline-block;  
+                      overflow-x: auto;
+                      padding: 0;
+                      vertical-align: top;
+                    }
+                    div.row {
+                      display: block;
+                    }
+                    h1 {
+                        margin-left: 10em;
+                    }
+                    .thead {
+                        text-align: center;
+                        font-weight: bold;
+                        }
+                    .keyword {
+                        width: 30%;
+                        margin-left: 0.1cm;
+                        /*margin: 0.1cm; /* Can be removed, good for readability when using colour output */
+                    }
+                    .location {
+                        width: 10%;
+                        text-align: center;
+                    }
+                    .comment {
+                        width:50%;
+                        margin-left: 0.5cm;
+                    }
+                }
+                """
     elif columns == 2:
         print_css += """             
                 @media print {
@@ -438,181 +2179,1865 @@ def add_print_css(columns):
                 }"""
     return print_css
 
-def add_print_css2():
-    """ Holds the rest of the non specific css """
+def add_print_css2():
+    """ Holds the rest of the non specific css """
+
+    return """
+                section.table > div:nth-of-type(odd) {
+                    background: #e0e0e0;
+                }
+                .alphabet
+                {
+                    text-align: center;
+                    page-break-before:auto;
+                }
+                .table {
+                    display: table;
+                    border-spacing: 1px;
+                }
+                .row {
+                    display: table-row;
+                }
+                .row > div {
+                    display: table-cell;
+                    padding: 4px; 
+                }
+                .thead {
+                    text-align: center;
+                    font-weight: bold;
+                }
+                .location {
+                    text-align: center;
+                }
+
+                .colour1 {
+                background: #b7e1cd;
+                }
+                .colour2 {
+                background: #e1c8b7;
+                }
+                .colour3 {
+                background: #b7c5e1;
+                }
+                .colour4 {
+                background: #e0e1b7;
+
+                }
+                .colour5 {
+                background: #e1bcb7;
+
+                }
+                .colour6 {
+                background: #b7dde1
+                }
+                
+
+                </style>
+                </head>
+                """
+
+def pick_colour(location):
+    """ Returns the proper colour code depending on which book the location references """
+
+    # Assume location in the form n.nnn
+    book = location.split('.')[0]
+
+    return f" colour{book}"
+
+def create_html_row(keyword, location, comment, columns, book_colours):
+    """ Converts the fields of an index entry to html """
+
+    if book_colours:
+        colour = pick_colour(location)
+    else:
+        colour = ''
+
+    keyword = format_to_html(keyword)
+    if columns == 2:
+        return f"<div class=\"row\"><div class=\"location{colour}\">{location}</div><div class=\"keyword\">{keyword}</div></div>\n\n"
+    if columns == 3:
+        comment = format_to_html(comment)
+        return f"<div class=\"row\"><div class=\"keyword\">{keyword}</div><div class=\"location{colour}\">{location}</div><div class=\"comment\">{comment}</div></div>\n\n"
+
+def iter_html_head(columns, header, navigation='', search=False):
+    """ Generates the start of the HTML file (styles, navigation links of a split page, search box, title, first table) """
+
+    yield create_html_head()
+    yield add_print_css(columns)
+    yield add_print_css2()
+    yield navigation
+    if search:
+        yield EMBED_SEARCH_BOX
+    
+    # Add title if desired
+    if header:
+        yield f"<h1>{header}</h1>"
+    
+    # Create first table:
+    yield """<section class="table">"""
+
+class SectionHeadings():
+    """ Works out the letter section headings one entry at a time, in index order """
+
+    def __init__(self, columns, page_breaks):
+        self.columns = columns
+        self.page_breaks = page_breaks
+        self.current_char = ''
+        self.non_alpha_char = False
+
+    def heading(self, test_letter):
+        """ HTML heading of a new section starting with this entry, None if the entry is in the current section """
+
+        columns = self.columns
+        new_heading = None
+
+        # We haven't seen a non alphabetical character
+        if not self.non_alpha_char and not test_letter.isalpha(): 
+            self.non_alpha_char = True
+            if columns == 2:
+                new_heading = f"""<div class=\"row\"><div class=\"alphabet\"><h1>#./!</h1></div><div></div></div>"""
+            else:
+                new_heading = f"""<div class=\"row\"><div></div><div class=\"alphabet\"><h1>#./!</h1></div><div></div></div>"""
+
+        if test_letter.isalpha() and not self.non_alpha_char: # Didn't have non alpha char
+            self.non_alpha_char = True # Don't go through this path second time
+            if test_letter != self.current_char:
+                self.current_char = test_letter
+
+                if columns == 2:
+                    new_heading = f"""<div class=\"row\"><div class=\"alphabet\"><h1>{self.current_char}</h1></div><div></div></div>"""
+                else:
+                    new_heading = f"""<div class=\"row\"><div></div><div class=\"alphabet\"><h1>{self.current_char}</h1></div><div></div></div>"""
+
+
+        # The rest of the Alphabetical entries 
+        elif test_letter.isalpha(): 
+            if test_letter != self.current_char:
+                self.current_char = test_letter
+
+                # Page Breaks
+                if self.page_breaks:
+                    if columns == 2:
+                        new_heading = f"""</section><section class="table"><div class=\"row\"><div class=\"alphabet\"><h1>{self.current_char}</h1></div><div></div></div>"""
+                    else:
+                        new_heading = f"""</section><section class="table"><div class=\"row\"><div></div><div class=\"alphabet\"><h1>{self.current_char}</h1></div><div></div></div>"""
+                else:
+                    if columns == 2:
+                        new_heading = f"""<div class=\"row\"><div class=\"alphabet\"><h1>{self.current_char}</h1></div><div></div></div>"""
+                    else:
+                        new_heading = f"""<div class=\"row\"><div></div><div class=\"alphabet\"><h1>{self.current_char}</h1></div><div></div></div>"""
+
+        return new_heading
+
+def letter_changes(letters, previous=None):
+    """ Positions in letters where the letter differs from the one before (previous is the letter before the first) """
+
+    if not letters:
+        return []
+    # groupby compares in C, and mostly by identity as the letters are interned
+    run_ends = list(itertools.accumulate(len(list(run)) for _, run in itertools.groupby(letters)))
+    changes = [0, *run_ends[:-1]]
+    if letters[0] == previous:
+        del changes[0]
+    return changes
+
+def html_sections(index, columns, page_breaks):
+    """ Splits the (sorted) index into letter sections, generates (heading html, first entry, last entry + 1) """
+
+    # A new section can only start where the letter changes
+    headings = SectionHeadings(columns, page_breaks)
+    letters = index.letters
+    heading = None
+    start = 0
+    for position in letter_changes(letters):
+        new_heading = headings.heading(letters[position])
+        if new_heading is not None:
+            if heading is not None:
+                yield heading, start, position
+            heading = new_heading
+            start = position
+
+    if heading is not None:
+        yield heading, start, index.count
+
+# Indexes with fewer entries are rendered in one process (starting the workers would take longer than rendering)
+PARALLEL_RENDER_MIN = 50000
+# Ranges of entries per render process
+RENDER_TASKS_PER_JOB = 4
+
+def iter_html_section(index, heading, start, stop, columns, book_colours):
+    """ Generates the HTML of one letter section: the heading then each entry """
+
+    yield heading
+    keywords = index.keywords
+    locations = index.locations
+    comments = index.comments
+    for position in range(start, stop):
+        yield create_html_row(keywords[position], locations[position], comments[position], columns, book_colours)
+
+def iter_html_groups(index, groups, book_colours, header):
+    """ Generates a HTML file with one section per group of positions, headed by the first keyword and group size """
+
+    columns = index.columns
+    yield from iter_html_head(columns, header)
+    keywords = index.keywords
+    locations = index.locations
+    comments = index.comments
+    for positions in groups:
+        title = f"{format_to_html(index.plain_keywords[positions[0]])} ({len(positions)})"
+        if columns == 2:
+            yield f"""<div class=\"row\"><div class=\"alphabet\"><h2>{title}</h2></div><div></div></div>"""
+        else:
+            yield f"""<div class=\"row\"><div></div><div class=\"alphabet\"><h2>{title}</h2></div><div></div></div>"""
+        for position in positions:
+            yield create_html_row(keywords[position], locations[position], comments[position], columns, book_colours)
+    yield "</section></body></html>"
+
+def clip_sections(sections, start, stop, headings=True):
+    """ The parts of (heading, start, stop) sections between entries start and stop
+
+        A section started before start only keeps its heading if headings is True """
+
+    return [(heading if headings or section_start >= start else '', max(section_start, start), min(section_stop, stop))
+            for heading, section_start, section_stop in sections if section_start < stop and section_stop > start]
+
+def render_jobs(index, jobs=None):
+    """ Number of processes to render index with: jobs (default one per CPU), 1 for small indexes """
+
+    if index.count < PARALLEL_RENDER_MIN:
+        return 1
+    return jobs or os.cpu_count() or 1
+
+def render_sections(index, sections, columns, book_colours):
+    """ The HTML of (parts of) sections as one string """
+
+    return ''.join(itertools.chain.from_iterable(iter_html_section(index, heading, start, stop, columns, book_colours)
+                                                 for heading, start, stop in sections))
+
+# The index being rendered, in each render worker process (see render_pool)
+_render_index = None
+
+def set_render_index(index):
+    """ Runs when a render worker process starts """
+
+    global _render_index
+    _render_index = index
+
+def render_pool(index, jobs):
+    """ Process pool of jobs workers which all have index as _render_index
+
+        Workers are forked where possible, so they share the index instead of each receiving a copy """
+
+    import concurrent.futures
+    import multiprocessing
+
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    return concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=context, initializer=set_render_index,
+                                                  initargs=(index.html_slice(0, index.count),))
+
+def render_worker_sections(sections, columns, book_colours):
+    """ render_sections of the worker's index (what each render worker runs) """
+
+    return render_sections(_render_index, sections, columns, book_colours)
+
+def iter_html_parallel(index, sections, columns, book_colours, jobs):
+    """ Generates the HTML of the sections rendered across jobs processes, in order
+
+        The entries are cut into equal ranges (a few per process so they all finish together),
+        a section cut in two only has its heading in the first range so the joined HTML is the same as render_sections """
+
+    task_entries = -(-index.count // (jobs * RENDER_TASKS_PER_JOB))
+    task_sections = (clip_sections(sections, start, start + task_entries, headings=False) for start in range(0, index.count, task_entries))
+    with render_pool(index, jobs) as pool:
+        yield from pool.map(render_worker_sections, task_sections, itertools.repeat(columns), itertools.repeat(book_colours))
+
+def iter_html(index, book_colours, columns, page_breaks, header, jobs=1, search=False):
+    """ Generates the HTML file piece by piece (head, letter headings, then one entry at a time)
+
+        With jobs > 1 the sections are rendered in that many processes (see iter_html_parallel), the HTML is the same.
+        search adds the search box, the search data (see EmbeddedSearch) has to follow the closing </section> """
+
+    yield from iter_html_head(columns, header, search=search)
+    if jobs > 1:
+        yield from iter_html_parallel(index, list(html_sections(index, columns, page_breaks)), columns, book_colours, jobs)
+        return
+    for heading, start, stop in html_sections(index, columns, page_breaks):
+        yield from iter_html_section(index, heading, start, stop, columns, book_colours)
+
+def create_html(index, book_colours, columns, page_breaks, header, jobs=1):
+    """ Creates the HTML file """
+
+    return ''.join(iter_html(index, book_colours, columns, page_breaks, header, jobs))
+
+def print_html(index, book_colours, file_name, page_breaks, header='', jobs=None):
+    """ Outputs a HTML File, streaming it to disk (or any file-like object) as it is generated
+
+        Large indexes are rendered across jobs processes (default one per CPU) """
+
+    columns = index.columns
+    html_file = iter_html(index, book_colours, columns, page_breaks, header, render_jobs(index, jobs))
+    html_file = itertools.chain(html_file, ["</section></body></html>"])
+
+    #Write the file
+    write_file(html_file, file_name)
+    
+
+def section_digest(index, heading, start, stop):
+    """ Fingerprint of everything that goes into a section's HTML """
+
+    import hashlib
+
+    digest = hashlib.blake2b(heading.encode(), digest_size=16)
+    for column in (index.keywords, index.locations, index.comments):
+        digest.update(b'\x1e')
+        digest.update('\x1f'.join(column[start:stop]).encode('utf-8', 'surrogatepass'))
+    return digest.hexdigest()
+
+def print_html_incremental(index, book_colours, file_name, page_breaks, header=''):
+    """ Outputs a HTML File, only rendering the letter sections that changed since the last incremental build
+
+        Unchanged sections are copied from the previous file, the state of each build is saved in <file_name>.state """
+
+    import json
+    import mmap
+
+    columns = index.columns
+    state_file = file_name + '.state'
+    options = [CACHE_VERSION, book_colours, columns, page_breaks, header]
+
+    # Sections of the previous build: digest -> (byte offset, length) in the previous file
+    previous = {}
+    try:
+        with open(state_file) as fo:
+            state = json.load(fo)
+        stat = os.stat(file_name)
+        # Only trust the previous file if it's the one that build wrote
+        if state['options'] == options and state['size'] == stat.st_size and state['mtime'] == stat.st_mtime_ns:
+            previous = {digest: (offset, length) for digest, offset, length in state['sections']}
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    sections = []
+    rendered = 0
+    temp_name = f"{file_name}.{os.getpid()}.tmp"
+    with contextlib.ExitStack() as stack:
+        if previous:
+            old_file = stack.enter_context(open(file_name, 'rb'))
+            old_html = stack.enter_context(mmap.mmap(old_file.fileno(), 0, access=mmap.ACCESS_READ))
+        fo = stack.enter_context(open(temp_name, 'wb', buffering=WRITE_BUFFER_SIZE))
+
+        fo.write(''.join(iter_html_head(columns, header)).encode())
+        for heading, start, stop in html_sections(index, columns, page_breaks):
+            digest = section_digest(index, heading, start, stop)
+            offset = fo.tell()
+            if digest in previous:
+                old_offset, length = previous[digest]
+                fo.write(old_html[old_offset:old_offset + length])
+            else:
+                for chunk in iter_html_section(index, heading, start, stop, columns, book_colours):
+                    fo.write(chunk.encode())
+                length = fo.tell() - offset
+                rendered += 1
+            sections.append([digest, offset, length])
+        fo.write(b"</section></body></html>")
+
+    os.replace(temp_name, file_name)
+    stat = os.stat(file_name)
+    with open(state_file, 'w') as fo:
+        json.dump({'options': options, 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sections': sections}, fo)
+    print(f"{output_name(file_name)} written as {file_name} ({rendered} of {len(sections)} sections rendered)")
+
+### Split HTML Output
+
+# --split letter writes a page per letter section, --split n a page per n entries
+SPLIT_LETTER = 'letter'
+
+NAVIGATION_CSS = """<style>
+                body { font-family: Calibri, -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, sans-serif; margin: 2em; }
+                nav.letters a { display: inline-block; min-width: 2em; padding: 0.2em; text-align: center; font-size: 1.5em; }
+                nav.letters small { display: block; font-size: 0.5em; color: grey; }
+                ul.pages { columns: 3; }
+                </style>"""
+
+def letter_slug(letter):
+    """ File name part for a letter section, 'symbols' for the #./! section """
+
+    if not letter.isalpha():
+        return 'symbols'
+    if letter.isascii():
+        return letter
+    return '-'.join(f"u{ord(char):04x}" for char in letter)
+
+def page_file_name(base, slug):
+    """ index.html -> index-A.html (base is the output file name without .html) """
+
+    return f"{base}-{slug}.html"
+
+def remove_old_pages(file_name, written):
+    """ Removes the pages the last split of file_name wrote that aren't in written (they would be out of date)
+
+        The pages each split writes are listed in <file_name>.pages, only pages listed there are removed """
+
+    import json
+
+    pages_file = file_name + '.pages'
+    folder = os.path.dirname(file_name)
+    try:
+        with open(pages_file) as fo:
+            previous = json.load(fo)['pages']
+    except (OSError, ValueError, KeyError, TypeError):
+        previous = []
+
+    kept = {os.path.basename(page_name) for page_name in written}
+    for name in previous:
+        # Only plain names next to file_name, anything else didn't come from a split
+        if not isinstance(name, str) or name in kept or os.path.basename(name) != name:
+            continue
+        page_name = os.path.join(folder, name)
+        try:
+            os.remove(page_name)
+            print(f"Removed {page_name} (from an earlier split)")
+        except FileNotFoundError:
+            pass
+        except OSError as error:
+            print(f"Warning: Could not remove {page_name} from an earlier split ({error})")
+
+    try:
+        with open(pages_file, 'w') as fo:
+            json.dump({'pages': sorted(kept)}, fo)
+    except OSError as error:
+        print(f"Warning: Could not write {pages_file} ({error}), pages of this split won't be removed by the next one")
+
+def split_pages(index, columns, per_page=None, page_breaks=False):
+    """ Splits the (sorted) index into pages, returns a list of (slug, label, start, stop, sections)
+
+        Without per_page there is one page per letter section, otherwise one per per_page entries.
+        sections are the (heading, start, stop) of html_sections() on that page
+        (a section split across pages gets its heading on each of them) """
+
+    if per_page is None:
+        pages = []
+        seen = collections.Counter()
+        for heading, start, stop in html_sections(index, columns, False):
+            letter = index.letters[start]
+            slug = letter_slug(letter)
+            seen[slug] += 1
+            if seen[slug] > 1:
+                slug += f"-{seen[slug]}"
+            pages.append((slug, letter if letter.isalpha() else '#./!', start, stop, [(heading, start, stop)]))
+        return pages
+
+    sections = list(html_sections(index, columns, page_breaks))
+    page_count = -(-index.count // per_page)
+    pages = []
+    for number, page_start in enumerate(range(0, index.count, per_page), 1):
+        page_stop = min(page_start + per_page, index.count)
+        page_sections = clip_sections(sections, page_start, page_stop)
+        label = f"{index.plain_keywords[page_start]} - {index.plain_keywords[page_stop - 1]}"
+        pages.append((f"{number:0{len(str(page_count))}}", label, page_start, page_stop, page_sections))
+    return pages
+
+def split_letters(index, columns, pages):
+    """ (letter, entries, slug of the page with its first entry) for each letter section of the split index """
+
+    page_starts = [start for _, _, start, _, _ in pages]
+    letters = []
+    for _, start, stop in html_sections(index, columns, False):
+        letter = index.letters[start]
+        page = pages[bisect.bisect_right(page_starts, start) - 1]
+        letters.append((letter if letter.isalpha() else '#./!', stop - start, page[0]))
+    return letters
+
+def page_navigation(base, pages, number):
+    """ Links at the top of split page number: the navigation page and the previous/next pages """
+
+    links = [f'<a href="{os.path.basename(base)}.html">Index</a>']
+    if number > 0:
+        slug, label = pages[number - 1][:2]
+        links.append(f'<a href="{os.path.basename(page_file_name(base, slug))}">&larr; {format_to_html(label)}</a>')
+    if number + 1 < len(pages):
+        slug, label = pages[number + 1][:2]
+        links.append(f'<a href="{os.path.basename(page_file_name(base, slug))}">{format_to_html(label)} &rarr;</a>')
+    return f'<nav class="pages">{" | ".join(links)}</nav>'
+
+def iter_html_page(index, sections, book_colours, columns, header, navigation):
+    """ Generates one split page: the usual head, navigation links, then its (parts of) letter sections """
+
+    yield from iter_html_head(columns, header, navigation)
+    for heading, start, stop in sections:
+        yield from iter_html_section(index, heading, start, stop, columns, book_colours)
+    yield "</section></body></html>"
+
+def iter_html_navigation(index, base, pages, letters, header):
+    """ Generates the small navigation page of a split index: letters and pages with their entry counts """
+
+    yield f"<html><head><meta charset=\"utf-8\"><title>{header or 'Index'}</title>{NAVIGATION_CSS}</head><body>"
+    if header:
+        yield f"<h1>{header}</h1>"
+    yield f"<p>{index.count} entries on {len(pages)} pages</p>"
+    yield '<nav class="letters">'
+    for letter, count, slug in letters:
+        yield f'<a href="{os.path.basename(page_file_name(base, slug))}">{format_to_html(letter)}<small>{count}</small></a>'
+    yield "</nav>"
+    # Letter pages are already listed above
+    if len(letters) != len(pages) or any(letter[2] != page[0] for letter, page in zip(letters, pages)):
+        yield '<ul class="pages">'
+        for slug, label, start, stop, _ in pages:
+            yield f'<li><a href="{os.path.basename(page_file_name(base, slug))}">{format_to_html(label)}</a> ({stop - start})</li>'
+        yield "</ul>"
+    yield "</body></html>"
+
+def write_html_page(page_name, index, sections, book_colours, columns, header, navigation):
+    """ Writes one split page (what each process runs when the pages are written in parallel) """
+
+    write_file(iter_html_page(index, sections, book_colours, columns, header, navigation), page_name, announce=False)
+
+def write_worker_page(page_name, sections, book_colours, columns, header, navigation):
+    """ write_html_page of the worker's index (what each render worker runs for split output) """
+
+    write_html_page(page_name, _render_index, sections, book_colours, columns, header, navigation)
+
+def print_html_split(index, book_colours, file_name, page_breaks=False, header='', per_page=None, jobs=None):
+    """ Outputs the index as one HTML file per letter (or per per_page entries), next to file_name,
+        and a navigation page linking them as file_name. Returns the names of the files written
+
+        Large indexes have their pages written by jobs processes (default one per CPU) """
+
+    columns = index.columns
+    base = file_name[:-len('.html')] if file_name.endswith('.html') else file_name
+    pages = split_pages(index, columns, per_page, page_breaks)
+    written = [page_file_name(base, slug) for slug, _, _, _, _ in pages]
+    navigations = [page_navigation(base, pages, number) for number in range(len(pages))]
+    jobs = render_jobs(index, jobs)
+    if jobs > 1:
+        with render_pool(index, jobs) as pool:
+            list(pool.map(write_worker_page, written, [sections for _, _, _, _, sections in pages], itertools.repeat(book_colours),
+                          itertools.repeat(columns), itertools.repeat(header), navigations))
+    else:
+        for page_name, (_, _, _, _, sections), navigation in zip(written, pages, navigations):
+            write_html_page(page_name, index, sections, book_colours, columns, header, navigation)
+
+    letters = split_letters(index, columns, pages)
+    write_file(iter_html_navigation(index, base, pages, letters, header), file_name, announce=False)
+    written.append(file_name)
+    print(f"{output_name(file_name)} written as {file_name} ({len(pages)} pages, {page_file_name(base, '*')})")
+    remove_old_pages(file_name, written[:-1])
+    return written
+
+### Embedded Search
+# --embed-search adds a search box to index.html, answered in the browser from a word index built while the HTML is written:
+# the distinct words of the keywords and comments (lower case, without formatting) in sorted order and, for each word,
+# the entries with it in their keyword and the other entries with it in their comment, stored as gaps between entry numbers
+
+EMBED_WORD_RE = re.compile(r'\w+')
+
+EMBED_SEARCH_BOX = """<style>
+                .search { position: sticky; top: 0; z-index: 1; background: #fff; padding: 0.5em; border-bottom: 1px solid #ccc; }
+                .search input { width: 100%; box-sizing: border-box; font-size: 1.1em; padding: 0.3em; }
+                #search-results { max-height: 50vh; overflow-y: auto; }
+                #search-results .row { cursor: pointer; }
+                #search-results .row:hover, .row.found { background: #ffeb99; }
+                @media print { .search { display: none; } }
+                </style>
+                <div class="search"><input type="search" id="search" placeholder="Search keywords and comments" autocomplete="off">
+                <div id="search-results"></div></div>
+                """
+
+EMBED_SEARCH_SCRIPT = """<script>
+(function () {
+    var data = JSON.parse(document.getElementById('search-data').textContent);
+    var rows = Array.prototype.filter.call(document.querySelectorAll('section.table > .row'), function (row) {
+        return !row.querySelector('.alphabet');
+    });
+    var box = document.getElementById('search'), results = document.getElementById('search-results');
+    var decoded = {}, shown = [];
+
+    // Entry numbers of data[field][word], the gaps are added up the first time they're needed
+    function entries(field, word) {
+        var key = field + word;
+        if (!decoded[key]) {
+            var position = 0;
+            decoded[key] = data[field][word].map(function (gap) { return position += gap; });
+        }
+        return decoded[key];
+    }
+
+    // Entries with a word starting with prefix: entry number => 1 if it is in the keyword, 2 if only in the comment
+    function find(prefix) {
+        var words = data.w, low = 0, high = words.length, found = new Map();
+        while (low < high) {
+            var middle = (low + high) >> 1;
+            if (words[middle] < prefix) low = middle + 1; else high = middle;
+        }
+        for (var word = low; word < words.length && words[word].startsWith(prefix); word++) {
+            entries('k', word).forEach(function (position) { found.set(position, 1); });
+            entries('c', word).forEach(function (position) { if (!found.has(position)) found.set(position, 2); });
+        }
+        return found;
+    }
+
+    // Every word must match, entries matching in their keyword first then in index order
+    function search() {
+        var terms = box.value.toLowerCase().match(/[\\p{L}\\p{N}_]+/gu) || [];
+        var matches = null;
+        terms.forEach(function (term) {
+            var found = find(term);
+            if (matches !== null) {
+                var both = new Map();
+                matches.forEach(function (field, position) {
+                    if (found.has(position)) both.set(position, Math.max(field, found.get(position)));
+                });
+                found = both;
+            }
+            matches = found;
+        });
+        results.textContent = '';
+        shown = [];
+        if (matches === null) return;
+        var ranked = Array.from(matches.keys()).sort(function (a, b) { return matches.get(a) - matches.get(b) || a - b; });
+        var count = document.createElement('div');
+        count.textContent = ranked.length + (ranked.length === 1 ? ' result' : ' results') +
+            (ranked.length > %(limit)d ? ', first %(limit)d shown' : '');
+        results.appendChild(count);
+        ranked.slice(0, %(limit)d).forEach(function (position) {
+            var row = rows[position].cloneNode(true);
+            row.addEventListener('click', function () {
+                shown.forEach(function (previous) { previous.classList.remove('found'); });
+                rows[position].classList.add('found');
+                shown = [rows[position]];
+                rows[position].scrollIntoView({block: 'center'});
+            });
+            results.appendChild(row);
+        });
+    }
+
+    box.addEventListener('input', search);
+    box.addEventListener('keydown', function (event) {
+        if (event.key === 'Escape') { box.value = ''; search(); }
+    });
+})();
+</script>
+"""
+# Results listed under the search box, the rest are only counted
+EMBED_SEARCH_LIMIT = 200
+
+def position_gaps(positions):
+    """ Differences between consecutive (ascending) positions, the first one from 0 """
+
+    return list(map(operator.sub, positions, [0, *positions[:-1]]))
+
+class EmbeddedSearch():
+    """ Collects the words of the entries, in output order, and writes them as the data of the search box """
+
+    def __init__(self):
+        self.count = 0
+        self.keywords = {}
+        self.comments = {}
+
+    def add(self, plain_keywords, comments):
+        """ Adds the next entries: their keywords without formatting and their comments """
+
+        find_words = EMBED_WORD_RE.findall
+        keyword_words = self.keywords
+        comment_words = self.comments
+        for position, keyword, comment in zip(itertools.count(self.count), plain_keywords, comments):
+            words = set(find_words(keyword.lower()))
+            for word in words:
+                keyword_words.setdefault(word, []).append(position)
+            if comment:
+                for word in set(find_words(strip_formatting(comment).lower())) - words:
+                    comment_words.setdefault(word, []).append(position)
+            self.count += 1
+
+    def data(self):
+        """ The search data as a dict: w the sorted words, k and c the gaps between the entries with each word
+            in their keyword / only in their comment """
+
+        # In the order JavaScript compares strings (UTF-16 code units)
+        words = sorted(self.keywords.keys() | self.comments.keys(), key=lambda word: word.encode('utf-16-be'))
+        return {"w": words,
+                "k": [position_gaps(self.keywords.get(word, [])) for word in words],
+                "c": [position_gaps(self.comments.get(word, [])) for word in words]}
+
+    def iter_html(self):
+        """ Generates the search data and script, put after the entries (the search box is in iter_html_head) """
+
+        import json
+
+        data = self.data()
+        # Words can't contain < but be safe, the JSON mustn't end the script early
+        text = json.dumps(data, ensure_ascii=False, separators=(',', ':')).replace('</', '<\\/')
+        self.words = len(data["w"])
+        self.size = len(text.encode())
+        yield '<script type="application/json" id="search-data">'
+        yield text
+        yield '</script>'
+        yield EMBED_SEARCH_SCRIPT % {"limit": EMBED_SEARCH_LIMIT}
+
+    def print_size(self):
+        """ Prints the size of the search data last written by iter_html """
+
+        print(f"Search index embedded: {self.words} words for {self.count} entries, {self.size / 1024:,.0f} KB")
+
+### Single Pass Output
+# write_outputs() walks the sorted index once, section by section, rendering each entry's HTML once,
+# and hands every section to each output: an object with start(), section(index, heading, start, stop, rows) and finish()
+# (index is the index start and stop refer to, see write_merged_outputs for a sorted stream of blocks)
+
+def render_worker_rows(start, stop, columns, book_colours):
+    """ HTML rows of entries start to stop - 1 of the worker's index (what each render worker runs) """
+
+    index = _render_index
+    return list(map(create_html_row, index.keywords[start:stop], index.locations[start:stop], index.comments[start:stop],
+                    itertools.repeat(columns), itertools.repeat(book_colours)))
+
+def iter_section_rows(index, sections, columns, book_colours, jobs=1):
+    """ Generates (heading, start, stop, rows) for each section, rows being the HTML of each of its entries
+
+        With jobs > 1 the rows are rendered by that many processes, in equal ranges of entries like iter_html_parallel """
+
+    if jobs <= 1:
+        for heading, start, stop in sections:
+            rows = list(map(create_html_row, index.keywords[start:stop], index.locations[start:stop], index.comments[start:stop],
+                            itertools.repeat(columns), itertools.repeat(book_colours)))
+            yield heading, start, stop, rows
+        return
+
+    task_entries = -(-index.count // (jobs * RENDER_TASKS_PER_JOB))
+    starts = range(0, index.count, task_entries)
+    with render_pool(index, jobs) as pool:
+        results = pool.map(render_worker_rows, starts, [start + task_entries for start in starts],
+                           itertools.repeat(columns), itertools.repeat(book_colours))
+        buffered = []
+        for heading, start, stop in sections:
+            while len(buffered) < stop - start:
+                buffered += next(results)
+            yield heading, start, stop, buffered[:stop - start]
+            del buffered[:stop - start]
+
+class HtmlOutput():
+    """ Writes the index HTML (what print_html writes), with the embedded search box if search is True """
+
+    stage = 'render'
+
+    def __init__(self, file_name, columns, header='', search=False):
+        self.file_name = file_name
+        self.columns = columns
+        self.header = header
+        self.search = EmbeddedSearch() if search else None
+        self.fo = None
+
+    def start(self):
+        # The writes, spread over the sections, are profiled as one write stage
+        self.writes = StageTotal('write')
+        with self.writes.timing():
+            self.fo = open(self.file_name, "w", buffering=WRITE_BUFFER_SIZE)
+            self.fo.writelines(iter_html_head(self.columns, self.header, search=self.search is not None))
+
+    def section(self, index, heading, start, stop, rows):
+        with self.writes.timing():
+            self.fo.write(heading)
+            self.fo.writelines(rows)
+        if self.search is not None:
+            self.search.add(index.plain_keywords[start:stop], index.comments[start:stop])
+
+    def finish(self):
+        search_html = list(self.search.iter_html()) if self.search is not None else []
+        with self.writes.timing():
+            self.fo.write("</section>")
+            self.fo.writelines(search_html)
+            self.fo.write("</body></html>")
+            self.fo.close()
+        self.writes.finish(file=self.file_name)
+        print(f"{output_name(self.file_name)} written as {self.file_name}")
+        if self.search is not None:
+            self.search.print_size()
+
+class ReportOutput():
+    """ Adds up the report counts section by section, then writes the report (what create_report writes) """
+
+    stage = 'report'
+
+    def __init__(self, columns, tsv, formats=('html',), file_name="report"):
+        self.columns = columns
+        self.tsv = tsv
+        self.formats = formats
+        self.file_name = file_name
+
+    def start(self):
+        self.entries = 0
+        self.page_counts = collections.Counter()
+        self.alphabet_entries = {}
+        self.comment_lengths = collections.Counter()
+
+    def section(self, index, heading, start, stop, rows):
+        self.entries += stop - start
+        self.page_counts.update(index.packed_locations[start:stop])
+        count_letters(index.letters[start:stop], self.alphabet_entries)
+        self.comment_lengths.update(map(len, index.comments[start:stop]))
+
+    def remove(self, index, start, stop):
+        """ Takes entries start to stop - 1 of index back out of the counts (see IndexWatcher) """
+
+        self.entries -= stop - start
+        # -= drops the counts that reach 0, as if those entries had never been counted
+        self.page_counts -= collections.Counter(index.packed_locations[start:stop])
+        self.comment_lengths -= collections.Counter(map(len, index.comments[start:stop]))
+        for letter, count in count_letters(index.letters[start:stop]).items():
+            self.alphabet_entries[letter] -= count
+            if not self.alphabet_entries[letter]:
+                del self.alphabet_entries[letter]
+
+    def finish(self):
+        stats = report_from_counts(self.entries, self.columns, self.tsv, self.page_counts, self.alphabet_entries, self.comment_lengths)
+        write_report(stats, self.formats, self.file_name)
+
+class DuplicatesOutput():
+    """ Finds the duplicate keywords section by section and writes them (what find_duplicates then print_html write)
+        reusing the rows already rendered for the index
+
+        Entries with the same duplicate_key have the same sort key, so they are always in the same section """
+
+    stage = 'duplicates'
+
+    def __init__(self, index, file_name, summary=True):
+        self.index = index
+        self.file_name = file_name
+        self.summary = summary
+
+    def start(self):
+        self.groups = []
+        self.rows = []
+
+    def section(self, index, heading, start, stop, rows):
+        groups = {}
+        for position, keyword in enumerate(self.index.plain_keywords[start:stop], start):
+            groups.setdefault(duplicate_key(keyword), []).append(position)
+        for key, positions in groups.items():
+            if len(positions) > 1 and key:
+                self.groups.append(positions)
+                self.rows += [rows[position - start] for position in positions]
+
+    def finish(self):
+        if self.summary:
+            print_duplicate_summary(self.index, self.groups)
+        duplicates = find_duplicates(self.index, self.groups)
+        self.entries = duplicates.count
+        html = itertools.chain(iter_html_head(duplicates.columns, ''),
+                               itertools.chain.from_iterable([heading, *self.rows[start:stop]]
+                                                             for heading, start, stop in html_sections(duplicates, duplicates.columns, False)),
+                               ["</section></body></html>"])
+        write_file(html, self.file_name)
+
+def write_outputs(index, outputs, book_colours, page_breaks=False, jobs=1, entry_rows=None):
+    """ Feeds each section of the (sorted) index, with its entries rendered as HTML, to every output in one pass
+
+        entry_rows is the HTML of every entry if it has already been rendered (see IndexWatcher) """
+
+    columns = index.columns
+    stages, rendering = output_stages(outputs)
+    for output, stage in stages:
+        with stage.timing():
+            output.start()
+    sections = list(html_sections(index, columns, page_breaks))
+    if entry_rows is None:
+        section_rows = iter_section_rows(index, sections, columns, book_colours, jobs)
+    else:
+        section_rows = ((heading, start, stop, entry_rows[start:stop]) for heading, start, stop in sections)
+    for heading, start, stop, rows in iter_timed(section_rows, rendering):
+        for output, stage in stages:
+            with stage.timing():
+                output.section(index, heading, start, stop, rows)
+    finish_outputs(stages, rendering, index.count)
+
+def output_stages(outputs):
+    """ (output, StageTotal) for each output, profiled as its own stage (output.stage e.g. report) over the sections,
+        and the StageTotal rendering the rows is added to (the index HTML's) """
+
+    stages = [(output, StageTotal(output.stage)) for output in outputs]
+    rendering = next((stage for _, stage in stages if stage.stage == 'render'), None) or StageTotal('render')
+    return stages, rendering
+
+def finish_outputs(stages, rendering, count):
+    """ Finishes each output (see output_stages) then records its stage, count is the number of entries written """
+
+    for output, stage in stages:
+        with stage.timing():
+            output.finish()
+        stage.finish(entries=getattr(output, 'entries', count))
+    if all(stage is not rendering for _, stage in stages):
+        rendering.finish(entries=count)
+
+def iter_timed(items, stage):
+    """ Generates the items, the time taken to make each of them added to stage (a StageTotal) """
+
+    items = iter(items)
+    while True:
+        with stage.timing():
+            item = next(items, stage)
+        if item is stage:
+            return
+        yield item
+
+def write_file(index_html, file_name, announce=True):
+    """ Writes the file to disk, index_html can be a string or an iterable of strings
+
+        file_name can also be an open file-like object (e.g. sys.stdout), announce prints that the file was written """
+
+    if isinstance(index_html, str):
+        index_html = [index_html]
+
+    if hasattr(file_name, 'write'):
+        for chunk in index_html:
+            file_name.write(chunk)
+        return
+
+    with open(file_name, "w", buffering=WRITE_BUFFER_SIZE) as fo_write:
+        if PROFILE_HOOKS:
+            write_timed(index_html, fo_write, file_name)
+        else:
+            for chunk in index_html:
+                fo_write.write(chunk)
+    if announce:
+        print(f"{output_name(file_name)} written as {file_name}")
+
+def output_name(file_name):
+    """ 'Index' for index.html (or out/index.html), used in the written messages """
+
+    return os.path.basename(file_name).split('.')[0].title()
+
+def write_timed(chunks, fo_write, file_name=None):
+    """ Writes the chunks, reporting the time spent writing (not generating them) as a write stage (of file_name) """
+
+    start = time.perf_counter()
+    wall = 0.0
+    cpu = 0.0
+    written = 0
+    for chunk in chunks:
+        chunk_wall = time.perf_counter()
+        chunk_cpu = time.process_time()
+        fo_write.write(chunk)
+        cpu += time.process_time() - chunk_cpu
+        wall += time.perf_counter() - chunk_wall
+        written += len(chunk)
+    flush_wall = time.perf_counter()
+    fo_write.flush()
+    wall += time.perf_counter() - flush_wall
+    metrics = {'wall': wall, 'cpu': cpu, 'start': start - (_profile_start or start), 'characters': written}
+    if file_name is not None:
+        metrics['file'] = file_name
+    record_stage('write', metrics)
+
+### HTTP Server
+
+SERVER_RELOAD_INTERVAL = 1.0 # Seconds between checks for changes to the input files
+SERVER_KEEP_ALIVE = 15 # Seconds an idle connection is kept open
+SERVER_MAX_HEAD = 16 * 1024 # Longest request line + headers accepted
+SERVER_SEARCH_LIMIT = 100 # Results per search unless the client asks for a limit
+
+def file_signatures(file_names):
+    """ (mtime, size) of each file (None if it can't be read), changes whenever one of them is saved """
+
+    signature = []
+    for file_name in file_names:
+        try:
+            stat = os.stat(file_name)
+        except OSError:
+            signature.append(None)
+        else:
+            signature.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+def parse_address(address):
+    """ Splits [host:]port into (host, port), the host defaults to localhost """
+
+    host, _, port = address.rpartition(':')
+    if not port.isdigit():
+        return None
+    return host.strip('[]') or '127.0.0.1', int(port)
 
-    return """
-                section.table > div:nth-of-type(odd) {
-                    background: #e0e0e0;
-                }
-                .alphabet
-                {
-                    text-align: center;
-                    page-break-before:auto;
-                }
-                .table {
-                    display: table;
-                    border-spacing: 1px;
-                }
-                .row {
-                    display: table-row;
-                }
-                .row > div {
-                    display: table-cell;
-                    padding: 4px; 
-                }
-                .thead {
-                    text-align: center;
-                    font-weight: bold;
-                }
-                .location {
-                    text-align: center;
-                }
+class IndexServer():
+    """ Keeps an index loaded (with its search index and rendered HTML) and answers HTTP requests from it
 
-                .colour1 {
-                background: #b7e1cd;
-                }
-                .colour2 {
-                background: #e1c8b7;
-                }
-                .colour3 {
-                background: #b7c5e1;
-                }
-                .colour4 {
-                background: #e0e1b7;
+        handle_request() works without any sockets, start() puts it behind an asyncio server.
+        The input files are polled and reloaded in a worker thread when they change,
+        requests keep being answered from the previous index until the new one is ready. """
 
-                }
-                .colour5 {
-                background: #e1bcb7;
+    def __init__(self, file_names, tsv=False, book_colours=False, page_breaks=False, header='', cache=True,
+                 fields=None, limit=SERVER_SEARCH_LIMIT, collation=None, embed_search=False):
+        self.file_names = file_names
+        # The --tsv option, self.tsv is whether the loaded files are TSV
+        self.tsv_option = tsv
+        self.tsv = tsv
+        self.book_colours = book_colours
+        self.page_breaks = page_breaks
+        self.header = header
+        self.cache = cache
+        self.fields = fields
+        self.limit = limit
+        self.collation = collation
+        self.embed_search = embed_search
+        self.signature = None
+        # (index, search index, html, etag, compressed html), replaced in one assignment on reload
+        self.current = None
 
-                }
-                .colour6 {
-                background: #b7dde1
-                }
-                
+    def file_signature(self):
+        """ (mtime, size) of every input file, changes when any of them is saved """
 
-                </style>
-                </head>
-                """
+        return file_signatures(self.file_names)
 
-def pick_colour(location):
-    """ Returns the proper colour code depending on which book the location references """
+    def load(self):
+        """ (Re)loads the input files, returns False (and keeps the old index) if that fails """
 
-    # Assume location in the form n.nnn
-    book = location.split('.')[0]
+        import hashlib
 
-    return f" colour{book}"
+        self.signature = self.file_signature()
+        try:
+            index, self.tsv = load_files(self.file_names, self.tsv_option, cache=self.cache, collation=self.collation)
+        except Exception as error:
+            print(f"Error: Could not load the index ({error})")
+            return False
+        if index.count == 0:
+            return False
 
-def create_html_line(entry, columns, book_colours):
-    """ Converts each individual index entry to html """
+        search = SearchIndex(index)
+        fields = self.fields or (('keyword', 'comment') if index.columns == 3 else ('keyword',))
+        search.build(fields)
+        html = ''.join(render(index, self.book_colours, self.page_breaks, self.header, self.embed_search)).encode()
+        etag = '"' + hashlib.blake2b(html, digest_size=16).hexdigest() + '"'
+        self.current = (index, search, html, etag, {})
+        return True
 
-    if book_colours:
-        colour = pick_colour(entry['Location'])
-    else:
-        colour = ''
+    def handle_request(self, method, target, headers=None):
+        """ Answers one request, returns (status, headers, body)
 
-    entry['Keyword'] = format_to_html(entry['Keyword'])
-    if columns == 2:
-        return f"<div class=\"row\"><div class=\"location{colour}\">{entry['Location']}</div><div class=\"keyword\">{entry['Keyword']}</div></div>\n\n"
-    if columns == 3:
-        entry['Comment'] = format_to_html(entry['Comment'])
-        return f"<div class=\"row\"><div class=\"keyword\">{entry['Keyword']}</div><div class=\"location{colour}\">{entry['Location']}</div><div class=\"comment\">{entry['Comment']}</div></div>\n\n"
+            GET / (or /index.html)  the rendered index
+            GET /search?q=...&field=k|c|b&limit=n  search results as JSON
+            GET /status  number of entries and input files as JSON """
 
-def get_first_letter(keyword):
-    """ Get the first character that is actually part of the keyword (i.e. not punctuation!) """
+        import gzip
+        import urllib.parse
 
-    char_i = 0
-    while char_i < len(keyword):
-        if keyword[char_i] == ';':
-            char_i = keyword.index(' ', char_i) + 1 # First space after this char
-            continue
-        elif keyword[char_i] == "*":
-            char_i += 1
-            continue
+        headers = headers or {}
+        if method not in ('GET', 'HEAD'):
+            return self.json_response(405, {"error": "Only GET and HEAD are supported"}, [('Allow', 'GET, HEAD')])
+        if self.current is None:
+            return self.json_response(503, {"error": "No index loaded"})
+        index, search, html, etag, compressed = self.current
+
+        path, _, query = target.partition('?')
+        params = urllib.parse.parse_qs(query)
+
+        if path in ('/', '/index.html'):
+            response_headers = [('Content-Type', 'text/html; charset=utf-8'), ('ETag', etag), ('Cache-Control', 'no-cache')]
+            if headers.get('if-none-match') == etag:
+                return 304, response_headers, b''
+            if 'gzip' in headers.get('accept-encoding', ''):
+                if 'gzip' not in compressed:
+                    compressed['gzip'] = gzip.compress(html, 6)
+                response_headers.append(('Content-Encoding', 'gzip'))
+                return 200, response_headers, compressed['gzip']
+            return 200, response_headers, html
+
+        if path == '/search':
+            term = params.get('q', [''])[0].strip()
+            fields = self.fields or (('keyword', 'comment') if index.columns == 3 else ('keyword',))
+            if 'field' in params:
+                fields = parse_fields(params['field'][0])
+                if fields is None:
+                    return self.json_response(400, {"error": "field must be keyword, comment or both"})
+            limit = self.limit
+            if 'limit' in params:
+                if not params['limit'][0].isdigit():
+                    return self.json_response(400, {"error": "limit must be a number"})
+                limit = int(params['limit'][0]) or None
+            positions = search.search(term, fields, limit) if term else []
+            return self.json_response(200, {"query": term, "results": results_to_json(index, positions)})
+
+        if path == '/status':
+            return self.json_response(200, {"entries": index.count, "columns": index.columns, "files": self.file_names})
+
+        return self.json_response(404, {"error": f"Not found: {path}"})
+
+    def json_response(self, status, data, extra_headers=()):
+        """ (status, headers, body) for a JSON reply """
+
+        import json
+
+        return status, [('Content-Type', 'application/json'), *extra_headers], json.dumps(data).encode()
+
+    async def handle_connection(self, reader, writer):
+        """ Reads requests off one connection (keeping it alive between requests) and writes the replies """
+
+        import asyncio
+
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), SERVER_KEEP_ALIVE)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    writer.write(self.format_response(431, [], b'', 'GET', False))
+                    break
+
+                lines = head.decode('latin-1').split('\r\n')
+                request_line = lines[0].split()
+                if len(request_line) != 3 or not request_line[2].startswith('HTTP/'):
+                    writer.write(self.format_response(400, [], b'', 'GET', False))
+                    break
+                method, target, version = request_line
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(':')
+                    if name:
+                        headers[name.strip().lower()] = value.strip()
+
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection != 'close' and (version != 'HTTP/1.0' or connection == 'keep-alive')
+                # There is nothing to do with a request body, don't let it be read as the next request
+                if headers.get('content-length', '0') != '0' or 'transfer-encoding' in headers:
+                    keep_alive = False
+
+                status, response_headers, body = self.handle_request(method, target, headers)
+                writer.write(self.format_response(status, response_headers, body, method, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def format_response(self, status, headers, body, method, keep_alive):
+        """ Encodes a reply, the body is left out for HEAD requests """
+
+        import http
+
+        lines = [f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}"]
+        lines.extend(f"{name}: {value}" for name, value in headers)
+        lines.append(f"Content-Length: {len(body)}")
+        lines.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+        response = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        if method == 'HEAD':
+            return response
+        return response + body
+
+    async def watch(self, interval=SERVER_RELOAD_INTERVAL):
+        """ Reloads the index whenever one of the input files changes """
+
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            if self.file_signature() != self.signature:
+                print("Input changed, reloading")
+                if await loop.run_in_executor(None, self.load):
+                    print(f"Serving {self.current[0].count} entries")
+
+    async def start(self, host='127.0.0.1', port=8000):
+        """ Starts listening (port 0 picks a free port), returns the asyncio server """
+
+        import asyncio
+
+        return await asyncio.start_server(self.handle_connection, host, port, limit=SERVER_MAX_HEAD)
+
+    async def run(self, host, port):
+        """ Serves until interrupted """
+
+        import asyncio
+
+        server = await self.start(host, port)
+        watcher = asyncio.create_task(self.watch())
+        for sock in server.sockets:
+            print(f"Serving {self.current[0].count} entries on http://{sock.getsockname()[0]}:{sock.getsockname()[1]}/")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            watcher.cancel()
+
+def serve(file_names, address, tsv=False, book_colours=False, page_breaks=False, header='', cache=True, fields=None, limit=None,
+          collation=None, embed_search=False):
+    """ Runs the HTTP server until Ctrl-C, returns False if it could not start """
+
+    import asyncio
+
+    host, port = address
+    server = IndexServer(file_names, tsv, book_colours, page_breaks, header, cache, fields, limit or SERVER_SEARCH_LIMIT, collation,
+                         embed_search)
+    if not server.load():
+        return False
+    try:
+        asyncio.run(server.run(host, port))
+    except KeyboardInterrupt:
+        print("Server stopped")
+    except OSError as error:
+        print(f"Error: Could not start the server ({error})")
+        return False
+    return True
+
+### Watch Mode
+# --watch keeps the index, the HTML of every entry and the written sections in memory. When a markdown file is saved
+# only its changed lines are parsed again, their entries are taken out of / put into the sorted index with bisect,
+# and the outputs are written again from what is kept (only the sections that changed are joined again)
+
+WATCH_INTERVAL = 0.05 # Seconds between checks for changes to the input files
+WATCH_DEBOUNCE = 0.05 # Seconds the files must stay the same before rebuilding (editors often save in several writes)
+WATCH_MAX_CHANGES = 5000 # Changed entries above which the files are simply loaded again
+
+def common_prefix(old, new):
+    """ Length of the common start of two bytes objects """
+
+    # Bisect on the length, only comparing the part not already known to match
+    low, high = 0, min(len(old), len(new))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if old.startswith(new[low:middle], low):
+            low = middle
         else:
-            return keyword[char_i]
-        
+            high = middle - 1
+    return low
 
-def create_html(index, book_colours, columns, page_breaks, header):
-    """ Creates the HTML file """
+def common_suffix(old, new, limit):
+    """ Length of the common end of two bytes objects (at most limit) """
 
-    html_file = create_html_head()
-    html_file += add_print_css(columns)
-    html_file += add_print_css2()
-    
-    # Add title if desired
-    if header:
-        html_file += f"<h1>{header}</h1>"
-    
-    # Create first table:
-    html_file += """<section class="table">"""
+    low, high = 0, min(len(old), len(new), limit)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if old.endswith(new[len(new) - middle:len(new) - low], 0, len(old) - low):
+            low = middle
+        else:
+            high = middle - 1
+    return low
 
-    # Add each index entry, checking for new start letters
-    current_char = ''
-    non_alpha_char = False
-    for entry in index.entries:
-        test_letter = get_first_letter(entry['Keyword']).upper()
+def changed_lines(old, new):
+    """ (start, old_stop, new_stop): the whole lines old[start:old_stop] became new[start:new_stop], the rest is the same """
 
-        # We haven't seen a non alphabetical character
-        if not non_alpha_char and not test_letter.isalpha(): 
-            non_alpha_char = True
-            if columns == 2:
-                html_file += f"""<div class=\"row\"><div class=\"alphabet\"><h1>#./!</h1></div><div></div></div>"""
-            else:
-                html_file += f"""<div class=\"row\"><div></div><div class=\"alphabet\"><h1>#./!</h1></div><div></div></div>"""
+    prefix = common_prefix(old, new)
+    suffix = common_suffix(old, new, min(len(old), len(new)) - prefix)
+    start = old.rfind(b'\n', 0, prefix) + 1
+    # The end is moved to the start of the line after the change (in the common part, so the same in both)
+    line_end = old.find(b'\n', len(old) - suffix)
+    tail = 0 if line_end < 0 else len(old) - line_end - 1
+    return start, len(old) - tail, len(new) - tail
 
-        if test_letter.isalpha() and not non_alpha_char: # Didn't have non alpha char
-            non_alpha_char = True # Don't go through this path second time
-            if test_letter != current_char:
-                current_char = test_letter
+def decode_input(data):
+    """ Text of part of an input file, decoded like open_input does """
 
-                if columns == 2:
-                    html_file += f"""<div class=\"row\"><div class=\"alphabet\"><h1>{current_char}</h1></div><div></div></div>"""
-                else:
-                    html_file += f"""<div class=\"row\"><div></div><div class=\"alphabet\"><h1>{current_char}</h1></div><div></div></div>"""
+    return io.TextIOWrapper(io.BytesIO(data)).read()
 
+def entry_tuples(index):
+    """ (keyword, location, comment) of every entry """
 
-        # The rest of the Alphabetical entries 
-        elif test_letter.isalpha(): 
-            if test_letter != current_char:
-                current_char = test_letter
+    return list(zip(index.keywords, index.locations, index.comments))
 
-                # Page Breaks
-                if page_breaks:
-                    if columns == 2:
-                        html_file += f"""</section><section class="table"><div class=\"row\"><div class=\"alphabet\"><h1>{current_char}</h1></div><div></div></div>"""
-                    else:
-                        html_file += f"""</section><section class="table"><div class=\"row\"><div></div><div class=\"alphabet\"><h1>{current_char}</h1></div><div></div></div>"""
-                else:
-                    if columns == 2:
-                        html_file += f"""<div class=\"row\"><div class=\"alphabet\"><h1>{current_char}</h1></div><div></div></div>"""
-                    else:
-                        html_file += f"""<div class=\"row\"><div></div><div class=\"alphabet\"><h1>{current_char}</h1></div><div></div></div>"""
-                    
-        html_file += create_html_line(entry, columns, book_colours)
+def split_matched(entries, matched):
+    """ (positions of the other entries, the matched entries in order) for the entries in matched (a Counter, used up) """
 
-    return html_file
+    positions = []
+    found = []
+    for position, entry in enumerate(entries):
+        if matched[entry] > 0:
+            matched[entry] -= 1
+            found.append(entry)
+        else:
+            positions.append(position)
+    return positions, found
 
-def print_html(index, book_colours, file_name, page_breaks, header=''):
-    """ Outputs a HTML File """
+class CachedHtmlOutput():
+    """ Writes the index HTML like HtmlOutput, reusing the encoded HTML of the sections that are the same as last time
 
-    columns = index.columns
-    html_file = ""
-    html_file += create_html(index, book_colours, columns, page_breaks, header)
-    html_file += "</section></body></html>"
+        Only the file after the first changed section is written again, in place (much quicker than a new file) """
 
-    #Write the file
-    write_file(html_file, file_name)
-    
+    stage = 'render'
+
+    def __init__(self, file_name, columns, header=''):
+        self.file_name = file_name
+        self.head = ''.join(iter_html_head(columns, header)).encode()
+        self.tail = b"</section></body></html>"
+        self.sections = {}
+        # What was written last time, and the (size, mtime) it left the file with
+        self.written = []
+        self.written_stat = None
+
+    def start(self):
+        self.previous = self.sections
+        self.sections = {}
+        self.parts = [self.head]
+        self.rendered = 0
 
-def write_file(index_html, file_name):
-    """ Writes the file to disk """
+    def section(self, index, heading, start, stop, rows):
+        # The rows of unchanged entries are the same str objects, so comparing them is quick
+        key = (heading, tuple(rows))
+        html = self.previous.get(key)
+        if html is None:
+            html = (heading + ''.join(rows)).encode()
+            self.rendered += 1
+        self.sections[key] = html
+        self.parts.append(html)
 
-    with open(file_name, "w") as fo_write:
-        fo_write.write(index_html)
-    print(f"{file_name[:file_name.index('.')].title()} written as {file_name}")
+    def file_stat(self):
+        try:
+            stat = os.stat(self.file_name)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def finish(self):
+        parts = self.parts
+        parts.append(self.tail)
+        # Skip the sections at the start that haven't changed, if the file is still the one written last time
+        same = 0
+        offset = 0
+        if self.written and self.file_stat() == self.written_stat:
+            for part, written in zip(parts, self.written):
+                if part is not written:
+                    break
+                same += 1
+                offset += len(part)
+        with profile_stage('write') as metrics, open(self.file_name, 'r+b' if same else 'wb') as fo:
+            fo.seek(offset)
+            fo.writelines(parts[same:])
+            fo.truncate()
+            metrics['file'] = self.file_name
+        self.written = parts
+        self.written_stat = self.file_stat()
+        self.previous = self.parts = None
+        print(f"{output_name(self.file_name)} written as {self.file_name} ({self.rendered} of {len(self.sections)} sections changed)")
+
+class IndexWatcher():
+    """ Builds the outputs, then updates them whenever the input files change (see run)
+
+        Changed markdown files are updated entry by entry (see update_file). Anything else (TSV files, files
+        appearing or disappearing, a change in the number of columns, large edits...) loads everything again """
+
+    def __init__(self, input_names, tsv=False, book_colours=False, page_breaks=False, header='', report_formats=None,
+                 duplicates=False, cache=True, jobs=None, collation=None):
+        self.input_names = input_names
+        self.tsv_option = tsv
+        self.book_colours = book_colours
+        self.page_breaks = page_breaks
+        self.header = header
+        self.report_formats = report_formats
+        self.duplicates = duplicates
+        self.cache = cache
+        self.jobs = jobs
+        self.collation = collation
+        self.file_names = []
+        self.signature = None
+        self.index = Index()
+        self.contents = {}
+
+    def current_signature(self):
+        """ (input files, their signatures), the input files can change when directories or globs are watched """
+
+        file_names = expand_input_files(self.input_names)
+        return file_names, file_signatures(file_names)
+
+    def load(self):
+        """ Loads every input file and writes all the outputs, returns False if there is nothing to write """
+
+        # Read the files until they don't change while being read, their contents have to match the index
+        while True:
+            self.file_names, signature = self.current_signature()
+            if None in signature:
+                print(f"Warning: Waiting for {self.file_names[signature.index(None)]}")
+                self.signature = (self.file_names, signature)
+                return False
+            contents = {}
+            for file_name in self.file_names:
+                with open(file_name, 'rb') as fo:
+                    contents[file_name] = fo.read()
+            self.index, self.tsv = load_files(self.file_names, self.tsv_option, jobs=self.jobs, cache=self.cache,
+                                              collation=self.collation)
+            if self.current_signature() == (self.file_names, signature):
+                break
+        self.signature = (self.file_names, signature)
+        # Only markdown files are updated line by line
+        self.contents = {} if self.tsv else {file_name: data for file_name, data in contents.items() if not data.startswith(b'\x1f\x8b')}
+        if self.index.count == 0:
+            return False
+
+        index = self.index
+        self.rows = list(map(create_html_row, index.keywords, index.locations, index.comments,
+                             itertools.repeat(index.columns), itertools.repeat(self.book_colours)))
+        self.html = CachedHtmlOutput("index.html", index.columns, self.header)
+        self.report = ReportOutput(index.columns, self.tsv, self.report_formats) if self.report_formats else None
+        if self.duplicates:
+            self.duplicate_counts = collections.Counter(map(duplicate_key, index.plain_keywords))
+        outputs = [self.report] if self.report else []
+        if self.duplicates:
+            outputs.append(DuplicatesOutput(index, "duplicates.html"))
+        outputs.append(self.html)
+        write_outputs(index, outputs, self.book_colours, self.page_breaks, entry_rows=self.rows)
+        return True
+
+    def update_file(self, file_name):
+        """ (removed, added): indexes of the entries that left and joined file_name since it was last read
+
+            None if the file can't be updated entry by entry """
+
+        if file_name not in self.contents:
+            return None
+        with open(file_name, 'rb') as fo:
+            new = fo.read()
+        old = self.contents[file_name]
+        start, old_stop, new_stop = changed_lines(old, new)
+        removed, _ = parse_text(decode_input(old[start:old_stop]))
+        added, bad_lines = parse_text(decode_input(new[start:new_stop]))
+        # Maybe a TSV file now, let load_files decide
+        if any("\t" in line for _, line in bad_lines):
+            return None
+        line_offset = old.count(b'\n', 0, start)
+        print_bad_lines(file_name, [(line_offset + line_number, line) for line_number, line in bad_lines], len(bad_lines))
+        self.contents[file_name] = new
+        removed.normalize(self.collation)
+        added.normalize(self.collation)
+
+        # Entries both removed and added (the unchanged lines between two edits, moved lines) stay where they are,
+        # unless they were moved around entries with the same sort key (whose order follows the lines)
+        removed_entries = entry_tuples(removed)
+        added_entries = entry_tuples(added)
+        same = collections.Counter(removed_entries) & collections.Counter(added_entries)
+        if same:
+            removed_positions, removed_same = split_matched(removed_entries, same.copy())
+            added_positions, added_same = split_matched(added_entries, same)
+            if removed_same != added_same:
+                for entry, key in zip(removed_entries, removed.sort_keys):
+                    if entry in same and self.tied(key, entry):
+                        return None
+            removed = removed.subset(removed_positions)
+            added = added.subset(added_positions)
+        return removed, added
+
+    def tied(self, key, entry):
+        """ True if the index has a different entry with this sort key (entries with the same key are in input file order) """
+
+        index = self.index
+        low = bisect.bisect_left(index.sort_keys, key)
+        high = bisect.bisect_right(index.sort_keys, key, low)
+        return any(found != entry for found in zip(index.keywords[low:high], index.locations[low:high], index.comments[low:high]))
+
+    def apply(self, removed, added):
+        """ Takes the removed entries out of the index and puts the added ones in their sorted place, with their HTML
+
+            Returns False if that can't be done exactly like a full load, the index is then out of date """
+
+        index = self.index
+        names = index.column_names()
+        sort_keys = index.sort_keys
+
+        for position, entry in enumerate(entry_tuples(removed)):
+            key = removed.sort_keys[position]
+            low = bisect.bisect_left(sort_keys, key)
+            high = bisect.bisect_right(sort_keys, key, low)
+            tied = list(zip(index.keywords[low:high], index.locations[low:high], index.comments[low:high]))
+            if entry not in tied:
+                return False
+            # Which of several copies came from this file only matters if there are other entries between them
+            if tied.count(entry) > 1 and tied.count(entry) < len(tied):
+                return False
+            found = low + tied.index(entry)
+            for name in names:
+                del getattr(index, name)[found]
+            del self.rows[found]
+
+        for position, entry in enumerate(entry_tuples(added)):
+            key = added.sort_keys[position]
+            # Where it goes among different entries with the same sort key depends on the input files, load them again
+            if self.tied(key, entry):
+                return False
+            high = bisect.bisect_right(sort_keys, key)
+            for name in names:
+                getattr(index, name).insert(high, getattr(added, name)[position])
+            self.rows.insert(high, create_html_row(*entry, index.columns, self.book_colours))
+        return True
+
+    def update(self):
+        """ Brings the index and the outputs up to date with the input files """
+
+        start = time.perf_counter()
+        file_names, signature = self.current_signature()
+        if None in signature:
+            print(f"Warning: Waiting for {file_names[signature.index(None)]}")
+            self.signature = (file_names, signature)
+            return
+        changes = None
+        if file_names == self.file_names and self.index.count:
+            changed = [file_name for file_name, old, new in zip(file_names, self.signature[1], signature) if old != new]
+            self.signature = (file_names, signature)
+            changes = []
+            for file_name in changed:
+                change = self.update_file(file_name)
+                if change is None:
+                    changes = None
+                    break
+                changes.append(change)
+        if changes is not None:
+            changes = self.apply_changes(changes)
+        if changes is None:
+            print("Loading the index again")
+            self.load()
+        elif any(changes):
+            print(f"Updated {changes[0]} added and {changes[1]} removed entries in {(time.perf_counter() - start) * 1000:.0f} ms")
+        else:
+            print("No entries changed")
+
+    def apply_changes(self, changes):
+        """ Applies the (removed, added) changes of each file and writes the outputs they affect
+
+            Returns (added, removed) entry counts, None if the index has to be loaded again """
+
+        index = self.index
+        added_count = sum(added.count for _, added in changes)
+        removed_count = sum(removed.count for removed, _ in changes)
+        if not added_count and not removed_count:
+            return 0, 0
+        if added_count + removed_count > WATCH_MAX_CHANGES or removed_count >= index.count:
+            return None
+        # A first comment changes the layout of every row
+        if index.columns == 2 and any(any(added.comments) for _, added in changes):
+            return None
+
+        duplicates_changed = False
+        for removed, added in changes:
+            if not self.apply(removed, added):
+                return None
+            if self.report:
+                self.report.remove(removed, 0, removed.count)
+                new_letter = any(letter not in self.report.alphabet_entries for letter in count_letters(added.letters))
+                self.report.section(added, '', 0, added.count, [])
+                if new_letter:
+                    # Letters are listed in index order
+                    self.report.alphabet_entries = count_letters(index.letters)
+            if self.duplicates:
+                counts = self.duplicate_counts
+                removed_keys = list(map(duplicate_key, removed.plain_keywords))
+                added_keys = list(map(duplicate_key, added.plain_keywords))
+                duplicates_changed = duplicates_changed or any(counts[key] > 1 for key in removed_keys + added_keys if key)
+                counts.subtract(removed_keys)
+                counts.update(added_keys)
+                duplicates_changed = duplicates_changed or any(counts[key] > 1 for key in added_keys if key)
+        if index.columns == 3 and not any(index.comments):
+            return None
+
+        if self.report:
+            self.report.finish()
+        outputs = []
+        if duplicates_changed:
+            outputs.append(DuplicatesOutput(index, "duplicates.html"))
+        outputs.append(self.html)
+        write_outputs(index, outputs, self.book_colours, self.page_breaks, entry_rows=self.rows)
+        return added_count, removed_count
+
+    def run(self, interval=WATCH_INTERVAL, debounce=WATCH_DEBOUNCE):
+        """ Checks the input files every interval seconds, updating once they have stopped changing for debounce seconds """
+
+        while True:
+            time.sleep(interval)
+            signature = self.current_signature()
+            if signature == self.signature:
+                continue
+            while True:
+                time.sleep(debounce)
+                settled = self.current_signature()
+                if settled == signature:
+                    break
+                signature = settled
+            with profile_stage('watch_update') as metrics:
+                self.update()
+                metrics['entries'] = self.index.count if self.file_names else 0
+
+def watch(input_names, tsv=False, book_colours=False, page_breaks=False, header='', report_formats=None, duplicates=False,
+          cache=True, jobs=None, collation=None):
+    """ Writes the outputs, then keeps them up to date as the input files (names, directories or globs) change, until Ctrl-C """
+
+    watcher = IndexWatcher(input_names, tsv, book_colours, page_breaks, header, report_formats, duplicates, cache, jobs, collation)
+    watcher.load()
+    print("Watching for changes, Ctrl-C to stop")
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        print("Stopped watching")
+
+### Library API
+# For scripts importing indexer, e.g.
+#   index = indexer.load(['book1.md', 'book2.md'])
+#   for entry in indexer.search(index, 'linux kern*', limit=10): print(entry.keyword, entry.location)
+#   for entry in indexer.locate(index, '2.40-75'): print(entry.location, entry.keyword)
+#   indexer.build('index.md', 'out/index.html', book_colours=True, report='out/report')
+#   for result in indexer.run_batch([{'inputs': 'a.md', 'output': 'a.html'}, ...]): ...
+# Nothing heavy is imported until a function needs it, so importing indexer is cheap.
+
+# Search and location indexes built by search(), locate() and gaps(), kept for as long as their index exists
+_search_indexes = weakref.WeakKeyDictionary()
+_location_indexes = weakref.WeakKeyDictionary()
+
+def quiet_output(quiet):
+    """ Context manager hiding the indexer's messages when quiet is True """
+
+    if quiet:
+        return contextlib.redirect_stdout(io.StringIO())
+    return contextlib.nullcontext()
+
+def load(file_names, tsv=False, cache=True, jobs=None, quiet=False, collation=None):
+    """ Loads input files (a path or list of paths, directories or globs) into one Index sorted by collation (see Collation)
+
+        Raises FileNotFoundError if there are no input files, ValueError if no entries could be loaded """
+
+    if isinstance(file_names, (str, os.PathLike)):
+        file_names = [file_names]
+    file_names = expand_input_files([os.fspath(file_name) for file_name in file_names])
+    if not file_names:
+        raise FileNotFoundError("No input files found")
+    with quiet_output(quiet):
+        index, tsv = load_files(file_names, tsv, jobs=jobs, cache=cache, collation=collation)
+    if index.count == 0:
+        raise ValueError(f"No entries could be loaded from {', '.join(file_names)}")
+    return index
+
+def sort(index, key=None, collation=None):
+    """ Sorts the index in place (normalizing it first if needed, or again with a different collation) and returns it
+
+        key is called with an Entry, without one the index is sorted on its sort keys (see Collation) """
+
+    if collation is not None or not index.normalized:
+        index.normalize(collation)
+    index.sort(key)
+    return index
+
+def search(index, query, fields=None, limit=None):
+    """ Entries matching query (every word must match, word* matches the start), best matches first
+
+        fields is a tuple of 'keyword' and/or 'comment' (default: both for 3 column indexes) """
+
+    # Built again if entries were added, sorted or normalized since
+    version, search_index = _search_indexes.get(index, (None, None))
+    if version != (index.version, index.count):
+        search_index = SearchIndex(index)
+        _search_indexes[index] = ((index.version, index.count), search_index)
+    if fields is None:
+        fields = ('keyword', 'comment') if index.columns == 3 else ('keyword',)
+    return search_index.search_entries(query, fields, limit)
+
+def location_index(index):
+    """ The LocationIndex of index, built again if entries were added, sorted or normalized since the last one """
+
+    version, locations = _location_indexes.get(index, (None, None))
+    if version != (index.version, index.count):
+        locations = LocationIndex(index)
+        _location_indexes[index] = ((index.version, index.count), locations)
+    return locations
+
+def locate(index, locations):
+    """ Entries at locations, in location order: a page '2.40', pages '2.40-75' or '2.40-3.10', a book '3' or books '2-3'
+
+        Raises ValueError if locations isn't one of those """
+
+    location_positions = location_index(index).query(locations)
+    if location_positions is None:
+        raise ValueError(f"Unknown location {locations!r}, use e.g. 2.40, 2.40-75, 2.40-3.10 or 3")
+    return [Entry(index, position) for position in location_positions]
+
+def gaps(index, locations=None):
+    """ Pages without entries as {book: [[first, last], ...]} for locations (as for locate, default every book)
+
+        A book is checked between its first and last pages with entries, a range of pages from its start to its end """
+
+    book_gaps = location_index(index).query_gaps(locations)
+    if book_gaps is None:
+        raise ValueError(f"Unknown location {locations!r}, use e.g. 2.40-75, 2.40-3.10 or 3")
+    return book_gaps
+
+def render(index, book_colours=False, page_breaks=False, header='', search=False):
+    """ The index as HTML, generated piece by piece (join it or write it out as it comes)
+
+        search embeds a search box and its data (see EmbeddedSearch) """
+
+    yield from iter_html(index, book_colours, index.columns, page_breaks, header, search=search)
+    yield "</section>"
+    if search:
+        embedded = EmbeddedSearch()
+        embedded.add(index.plain_keywords, index.comments)
+        yield from embedded.iter_html()
+    yield "</body></html>"
+
+def report(index, tsv=False):
+    """ Report statistics as a dict (see report_stats) """
+
+    return report_stats(index, tsv)
+
+def build(inputs, output='index.html', tsv=False, book_colours=False, page_breaks=False, header='',
+          duplicates=None, report=None, report_formats=('html',), cache=True, incremental=False, quiet=True, collation=None,
+          split=None, jobs=None, search=False):
+    """ Loads inputs (see load) and writes the index to output, like running the script once
+
+        duplicates is the file name for the duplicates HTML, report the file name (without extension)
+        for the report in report_formats, collation a Collation or its options as for --collation,
+        split 'letter' or a number of entries per page to split the index (see print_html_split),
+        jobs the number of processes loading and rendering (default one per CPU), search True to embed a search box
+        (see EmbeddedSearch, not with split or incremental). Returns a dict describing what was written """
+
+    start = time.perf_counter()
+    if isinstance(collation, str):
+        options = collation
+        collation = parse_collation(options)
+        if collation is None:
+            raise ValueError(f"Unknown collation {options!r}, use some of {', '.join(COLLATION_OPTIONS)}")
+    if search and (split or incremental):
+        raise ValueError("search can't be combined with split or incremental")
+    per_page = None
+    if split and split != SPLIT_LETTER:
+        per_page = int(split)
+        if per_page < 1:
+            raise ValueError(f"split must be {SPLIT_LETTER!r} or a number of entries per page, not {split!r}")
+    with quiet_output(quiet):
+        file_names = [inputs] if isinstance(inputs, (str, os.PathLike)) else inputs
+        file_names = expand_input_files([os.fspath(file_name) for file_name in file_names])
+        if not file_names:
+            raise FileNotFoundError("No input files found")
+        index, tsv = load_files(file_names, tsv, jobs=jobs, cache=cache, collation=collation)
+        if index.count == 0:
+            raise ValueError(f"No entries could be loaded from {', '.join(file_names)}")
+
+        output_html = print_html_incremental if incremental else functools.partial(print_html, jobs=jobs)
+        written = []
+        if report:
+            written += [f"{report}.{report_format}" for report_format in report_formats]
+        if duplicates:
+            written.append(duplicates)
+        if split or incremental:
+            if report:
+                create_report(index, tsv, report_formats, report)
+            if duplicates:
+                output_html(find_duplicates(index), book_colours, duplicates, False)
+        if split:
+            written += print_html_split(index, book_colours, output, page_breaks, header, per_page, jobs)
+        elif incremental:
+            output_html(index, book_colours, output, page_breaks, header)
+            written.append(output)
+        else:
+            # Everything in one pass over the index, like the command line
+            outputs = []
+            if report:
+                outputs.append(ReportOutput(index.columns, tsv, report_formats, report))
+            if duplicates:
+                outputs.append(DuplicatesOutput(index, duplicates, summary=False))
+            outputs.append(HtmlOutput(output, index.columns, header, search))
+            write_outputs(index, outputs, book_colours, page_breaks, render_jobs(index, jobs))
+            written.append(output)
+
+    return {"inputs": file_names, "entries": index.count, "columns": index.columns, "tsv": tsv,
+            "written": written, "seconds": round(time.perf_counter() - start, 3)}
+
+def run_batch(jobs, quiet=True):
+    """ Runs build() for each job (a dict of build's arguments) in this process, one after the other
+
+        Generates one result per job: build's dict plus "job" (its number) and "error" (None if it worked) """
+
+    for number, job in enumerate(jobs, 1):
+        try:
+            result = build(**job, quiet=quiet)
+        except Exception as error:
+            result = {"inputs": job.get("inputs") if isinstance(job, dict) else None, "error": f"{type(error).__name__}: {error}"}
+        else:
+            result["error"] = None
+        result["job"] = number
+        yield result
+
+def read_batch_jobs(fo):
+    """ Jobs from a batch file: one JSON object per line (blank lines and lines starting with # are skipped) """
+
+    import json
+
+    for line in fo:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield json.loads(line)
+
+def run_batch_file(file_name):
+    """ Runs every job in a batch file (- for stdin), printing one JSON result line per job """
+
+    import json
+
+    failed = 0
+    with (contextlib.nullcontext(sys.stdin) if file_name == '-' else open(file_name)) as fo:
+        for result in run_batch(read_batch_jobs(fo)):
+            failed += result["error"] is not None
+            print(json.dumps(result), flush=True)
+    return failed == 0
+
+def pop_option(arg_list, option, has_value=False, last=False):
+    """ Removes a long option (and its value) from arg_list
+
+        Returns the value (or True for options without one), None if the option isn't there
+        The value can only be the last arg if last is True (otherwise that's the input file) """
+
+    if option not in arg_list:
+        return None
+    position = arg_list.index(option)
+    del arg_list[position]
+    if not has_value:
+        return True
+    if position >= len(arg_list) - (0 if last else 1):
+        print(f"Error: {option} needs a value")
+        return None
+    return arg_list.pop(position)
+
+# Lines of allocation statistics written by --tracemalloc
+TRACEMALLOC_TOP = 50
 
 def start_program(arg_list):
+    """ Runs the program with the cli args, measuring it if --profile, --cprofile or --tracemalloc are given
+
+        --profile prints wall/CPU time, entries and memory per stage (to stderr),
+        --cprofile file saves cProfile stats (read them with pstats),
+        --tracemalloc file traces allocations (peak memory per stage) and saves the top allocating lines """
+
+    arg_list = list(arg_list)
+    batch_file = pop_option(arg_list, '--batch', has_value=True, last=True)
+    if batch_file:
+        return run_batch_file(batch_file)
+    profile = pop_option(arg_list, '--profile')
+    cprofile_file = pop_option(arg_list, '--cprofile', has_value=True)
+    tracemalloc_file = pop_option(arg_list, '--tracemalloc', has_value=True)
+    if not (profile or cprofile_file or tracemalloc_file):
+        return run_program(arg_list)
+
+    report = ProfileReport()
+    add_profile_hook(report)
+    profiler = None
+    if cprofile_file:
+        import cProfile
+        profiler = cProfile.Profile()
+    if tracemalloc_file:
+        import tracemalloc
+        tracemalloc.start()
+    try:
+        with profile_stage('total'):
+            if profiler:
+                result = profiler.runcall(run_program, arg_list)
+            else:
+                result = run_program(arg_list)
+    finally:
+        remove_profile_hook(report)
+        if profiler:
+            profiler.dump_stats(cprofile_file)
+            print(f"cProfile stats written as {cprofile_file}", file=sys.stderr)
+        if tracemalloc_file:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            with open(tracemalloc_file, "w") as fo_write:
+                for statistic in snapshot.statistics('lineno')[:TRACEMALLOC_TOP]:
+                    fo_write.write(f"{statistic}\n")
+            print(f"Allocation statistics written as {tracemalloc_file}", file=sys.stderr)
+        if profile:
+            report.print_report()
+    return result
+
+def run_program(arg_list):
     """ Calls appropriate functions based on cli args """
 
     book_colours = False
@@ -623,15 +4048,45 @@ def start_program(arg_list):
     page_breaks = False
     header = ''
     
+    # Long options (e.g. --no-cache) can go anywhere
+    arg_list = list(arg_list)
+    use_cache = not pop_option(arg_list, '--no-cache')
+    incremental = pop_option(arg_list, '--incremental')
+    # Search options
+    queries_file = pop_option(arg_list, '--queries', has_value=True)
+    output_format = pop_option(arg_list, '--format', has_value=True) or 'tsv'
+    search_fields = pop_option(arg_list, '--field', has_value=True)
+    search_limit = pop_option(arg_list, '--limit', has_value=True)
+    # Location queries
+    page_queries = pop_option(arg_list, '--pages', has_value=True)
+    gap_queries = pop_option(arg_list, '--gaps', has_value=True)
+    report_formats = pop_option(arg_list, '--report-format', has_value=True) or 'html'
+    near_duplicates = pop_option(arg_list, '--near-duplicates')
+    similarity = pop_option(arg_list, '--similarity', has_value=True)
+    split = pop_option(arg_list, '--split', has_value=True)
+    jobs = pop_option(arg_list, '--jobs', has_value=True)
+    max_memory = pop_option(arg_list, '--max-memory', has_value=True)
+    embed_search = pop_option(arg_list, '--embed-search')
+    # Sort order
+    collation_options = pop_option(arg_list, '--collation', has_value=True)
+    locale_name = pop_option(arg_list, '--locale', has_value=True)
+    # Server mode
+    serve_address = pop_option(arg_list, '--serve', has_value=True)
+    watch_files = pop_option(arg_list, '--watch')
+
     # Check for header flag and get the title
     if '-h' in arg_list[:-1]:
         header = ' '.join(arg_list[arg_list.index('-h')+1:-1])
         
     # Check args, -h flag must come last
     if '-h' in arg_list:
-        flags = ''.join(arg_list[:arg_list.index('-h')])
+        options = arg_list[:arg_list.index('-h')]
     else:
-        flags = ''.join(arg_list[:-1])
+        options = arg_list[:-1]
+    flags = ''.join(option for option in options if option.startswith('-'))
+    # Input files (or directories/globs): any other args before -h, and always the last arg
+    input_names = [option for option in options if not option.startswith('-')] + arg_list[-1:]
+    file_names = expand_input_files(input_names)
     if '-' in flags:
         if 'c' in flags:
             book_colours = True
@@ -646,53 +4101,220 @@ def start_program(arg_list):
         if 'p' in flags:
             page_breaks = True
 
-    ### Load the file into memory        
-    # Markdown File
-    if not tsv:
-        # Failsafe to check if user forgot TSV flag
+    ### Load the file(s) into memory, sorted
+    if not file_names:
+        print("Error: No input files found")
+        return True
+    # Search options are checked before anything is loaded
+    if output_format not in ('tsv', 'json'):
+        print("Error: --format must be tsv or json")
+        return True
+    if search_fields is not None:
+        search_fields = parse_fields(search_fields)
+        if search_fields is None:
+            print("Error: --field must be keyword, comment or both")
+            return True
+    if search_limit is not None:
+        if not search_limit.isdigit():
+            print("Error: --limit must be a number")
+            return True
+        search_limit = int(search_limit) or None
+
+    location_queries = [query for query in (page_queries or '').split(',') if query.strip()]
+    if gap_queries is not None:
+        gap_queries = [None] if gap_queries.strip().lower() == 'all' else [query for query in gap_queries.split(',') if query.strip()]
+    for query in location_queries + (gap_queries or []):
+        if query is not None and parse_location_range(query) is None:
+            print(f"Error: Unknown location {query}, use e.g. 2.40, 2.40-75, 2.40-3.10 or 3 (books, or all for --gaps)")
+            return True
+
+    report_formats = report_formats.lower().split(',')
+    if not set(report_formats) <= set(REPORT_FORMATS):
+        print(f"Error: --report-format must be one or more of {', '.join(REPORT_FORMATS)} (e.g. html,json)")
+        return True
+    if similarity is not None:
         try:
-            # Load index from file and sort it
-            index = parse_file(arg_list[-1])
-        except AttributeError:
-            tsv = True
-            print("Warning: -t TSV flag not used but input appears to be TSV file")
-        else:
-            # Sort key is 'Keyword' (need to remove formatting and color formatting)
-            index.entries.sort(key=lambda dict_entry: strip_formatting(dict_entry['Keyword'].lower()))
-
-    # TSV File
-    if tsv:
-        index = load_file_tsv(arg_list[-1])
-        # If len(index)==0 then error in loading TSV file
-        if len(index.entries) == 0:
+            similarity = float(similarity)
+        except ValueError:
+            similarity = -1
+        if not 0 < similarity <= 1:
+            print("Error: --similarity must be a number between 0 and 1")
+            return True
+    else:
+        similarity = NEAR_SIMILARITY
+    if jobs is not None:
+        if not jobs.isdigit() or int(jobs) < 1:
+            print("Error: --jobs must be a number of processes")
+            return True
+        jobs = int(jobs)
+    per_page = None
+    if split is not None:
+        if split.isdigit() and int(split) > 0:
+            per_page = int(split)
+        elif split != SPLIT_LETTER:
+            print("Error: --split must be letter or a number of entries per page")
+            return True
+        if incremental:
+            print("Error: --incremental can't be combined with --split")
+            return True
+    if watch_files and (search or queries_file or page_queries is not None or gap_queries is not None or serve_address or
+                        near_duplicates or split or incremental or max_memory or embed_search):
+        print("Error: --watch writes index.html (and -r, -d), it can't be combined with -s, --queries, --pages, --gaps, "
+              "--serve, --near-duplicates, --split, --incremental, --max-memory or --embed-search")
+        return True
+    if embed_search and (split or incremental):
+        print("Error: --embed-search can't be combined with --split or --incremental")
+        return True
+    if max_memory is not None:
+        max_memory = parse_size(max_memory)
+        if not max_memory:
+            print("Error: --max-memory must be a size, e.g. 200M or 2G")
+            return True
+        if search or queries_file or duplicates or near_duplicates or serve_address or incremental or split or \
+                page_queries is not None or gap_queries is not None or embed_search:
+            print("Error: --max-memory only writes the index (and -r report), it can't be combined with -s, -d, "
+                  "--queries, --pages, --gaps, --near-duplicates, --serve, --incremental, --split or --embed-search")
+            return True
+    collation = None
+    if collation_options is not None or locale_name is not None:
+        collation = parse_collation(collation_options or ','.join(COLLATION_OPTIONS), locale_name)
+        if collation is None:
+            print(f"Error: --collation must be one or more of {', '.join(COLLATION_OPTIONS)} (or none)")
+            return True
+        if locale_name is not None:
+            import locale
+            try:
+                collation.set_locale()
+            except locale.Error:
+                print(f"Error: Unknown locale {locale_name}")
+                return True
+
+    # Server mode loads (and reloads) the files itself
+    if serve_address:
+        address = parse_address(serve_address)
+        if address is None:
+            print("Error: --serve needs [host:]port")
             return True
-        index.entries.sort(key=lambda dict_entry: dict_entry['Keyword'].lower())
+        serve(file_names, address, tsv, book_colours, page_breaks, header, use_cache, search_fields, search_limit, collation,
+              embed_search)
+        return True
+
+    # Watch mode loads the files itself and keeps the outputs up to date
+    if watch_files:
+        watch(input_names, tsv, book_colours, page_breaks, header, report_formats if report else None, duplicates, use_cache,
+              jobs, collation)
+        return True
+
+    # Indexes bigger than memory are sorted in runs on disk and merged straight into the output
+    if max_memory:
+        with profile_stage('sort_runs') as metrics:
+            runs = sort_runs(file_names, tsv, max_memory, collation)
+            metrics['entries'] = runs.count
+        try:
+            if runs.count:
+                outputs = []
+                if report:
+                    outputs.append(ReportOutput(runs.columns, runs.tsv, report_formats))
+                outputs.append(HtmlOutput("index.html", runs.columns, header))
+                with profile_stage('merge') as metrics:
+                    write_merged_outputs(runs, outputs, book_colours, page_breaks)
+                    metrics['entries'] = runs.count
+        finally:
+            runs.close()
+        return True
+
+    # Batch search and location results go to stdout, keep the loading messages out of them
+    location_mode = page_queries is not None or gap_queries is not None
+    with contextlib.redirect_stdout(sys.stderr) if queries_file or location_mode else contextlib.nullcontext():
+        with profile_stage('load') as metrics:
+            index, tsv = load_files(file_names, tsv, jobs=jobs, cache=use_cache, collation=collation)
+            metrics['entries'] = index.count
+    # If len(index)==0 then error in loading the file
+    if index.count == 0:
+        return True
 
     ### File in memory as 'index' and is sorted
 
+    # Entries at pages and pages without entries, no files are written
+    if location_mode:
+        with profile_stage('locations') as metrics:
+            locations = LocationIndex(index)
+            for query in location_queries:
+                print_location_results(index, query, locations.query(query), output_format)
+            for query in gap_queries or []:
+                print_location_gaps(query or 'all', locations.query_gaps(query), output_format)
+            metrics['entries'] = index.count
+        return True
+
     # Run search if requested
-    if search:
-        search_index(index)
+    if search or queries_file:
+        with profile_stage('search') as metrics:
+            metrics['entries'] = index.count
+            if queries_file == '-':
+                search_batch(index, sys.stdin, output_format, search_fields, search_limit)
+            elif queries_file:
+                with open(queries_file) as fo:
+                    search_batch(index, fo, output_format, search_fields, search_limit)
+            else:
+                search_index(index, search_fields, search_limit)
         return True
     # Output Desired results
-    if report:
-        create_report(index, tsv)
-    if duplicates:
-        duplicates = find_duplicates(index)
-        print_html(duplicates, book_colours, "duplicates.html", False)
+    # The index, report and duplicates are written in one pass over the index (see write_outputs),
+    # unless the index is written a page or a changed section at a time
+    single_pass = not (incremental or split)
+    if report and not single_pass:
+        with profile_stage('report') as metrics:
+            create_report(index, tsv, report_formats)
+            metrics['entries'] = index.count
+    if incremental:
+        output_html = print_html_incremental
+    else:
+        output_html = functools.partial(print_html, jobs=jobs)
+    if duplicates and not single_pass:
+        with profile_stage('duplicates') as metrics:
+            groups = duplicate_groups(index)
+            print_duplicate_summary(index, groups)
+            duplicates = find_duplicates(index, groups)
+            metrics['entries'] = duplicates.count
+        with profile_stage('render') as metrics:
+            output_html(duplicates, book_colours, "duplicates.html", False)
+            metrics['entries'] = duplicates.count
+    if near_duplicates:
+        with profile_stage('near_duplicates') as metrics:
+            groups = near_duplicate_groups(index, similarity)
+            print(f"Found {len(groups)} groups of similar keywords")
+            metrics['entries'] = sum(len(positions) for positions in groups)
+        with profile_stage('render') as metrics:
+            write_file(iter_html_groups(index, groups, book_colours, "Near duplicates"), "similar.html")
+            metrics['entries'] = sum(len(positions) for positions in groups)
 
     # Ouput Index to HTML
-    print_html(index, book_colours, "index.html", page_breaks, header)
+    if single_pass:
+        # Each output is profiled as its own stage (render, report, duplicates), see write_outputs
+        outputs = []
+        if report:
+            outputs.append(ReportOutput(index.columns, tsv, report_formats))
+        if duplicates:
+            outputs.append(DuplicatesOutput(index, "duplicates.html"))
+        outputs.append(HtmlOutput("index.html", index.columns, header, embed_search))
+        write_outputs(index, outputs, book_colours, page_breaks, render_jobs(index, jobs))
+    else:
+        with profile_stage('render') as metrics:
+            if split:
+                print_html_split(index, book_colours, "index.html", page_breaks, header, per_page, jobs)
+            else:
+                output_html(index, book_colours, "index.html", page_breaks, header)
+            metrics['entries'] = index.count
     
 
 if __name__ == "__main__":
 
-    # Usage python3 indexer_md.py <flags> <-h "title"> <filename>
+    # Usage python3 indexer_md.py <flags> <-h "title"> <filename(s)>
     
     if len(sys.argv) > 1:
         start_program(sys.argv[1:])
     else:
-        print("Index Helper script\nUsage: $ python3 indexer.py <flags> <-h \"page title\"> <filename>\nFlags:")
+        print("Index Helper script\nUsage: $ python3 indexer.py <flags> <-h \"page title\"> <filename(s)>\nFlags:")
         print("\t-c\t colour output for book locations")
         print("\t-t\t Tab separated values file import")
         print("\t-d\t Show duplicate keyword entries")
@@ -700,4 +4322,28 @@ if __name__ == "__main__":
         print("\t-r\t Generate a report about your index (entries per book/per letter)")
         print("\t-p\t Have page breaks at each letter")
         print("\t-s\t Search your index, do not output any file")
+        print("\t--queries file\t Run every search in file (- for stdin), print the results (no other output)")
+        print("\t--format tsv|json\t Format of the --queries results")
+        print("\t--field k|c|b\t Search the keyword, comment or both")
+        print("\t--limit n\t Only show the first n results of each search")
+        print("\t--pages locations\t Print the entries at locations, e.g. 2.40-2.75 or 2.40-75 or 3 (comma separated, no other output)")
+        print("\t--gaps locations|all\t Print the pages without entries of books (e.g. 3) or page ranges (e.g. 2.1-2.200)")
+        print("\t--report-format html,json,csv\t Format(s) of the -r report (default html)")
+        print("\t--near-duplicates\t Output keywords that are similar (typos, reordered words) to similar.html")
+        print("\t--similarity n\t How similar near duplicates must be, 0 to 1 (default 0.8)")
+        print("\t--collation options\t Sort order: any of natural,accents,punctuation,location (default all) or none")
+        print("\t--locale name\t Sort words with the rules of this locale (e.g. de_DE.UTF-8)")
+        print("\t--serve [host:]port\t Serve the index (/), searches (/search?q=...) and /status over HTTP, reloading when the file changes")
+        print("\t--watch\t Write the outputs, then update them each time an input file is saved (Ctrl-C to stop)")
+        print("\t--batch file\t Build every job in file (JSON lines, - for stdin) in one process, see README")
+        print("\t--profile\t Print the time and memory used by each stage (load, parse, sort, render, write...)")
+        print("\t--cprofile file\t Save cProfile statistics of the run to file")
+        print("\t--tracemalloc file\t Trace memory allocations (peak per stage) and save the top allocations to file")
+        print("\t--no-cache\t Don't use (or update) the compiled index cache")
+        print("\t--max-memory size\t Sort on disk using about this much memory (e.g. 200M), for indexes bigger than memory "
+              "(not with -s, -d, --queries, --pages, --gaps, --near-duplicates, --serve, --incremental, --split or --embed-search)")
+        print("\t--jobs n\t Processes used to load the input files and render large indexes (default one per CPU)")
+        print("\t--embed-search\t Add a search box to index.html (or the page served by --serve), searching a word index embedded in the page")
+        print("\t--split letter|n\t Write a page per letter (or per n entries) and a navigation page as index.html")
+        print("\t--incremental\t Only re-render the letter sections that changed since the last --incremental run")
 
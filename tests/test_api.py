@@ -0,0 +1,92 @@
+"""
+test_api.py
+
+Tests for the library API (indexer.load, search, sort...).
+
+Usage: $ python3 -m pytest tests
+"""
+
+import sys
+import os
+import re
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import indexer
+
+
+def load_index(tmp_path, text):
+    """ Loads text as a markdown input file """
+
+    input_file = tmp_path / "index.md"
+    input_file.write_text(text)
+    return indexer.load(input_file, cache=False, quiet=True)
+
+def test_search_after_sort(tmp_path):
+    index = load_index(tmp_path, "Apple 1.5 fruit\nBanana 2.42 fruit\nCherry 4.236 tree\nDate 3.1\n")
+    assert [entry.keyword for entry in indexer.search(index, 'banana')] == ['Banana']
+
+    indexer.sort(index, key=lambda entry: entry.page)
+    assert [entry.keyword for entry in indexer.search(index, 'banana')] == ['Banana']
+    assert [entry.keyword for entry in indexer.search(index, 'tree')] == ['Cherry']
+
+def test_locate_after_sort(tmp_path):
+    index = load_index(tmp_path, "Apple 1.5 fruit\nBanana 2.42 fruit\nCherry 4.236 tree\nDate 3.1\n")
+    assert [entry.keyword for entry in indexer.locate(index, '2.42')] == ['Banana']
+
+    indexer.sort(index, key=lambda entry: entry.page)
+    assert [entry.keyword for entry in indexer.locate(index, '2.42')] == ['Banana']
+    assert [entry.location for entry in indexer.locate(index, '1-4')] == ['1.5', '2.42', '3.1', '4.236']
+    assert indexer.gaps(index, '4.230-4.240') == {4: [[230, 235], [237, 240]]}
+
+def test_search_short_terms(tmp_path):
+    index = load_index(tmp_path, "Apple 1.5 fruit\nBanana 2.42 **yellow** fruit\nCherry 4.236 tree\nDate 3.1\nab 3.2 x\nq 3.3\n")
+    search_index = indexer.SearchIndex(index)
+    for field in search_index.FIELDS:
+        texts = search_index.texts[field]
+        terms = {text[i:i + length] for text in texts for length in (1, 2) for i in range(len(text))} | {'zz', '!'}
+        for term in terms:
+            assert search_index.find(term, field) == {position for position, text in enumerate(texts) if term in text}
+
+def test_entries(tmp_path):
+    index = load_index(tmp_path, "Apple 1.5 fruit\nBanana 2.42 fruit\nCherry 4.236 tree\nDate 3.1\n")
+    entries = index.entries
+    assert len(entries) == 4
+    assert entries[1].keyword == 'Banana' and entries[-1].location == '3.1'
+    assert [entry.keyword for entry in entries[1:3]] == ['Banana', 'Cherry']
+    assert [entry.keyword for entry in entries[::-2]] == ['Date', 'Banana']
+    with pytest.raises(IndexError):
+        entries[4]
+    with pytest.raises(TypeError):
+        entries['Keyword']
+
+def test_search_word_prefix(tmp_path):
+    index = load_index(tmp_path, "Linux kernel 1.1\nkernel module 1.2\nlinux kernel modules 1.3\n**Windows** registry 1.4 run keys\n")
+    assert [entry.keyword for entry in indexer.search(index, 'linux kern*')] == ['Linux kernel', 'linux kernel modules']
+    assert [entry.keyword for entry in indexer.search(index, 'mod*')] == ['kernel module', 'linux kernel modules']
+    assert [entry.keyword for entry in indexer.search(index, 'win*')] == ['**Windows** registry']
+    assert [entry.keyword for entry in indexer.search(index, 'ke*')] == ['kernel module', 'Linux kernel', 'linux kernel modules', '**Windows** registry']
+    assert indexer.search(index, 'ernel*') == []
+
+    search_index = indexer.SearchIndex(index)
+    for field in search_index.FIELDS:
+        texts = search_index.texts[field]
+        for term in ['k', 'ke', 'kernel', 'modules', 'r', 'run', 'x', 'l k', 'y ']:
+            expected = {position for position, text in enumerate(texts)
+                        if re.search(r'(?<!\w)' + re.escape(term), text)}
+            assert search_index.find_prefix(term, field) == expected
+
+def test_split_removes_only_its_pages(tmp_path):
+    out = tmp_path / "out"
+    out.mkdir()
+    file_name = str(out / "index.html")
+    index = load_index(tmp_path, "Apple 1.5 fruit\nBanana 2.42 fruit\nCherry 4.236 tree\n")
+    indexer.print_html_split(index, False, file_name)
+    assert (out / "index-B.html").exists() and (out / "index-C.html").exists()
+
+    # A file of the user's that looks like a page
+    (out / "index-D.html").write_text("notes")
+    index = load_index(tmp_path, "Apple 1.5 fruit\n")
+    indexer.print_html_split(index, False, file_name)
+    assert sorted(path.name for path in out.glob("index-*.html")) == ['index-A.html', 'index-D.html']
@@ -0,0 +1,65 @@
+"""
+test_cache.py
+
+Tests for the compiled index cache (load_cache/save_cache through load_files).
+
+Usage: $ python3 -m pytest tests
+"""
+
+import sys
+import os
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import indexer
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    """ An empty cache directory used by load_files (instead of CACHE_DIR) """
+
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setattr(indexer.load_cache, '__defaults__', (str(cache_dir),))
+    monkeypatch.setattr(indexer.save_cache, '__defaults__', ('', str(cache_dir)))
+    return cache_dir
+
+def test_warnings_on_cache_hit(tmp_path, cache_dir, capsys):
+    input_file = tmp_path / "index.md"
+    input_file.write_text("Apple 1.1\nno location here\nBanana 1.2\n")
+
+    indexer.load_files([str(input_file)])
+    cold = capsys.readouterr().out
+    assert "line 2: no keyword or location" in cold
+
+    index, _ = indexer.load_files([str(input_file)])
+    warm = capsys.readouterr().out
+    assert "Loaded 2 entries from cache" in warm
+    assert warm.replace("Loaded 2 entries from cache\n", "") == cold
+    assert index.keywords == ['Apple', 'Banana']
+
+def test_csv_name_changes_key(tmp_path, cache_dir):
+    text = "Keyword,Location\nfoo,1.1\nbar,1.2\n"
+    (tmp_path / "index.tsv").write_text(text)
+    (tmp_path / "index.csv").write_text(text)
+
+    # Read as markdown (the keywords keep their comma) then, same contents, as a CSV table
+    index, tsv = indexer.load_files([str(tmp_path / "index.tsv")])
+    assert not tsv and index.keywords == ['bar,', 'foo,']
+    index, tsv = indexer.load_files([str(tmp_path / "index.csv")])
+    assert tsv and index.keywords == ['bar', 'foo']
+
+def test_unwritable_cache(tmp_path, cache_dir, monkeypatch):
+    input_file = tmp_path / "index.md"
+    input_file.write_text("Apple 1.1\nBanana 1.2\n")
+    indexer.load_files([str(input_file)])
+    for cache_file in cache_dir.iterdir():
+        cache_file.write_bytes(b"not a cache file")
+
+    def refuse(*args, **kwargs):
+        raise PermissionError("read only")
+    monkeypatch.setattr(os, 'remove', refuse)
+    monkeypatch.setattr(os, 'utime', refuse)
+
+    index, _ = indexer.load_files([str(input_file)])
+    assert index.keywords == ['Apple', 'Banana']
@@ -0,0 +1,160 @@
+"""
+test_format.py
+
+Differential tests for format_to_html: the single scan version must give the same HTML as the
+str.replace() loops it replaced (legacy_format_to_html below), on hand-picked tricky inputs and on
+seeded random ones.
+
+The documented differences (see legacy_difference) are checked on their own instead:
+ - a ;; without a space after it, the old function raised ValueError, it is now left as literal text
+ - '>;' and '<;', the old function escaped < and > first so the ; of &gt; / &lt; could make a ;;
+ - colour names containing markup (\\ * < > ;), the old function formatted inside the style attribute
+
+Usage: $ python3 -m pytest tests
+"""
+
+import sys
+import os
+import re
+import random
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import indexer
+
+
+def legacy_format_to_html(text):
+    """ format_to_html before the single scan version (unchanged) """
+
+    # First escape angle brackets
+    text = text.replace('<', '&lt;')
+    text = text.replace('>', '&gt;')
+    # Add in line breaks -- catching escaped ones
+    text = text.replace('\\\\n', '!NEWLINE!')
+    text = text.replace('\\n', '<br>')
+    text = text.replace('!NEWLINE!', '\\n')
+
+    #Color characters
+    while ';;' in text:
+        tag_index = text.index(";;") + 2
+        tag_stop_index = text.index(" ", tag_index)
+        color = text[tag_index:tag_stop_index]
+
+        text = text.replace(";;"+color, f"<span style=\"color:{color}\">", 1)
+        text = text.replace(";;", "</span>", 1)
+
+    # Bold
+    while '**' in text:
+        text = text.replace("**", "<span class=\"bold\">", 1)
+        text = text.replace("**", "</span>", 1)
+
+    # Italic while saving '*' characters
+    if not text.count('*') == 1: # Single asterisk? Might be in tsv file or not escaped
+        if '\\*' in text:
+            text = text.replace('\\*', "!AST!")
+        while '*' in text:
+            text = text.replace("*", "<span class=\"italic\">", 1)
+            text = text.replace("*", "</span>", 1)
+        if '!AST!' in text:
+            text = text.replace('!AST!', '*')
+
+    return text
+
+# Colour names (up to the next space) holding something the old function would format
+MARKUP_COLOUR_RE = re.compile(r";;[^ ]*[\\*<>;][^ ]* ")
+
+def legacy_difference(text):
+    """ Which documented difference applies to text (None if the output must be the same) """
+
+    try:
+        legacy_format_to_html(text)
+    except ValueError:
+        return 'crash'
+    if '>;' in text or '<;' in text:
+        return 'escaped bracket'
+    if MARKUP_COLOUR_RE.search(text):
+        return 'markup in colour'
+    return None
+
+TRICKY = [
+    "",
+    "plain text",
+    "**bold**",
+    "*italic*",
+    "***bold italic***",
+    "**bold *and italic***",
+    "*italic **and bold***",
+    "**unclosed bold",
+    "*unclosed italic",
+    "single * asterisk",
+    "two * lonely * asterisks",
+    "**bold** and a single *",
+    "escaped \\* asterisk",
+    "escaped \\* and *italic*",
+    "\\*\\*not bold\\*\\*",
+    "\\** next to bold**",
+    "**\\***",
+    ";;red red text;;",
+    ";;red red **bold** text;;",
+    ";;blue blue;; and ;;green green;;",
+    ";;red nested ;;blue colours;; ;;",
+    ";;red unclosed colour",
+    "text;; closing with nothing open",
+    ";;#ff0000 hex colour;;",
+    "line\\nbreak",
+    "escaped \\\\n newline",
+    "\\\\\\n three backslashes",
+    "trailing backslash \\",
+    "<script>alert(1)</script>",
+    "a < b > c",
+    "**<b>**",
+    ";;red <red> ;;",
+    "*a*b*c*",
+    "****",
+    "*****",
+    ";;red *italic colour*;;",
+    "1.103 **WMI** \\n;;purple persistence;;",
+]
+
+DIFFERENCES = [
+    ("no space after ;;", "text ;;red", 'crash'),
+    ("no space after ;;", ";;", 'crash'),
+    ("escaped bracket", "a>;;red b;;", 'escaped bracket'),
+    ("escaped bracket", "x <;;blue y;;", 'escaped bracket'),
+    ("markup in colour", ";;re*d text;; *a*", 'markup in colour'),
+    ("markup in colour", ";;<b> text;;", 'markup in colour'),
+    ("markup in colour", ";;red\\n text;;", 'markup in colour'),
+]
+
+@pytest.mark.parametrize("text", TRICKY)
+def test_tricky(text):
+    assert legacy_difference(text) is None
+    assert indexer.format_to_html(text) == legacy_format_to_html(text)
+
+# Pieces the random inputs are made of, every kind of markup and some text around it
+FUZZ_PIECES = ["\\", "\\\\n", "\\n", "\\*", "*", "**", ";;", ";;red ", ";;blue ", "<", ">", " ", "a", "word", "red ", ";"]
+
+def random_text(r):
+    return ''.join(r.choices(FUZZ_PIECES, k=r.randint(0, 12)))
+
+def test_fuzz():
+    r = random.Random(1)
+    compared = 0
+    for _ in range(50000):
+        text = random_text(r)
+        if legacy_difference(text) is None:
+            assert indexer.format_to_html(text) == legacy_format_to_html(text), text
+            compared += 1
+    # Most inputs must actually be compared
+    assert compared > 25000
+
+@pytest.mark.parametrize("reason, text, difference", DIFFERENCES)
+def test_differences(reason, text, difference):
+    assert legacy_difference(text) == difference
+    html = indexer.format_to_html(text)
+    assert isinstance(html, str)
+    # Nothing the user typed gets through as a tag
+    assert "<b>" not in html
+    if difference == 'crash':
+        assert ';;' in html
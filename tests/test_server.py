@@ -0,0 +1,67 @@
+"""
+test_server.py
+
+Starts the HTTP server (--serve) on a free port and makes one request to it.
+
+Usage: $ python3 -m pytest tests
+"""
+
+import sys
+import os
+import json
+import socket
+import asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import indexer
+
+
+def free_port():
+    """ A port nothing is listening on """
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+async def request_status(server, port):
+    """ Runs the server like --serve does, returns the response to GET /status """
+
+    running = asyncio.create_task(server.run('127.0.0.1', port))
+    try:
+        for _ in range(100):
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                break
+            except OSError:
+                await asyncio.sleep(0.05)
+        writer.write(b"GET /status HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        if running.done():
+            running.result() # raises what stopped the server
+        return response
+    finally:
+        running.cancel()
+
+def test_serve(tmp_path):
+    input_file = tmp_path / "index.md"
+    input_file.write_text("Linux 1.103 A free operating system\nWindows 1.105\n")
+    server = indexer.IndexServer([str(input_file)], cache=False)
+    assert server.load()
+
+    response = asyncio.run(request_status(server, free_port()))
+    head, _, body = response.partition(b"\r\n\r\n")
+    assert head.startswith(b"HTTP/1.1 200")
+    assert json.loads(body)["entries"] == 2
+
+def test_serve_embed_search(tmp_path):
+    input_file = tmp_path / "index.md"
+    input_file.write_text("Linux 1.103 A free operating system\nWindows 1.105\n")
+    for embed_search in (False, True):
+        server = indexer.IndexServer([str(input_file)], cache=False, embed_search=embed_search)
+        assert server.load()
+        status, _, body = server.handle_request('GET', '/')
+        assert status == 200
+        assert (b'id="search-data"' in body) == embed_search
+        assert body == ''.join(indexer.render(server.current[0], search=embed_search)).encode()
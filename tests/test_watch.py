@@ -0,0 +1,45 @@
+"""
+test_watch.py
+
+Tests for --watch (IndexWatcher): after an update, the outputs must be the same as a fresh build of the edited files.
+
+Usage: $ python3 -m pytest tests
+"""
+
+import sys
+import os
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import indexer
+
+
+INDEXER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'indexer.py')
+
+LINES = ["Apple 1.5 fruit\n", "apple 2.7 *fruit* again\n", "Banana 2.42 fruit\n", "Cherry 4.236 tree\n",
+         "Date 3.1\n", "Elderberry 1.9 ;;red;;shrub\n", "Fig 5.12 tree\n", "Grape 2.2 vine\n", "Kernel 6.1 Linux kernel\n",
+         "Linux 1.103 A free operating system\n", "Mango 3.33 tree\n", "Windows 1.105\n", "Zebra 9.9 crossing\n"]
+
+def test_update_matches_fresh_build(tmp_path, monkeypatch, capsys):
+    input_file = tmp_path / "index.md"
+    input_file.write_text(''.join(LINES))
+    monkeypatch.chdir(tmp_path)
+    watcher = indexer.IndexWatcher([str(input_file)], book_colours=True, duplicates=True, cache=False)
+    assert watcher.load()
+
+    # Edit a line, delete one and append two (a new letter and a duplicate)
+    lines = list(LINES)
+    lines[3] = "Cherry 4.237 tree, moved\n"
+    del lines[7]
+    lines += ["Quince 7.7 fruit\n", "BANANA 8.1 again\n"]
+    input_file.write_text(''.join(lines))
+    capsys.readouterr()
+    watcher.update()
+    assert "Updated 3 added and 2 removed entries" in capsys.readouterr().out
+
+    fresh = tmp_path / "fresh"
+    fresh.mkdir()
+    subprocess.run([sys.executable, INDEXER, '-cd', '--no-cache', str(input_file)], cwd=fresh,
+                   stdout=subprocess.DEVNULL, check=True)
+    for file_name in ("index.html", "duplicates.html"):
+        assert (tmp_path / file_name).read_bytes() == (fresh / file_name).read_bytes(), file_name